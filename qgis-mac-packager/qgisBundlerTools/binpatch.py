@@ -0,0 +1,99 @@
+# 2018 Peter Petrik (zilolv at gmail dot com)
+# GNU General Public License 2 any later version
+
+# Patch hardcoded paths in binaries. The NUL-terminated C strings
+# are rewritten in place in the memory-mapped file, the new string
+# is padded with NULs, so the binary keeps the same layout.
+
+import mmap
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from . import instrument
+
+
+class BinaryPatchError(Exception):
+    pass
+
+
+def _to_bytes(s):
+    if isinstance(s, str):
+        return s.encode("utf-8")
+    return s
+
+
+def _cstring_bounds(mm, pos):
+    # start and end (position of NUL) of the C string containing pos
+    start = mm.rfind(b"\0", 0, pos) + 1
+    end = mm.find(b"\0", pos)
+    if end == -1:
+        end = len(mm)
+    return start, end
+
+
+def patch_binary(path, rules):
+    # rules is list of (prefix, replacement), replacement must not be longer
+    # returns number of patched strings
+    rules = [(_to_bytes(old), _to_bytes(new)) for old, new in rules]
+    for old, new in rules:
+        if len(new) > len(old):
+            raise BinaryPatchError("Replacement " + new.decode("utf-8") + " is longer than " + old.decode("utf-8"))
+
+    if os.path.getsize(path) == 0:
+        return 0
+
+    patched = 0
+    with open(path, "r+b") as f:
+        with mmap.mmap(f.fileno(), 0) as mm:
+            for old, new in rules:
+                pos = mm.find(old)
+                while pos != -1:
+                    start, end = _cstring_bounds(mm, pos)
+                    cstring = mm[start:end]
+                    replaced = cstring.replace(old, new)
+                    mm[start:end] = replaced + b"\0" * (len(cstring) - len(replaced))
+                    patched += 1
+                    pos = mm.find(old, start + len(replaced))
+            if patched:
+                mm.flush()
+
+    if patched:
+        instrument.add_files()
+    return patched
+
+
+def find_strings(path, needle):
+    # list of (offset, C string) of all strings with needle, same as strings | grep
+    needle = _to_bytes(needle)
+    if os.path.getsize(path) == 0:
+        return []
+
+    found = []
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = mm.find(needle)
+            while pos != -1:
+                start, end = _cstring_bounds(mm, pos)
+                found.append((start, mm[start:end].decode("utf-8", "replace")))
+                pos = mm.find(needle, end)
+    return found
+
+
+def _find_strings_entry(item):
+    path, needle = item
+    try:
+        return path, find_strings(path, needle)
+    except (IOError, OSError, ValueError):
+        return path, []
+
+
+def scan_binaries(paths, needle, jobs):
+    # path -> occurrences of needle, for all paths with at least one
+    context = multiprocessing.get_context("fork")
+    result = {}
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+        for path, found in executor.map(_find_strings_entry, [(p, needle) for p in sorted(paths)], chunksize=16):
+            if found:
+                result[path] = found
+    return result
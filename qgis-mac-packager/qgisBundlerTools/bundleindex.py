@@ -0,0 +1,143 @@
+# 2018 Peter Petrik (zilolv at gmail dot com)
+# GNU General Public License 2 any later version
+
+# In-memory index of the bundle filesystem, built once with scandir
+# and then kept up to date by CopyUtils, so the steps do not need
+# to walk the whole bundle again and again
+
+import os
+
+from . import utils
+
+
+class FileEntry:
+    def __init__(self, path, is_dir, is_link, link_target):
+        self.path = path
+        # for links it is type of the link target, same as os.walk
+        self.is_dir = is_dir
+        self.is_link = is_link
+        self.link_target = link_target
+
+    # size and mode are not stored, files are rewritten
+    # in place (relink plan, binpatch, chmod) after indexing
+    @property
+    def size(self):
+        return os.lstat(self.path).st_size
+
+    @property
+    def mode(self):
+        return os.lstat(self.path).st_mode
+
+    def classify(self):
+        # utils.FILE_* type, cached in utils for the whole run
+        return utils.classify_file(self.path)
+
+
+def _entry(path, dir_entry=None):
+    if dir_entry is not None:
+        is_link = dir_entry.is_symlink()
+        is_dir = dir_entry.is_dir()
+    else:
+        is_link = os.path.islink(path)
+        is_dir = os.path.isdir(path)
+    link_target = os.readlink(path) if is_link else None
+    return FileEntry(path, is_dir, is_link, link_target)
+
+
+class BundleIndex:
+    def __init__(self, root):
+        self.root = root
+        # path -> FileEntry
+        self.entries = {}
+        # directory path -> set of names in it
+        self.children = {}
+
+    def build(self):
+        self.entries = {}
+        self.children = {}
+        self.entries[self.root] = _entry(self.root)
+        self._scan(self.root)
+        print("Indexed {} files in {}".format(len(self.entries), self.root))
+
+    def _scan(self, directory):
+        names = self.children.setdefault(directory, set())
+        with os.scandir(directory) as it:
+            for dir_entry in it:
+                path = os.path.join(directory, dir_entry.name)
+                e = _entry(path, dir_entry)
+                self.entries[path] = e
+                names.add(dir_entry.name)
+                # same as os.walk, do not follow symlinks to directories
+                if e.is_dir and not e.is_link:
+                    self._scan(path)
+
+    def _in_root(self, path):
+        return path == self.root or path.startswith(self.root + "/")
+
+    def add(self, path):
+        # (re)index path, for directories also its content
+        path = os.path.normpath(path)
+        if not self._in_root(path):
+            return
+        if not os.path.lexists(path):
+            self.remove(path)
+            return
+
+        parent = os.path.dirname(path)
+        if parent not in self.entries and parent != path:
+            self.add(parent)
+
+        self.remove(path)
+        e = _entry(path)
+        self.entries[path] = e
+        if path != self.root:
+            self.children.setdefault(parent, set()).add(os.path.basename(path))
+        if e.is_dir and not e.is_link:
+            self._scan(path)
+
+    def remove(self, path):
+        path = os.path.normpath(path)
+        if path not in self.entries:
+            return
+        e = self.entries.pop(path)
+        for name in self.children.pop(path, set()):
+            self.remove(os.path.join(path, name))
+        parent = os.path.dirname(path)
+        if parent in self.children:
+            self.children[parent].discard(os.path.basename(path))
+
+    def get(self, path):
+        return self.entries.get(os.path.normpath(path))
+
+    def exists(self, path):
+        return os.path.normpath(path) in self.entries
+
+    def files(self, top=None):
+        # all non-directory entries, same as files of os.walk
+        top = top or self.root
+        return sorted(p for p, e in self.entries.items()
+                      if not e.is_dir and (p.startswith(top + "/")))
+
+    def walk(self, top=None):
+        # replacement of os.walk(top), directories removed
+        # or pruned from dirs by the caller are not visited
+        top = os.path.normpath(top or self.root)
+        if top not in self.children:
+            return
+        dirs = []
+        files = []
+        for name in sorted(self.children[top]):
+            e = self.entries[os.path.join(top, name)]
+            if e.is_dir:
+                dirs.append(name)
+            else:
+                files.append(name)
+
+        yield top, dirs, files
+
+        for name in dirs:
+            path = os.path.join(top, name)
+            e = self.entries.get(path)
+            if e is not None and not e.is_link:
+                for item in self.walk(path):
+                    yield item
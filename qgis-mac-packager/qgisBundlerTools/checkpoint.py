@@ -0,0 +1,60 @@
+# 2018 Peter Petrik (zilolv at gmail dot com)
+# GNU General Public License 2 any later version
+
+# State passed between the named bundler steps (dependency sets,
+# qt/qca directories, ...), saved after each finished step so the
+# bundling can be resumed from any step (--resume_from, --only)
+# against an existing bundle directory
+
+import json
+import os
+
+
+class CheckpointError(Exception):
+    pass
+
+
+class BundlerState:
+    def __init__(self, filename):
+        self.filename = filename
+        # names of finished steps in order
+        self.completed = []
+        # step outputs, must be json serializable
+        self.data = {}
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            raise CheckpointError("Missing " + self.filename + ", unable to resume, run the whole bundling first")
+        with open(self.filename, "r") as f:
+            content = json.load(f)
+        self.completed = content["completed"]
+        self.data = content["data"]
+
+    def save(self):
+        with open(self.filename, "w") as f:
+            json.dump({"completed": self.completed, "data": self.data}, f, indent=1, sort_keys=True)
+
+    def is_done(self, step):
+        return step in self.completed
+
+    def done(self, step):
+        if step not in self.completed:
+            self.completed.append(step)
+        self.save()
+
+    def invalidate(self, steps):
+        # steps which are re-run are not finished anymore
+        self.completed = [s for s in self.completed if s not in steps]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        if key not in self.data:
+            raise CheckpointError("Missing " + key + " in " + self.filename + ", run the previous steps first")
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        if isinstance(value, set):
+            value = sorted(value)
+        self.data[key] = value
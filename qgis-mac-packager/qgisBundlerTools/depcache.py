@@ -0,0 +1,98 @@
+# 2018 Peter Petrik (zilolv at gmail dot com)
+# GNU General Public License 2 any later version
+
+# Persistent cache of the binary dependency analysis
+# Nightly/LTR/PR builds analyze almost the same homebrew
+# libraries every day, so we store the parsed load commands
+# keyed by the hash of the Mach-O headers and load commands
+# (macho.load_commands_digest).
+# The key does not depend on the path, so the files recopied
+# to the bundle in each run still hit the cache.
+
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# commit to disk after this number of new entries,
+# so the work is not lost when the bundler fails
+COMMIT_INTERVAL = 500
+
+
+class DependencyCache:
+    def __init__(self, filename, max_entries=100000):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS deps ("
+                           "digest TEXT PRIMARY KEY, deps TEXT, last_used REAL)")
+        self._conn.commit()
+        # entries not yet committed are saved on any exit
+        atexit.register(self.commit)
+
+    def get(self, digest):
+        # digest is macho.load_commands_digest of the file
+        # returns dictionary with frameworks, sys_libs, libs and rpaths or None
+        with self._lock:
+            row = self._conn.execute("SELECT deps FROM deps WHERE digest=?", (digest,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._conn.execute("UPDATE deps SET last_used=? WHERE digest=?", (time.time(), digest))
+            return json.loads(row[0])
+
+    def put(self, digest, deps):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO deps VALUES (?, ?, ?)",
+                               (digest, json.dumps(deps), time.time()))
+            self._pending += 1
+            if self._pending >= COMMIT_INTERVAL:
+                self._conn.commit()
+                self._pending = 0
+
+    def commit(self):
+        with self._lock:
+            if self._conn and self._pending:
+                self._conn.commit()
+                self._pending = 0
+
+    def evict(self):
+        # keep only max_entries most recently used entries
+        with self._lock:
+            self._conn.execute("DELETE FROM deps WHERE digest NOT IN "
+                               "(SELECT digest FROM deps ORDER BY last_used DESC LIMIT ?)",
+                               (self.max_entries,))
+            self._conn.commit()
+            self._pending = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def report(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM deps").fetchone()[0]
+        print("Dependency cache " + self.filename + ": " +
+              "{} hits, {} misses ({:.1f}% hit rate), {} entries".format(
+                  self.hits, self.misses, 100 * self.hit_rate(), count))
+
+    def close(self):
+        self.evict()
+        self.report()
+        atexit.unregister(self.commit)
+        self._conn.close()
+        self._conn = None
@@ -0,0 +1,123 @@
+# 2018 Peter Petrik (zilolv at gmail dot com)
+# GNU General Public License 2 any later version
+
+# Who-depends-on-whom graph of the bundled binaries,
+# built in STEP 1 and stored next to the bundle, so we
+# can find out why some library is bundled without
+# re-running the analysis
+
+import json
+import os
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class DependencyGraphError(Exception):
+    pass
+
+
+class DependencyGraph:
+    def __init__(self):
+        # path -> otool binary type (SYS_LIB, LIB, FRAMEWORK, BINARY)
+        self.nodes = {}
+        # path -> set of paths it loads
+        self.edges = {}
+        # path -> set of paths loading it
+        self.reverse_edges = {}
+
+    def add_node(self, path, type):
+        self.nodes[path] = type
+        self.edges.setdefault(path, set())
+        self.reverse_edges.setdefault(path, set())
+
+    def add_edge(self, src, dest):
+        if src == dest:
+            return
+        self.edges.setdefault(src, set()).add(dest)
+        self.reverse_edges.setdefault(dest, set()).add(src)
+
+    def binary_type(self, path):
+        return self.nodes.get(path)
+
+    def dependencies(self, path):
+        return self.edges.get(path, set())
+
+    def dependents(self, path):
+        return self.reverse_edges.get(path, set())
+
+    def _walk(self, roots, edges):
+        visited = set()
+        stack = list(roots)
+        while stack:
+            path = stack.pop()
+            if path in visited:
+                continue
+            visited.add(path)
+            stack.extend(edges.get(path, set()) - visited)
+        return visited
+
+    def closure(self, roots):
+        # everything loaded (transitively) by the roots, including roots
+        return self._walk(roots, self.edges)
+
+    def reverse_closure(self, roots):
+        # everything that (transitively) loads the roots, including roots
+        return self._walk(roots, self.reverse_edges)
+
+    def find(self, name):
+        return sorted(p for p in self.nodes if name in os.path.basename(p))
+
+    def why(self, path):
+        # shortest chain from some node nobody depends on down to path
+        parents = {path: None}
+        queue = [path]
+        while queue:
+            current = queue.pop(0)
+            if not self.dependents(current):
+                chain = []
+                while current is not None:
+                    chain.append(current)
+                    current = parents[current]
+                return chain
+            for d in sorted(self.dependents(current)):
+                if d not in parents:
+                    parents[d] = current
+                    queue.append(d)
+        return [path]
+
+    def to_dict(self):
+        return {"nodes": self.nodes,
+                "edges": {k: sorted(v) for k, v in self.edges.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        graph = cls()
+        for path, type in data["nodes"].items():
+            graph.add_node(path, type)
+        for src, dests in data["edges"].items():
+            for dest in dests:
+                graph.add_edge(src, dest)
+        return graph
+
+    def save(self, filename):
+        if filename.endswith(".msgpack"):
+            if msgpack is None:
+                raise DependencyGraphError("msgpack module is not installed")
+            with open(filename, "wb") as f:
+                f.write(msgpack.packb(self.to_dict()))
+        else:
+            with open(filename, "w") as f:
+                json.dump(self.to_dict(), f, indent=1, sort_keys=True)
+
+    @classmethod
+    def load(cls, filename):
+        if filename.endswith(".msgpack"):
+            if msgpack is None:
+                raise DependencyGraphError("msgpack module is not installed")
+            with open(filename, "rb") as f:
+                return cls.from_dict(msgpack.unpackb(f.read(), raw=False))
+        with open(filename, "r") as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,129 @@
+# 2018 Peter Petrik (zilolv at gmail dot com)
+# GNU General Public License 2 any later version
+
+# Bookkeeping for incremental bundling (--incremental)
+#
+# Every file copied to the bundle (a "product") is recorded with
+# the signature of its source and with the final state of the
+# destination at the end of the successful run. Next run the file
+# is kept as it is (already patched) when neither the source nor
+# the destination changed since then, and products which are
+# no longer produced are removed from the bundle.
+#
+# Mach-O binaries are always copied again, the dependency analysis
+# needs them with the original (not relinked) load commands.
+
+import json
+import os
+import stat
+
+from . import utils
+
+
+def _dest_state(dest):
+    # final state of the destination, None when it does not exist
+    # (e.g. removed by clean_redundant_files)
+    parent = os.path.dirname(dest)
+    if os.path.realpath(parent) != os.path.abspath(parent):
+        # somewhere below a symlinked directory, we cannot tell
+        return "unknown"
+    try:
+        st = os.lstat(dest)
+    except OSError:
+        return None
+    return [stat.S_IFMT(st.st_mode), st.st_size, st.st_mtime_ns]
+
+
+class IncrementalSync:
+    def __init__(self, manifest_file, incremental):
+        self.manifest_file = manifest_file
+        self.incremental = incremental
+        # dest -> record from the previous successful run
+        self.previous = {}
+        # dest -> record of this run
+        self.products = {}
+        # destinations (re)copied in this run
+        self.changed = set()
+        # continuing the run of the last checkpoint
+        self.resumed = False
+        # directories synced in this run
+        self.trees = set()
+        self.kept = 0
+        self.skipped = 0
+        self.bytes_copied = 0
+
+        if incremental and os.path.exists(manifest_file):
+            with open(manifest_file, "r") as f:
+                self.previous = json.load(f)["products"]
+
+    def resume(self):
+        # continue the run of the last checkpoint, everything in the manifest
+        # is already produced and all files are considered changed
+        for dest, record in self.previous.items():
+            self.products[dest] = {"signature": record["signature"]}
+        self.resumed = True
+
+    def source_signature(self, src, link_target=None):
+        if link_target is not None:
+            return {"src": src, "link": link_target}
+        st = os.stat(src)
+        return {"src": src, "size": st.st_size, "mtime": st.st_mtime_ns}
+
+    def needs_copy(self, dest, signature):
+        # returns True when the dest must be (re)created from the source
+        prev = self.previous.get(dest)
+        if prev is None or prev["signature"] != signature:
+            return True
+
+        if "link" not in signature and utils.classify_file(signature["src"]) == utils.FILE_MACHO:
+            return True
+
+        final = prev["dest"]
+        if final == "unknown":
+            return True
+        if final is None:
+            # source did not change and some later step removed the file last time,
+            # it will be removed again, so do not copy it at all
+            self.skipped += 1
+            return False
+
+        if _dest_state(dest) != final:
+            return True
+
+        self.kept += 1
+        return False
+
+    def produced(self, dest, signature, copied):
+        self.products[dest] = {"signature": signature}
+        if copied:
+            self.changed.add(dest)
+            if "size" in signature:
+                self.bytes_copied += signature["size"]
+
+    def produced_tree(self, dest):
+        self.trees.add(dest)
+
+    def is_produced(self, dest):
+        return dest in self.products or dest in self.trees
+
+    def is_changed(self, dest):
+        # files which were not produced by copy (e.g. created by some step) are always changed
+        return self.resumed or dest in self.changed or dest not in self.products
+
+    def is_copied(self, dest):
+        # copied from the source in this run, i.e. not modified by any step yet
+        return dest in self.changed
+
+    def stale(self):
+        # products of previous run, which are not produced any more
+        return sorted(set(self.previous.keys()) - set(self.products.keys()))
+
+    def report(self):
+        print("Incremental sync: {} copied ({:.1f} MB), {} kept, {} skipped as removed".format(
+            len(self.changed), self.bytes_copied / 1024.0 / 1024.0, self.kept, self.skipped))
+
+    def save(self):
+        for dest, record in self.products.items():
+            record["dest"] = _dest_state(dest)
+        with open(self.manifest_file, "w") as f:
+            json.dump({"products": self.products}, f, indent=1, sort_keys=True)
@@ -4,30 +4,63 @@
 import subprocess
 import os
 from .utils import framework_name
+from . import macho
 
 
-def fix_lib(binary, depLibs, contentsPath, relLibPathToExe, relLibPathToFramework):
+def lib_edits(binary, depLibs, contentsPath, relLibPathToExe, relLibPathToFramework):
+    # returns (id, changes, rpaths to delete) for the binary
     binary = os.path.realpath(binary)
-    p = binary.replace(contentsPath, "@executable_path/..")
-    args = ["install_name_tool", "-id", p, binary]
-    try:
-        subprocess.check_output(args, encoding='UTF-8')
-    except:
-        print("WARNING: " + binary)
+    id_name = binary.replace(contentsPath, "@executable_path/..")
 
+    changes = {}
     for lib in depLibs.libs:
-        args = ["install_name_tool",
-                "-change", lib,
-                relLibPathToExe + "/" + os.path.basename(lib),
-                binary]
-        try:
-            subprocess.check_output(args, encoding='UTF-8')
-        except:
-            print("WARNING: " + binary)
+        changes[lib] = relLibPathToExe + "/" + os.path.basename(lib)
 
     for framework in depLibs.frameworks:
         frameworkName, frameworkDir = framework_name(framework)
         # Do not use versions lib, just the main one
-        framework_path = relLibPathToFramework + "/" + frameworkName + ".framework/" + frameworkName
-        args = ["install_name_tool", "-change", framework, framework_path, binary]
+        changes[framework] = relLibPathToFramework + "/" + frameworkName + ".framework/" + frameworkName
+
+    # all dependencies are relinked to @executable_path,
+    # rpaths to the build machine are not needed and
+    # would make dyld to search there on the user machine
+    delete_rpaths = [r for r in depLibs.rpaths if os.path.isabs(r) and not r.startswith(contentsPath)]
+
+    return id_name, changes, delete_rpaths
+
+
+def apply_edits(binary, id_name, changes, delete_rpaths):
+    # patch load commands in place, binaries which
+    # already have the right paths are not touched at all
+    try:
+        macho.rewrite_load_commands(binary, id_name, changes, delete_rpaths)
+        return
+    except macho.MachOError as err:
+        print("WARNING: " + binary + ": " + str(err) + ", trying install_name_tool")
+
+    # fallback, all edits in one process
+    slices = macho.read_slices(binary)
+    s = macho.main_slice(slices)
+    if s is None:
+        return
+
+    args = ["install_name_tool"]
+    if s.id_dylib() is not None and id_name is not None:
+        args += ["-id", id_name]
+    for lib in s.dylibs():
+        if lib in changes:
+            args += ["-change", lib, changes[lib]]
+    for rpath in s.rpaths():
+        if rpath in delete_rpaths:
+            args += ["-delete_rpath", rpath]
+    args += [binary]
+    try:
         subprocess.check_output(args, encoding='UTF-8')
+    except:
+        print("WARNING: " + binary)
+
+
+def fix_lib(binary, depLibs, contentsPath, relLibPathToExe, relLibPathToFramework):
+    binary = os.path.realpath(binary)
+    id_name, changes, delete_rpaths = lib_edits(binary, depLibs, contentsPath, relLibPathToExe, relLibPathToFramework)
+    apply_edits(binary, id_name, changes, delete_rpaths)
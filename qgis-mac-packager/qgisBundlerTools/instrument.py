@@ -0,0 +1,189 @@
+# 2018 Peter Petrik (zilolv at gmail dot com)
+# GNU General Public License 2 any later version
+
+# Wall time, CPU time, peak RSS, bytes copied, files touched
+# and number of spawned processes of the bundler steps and of the
+# functions in steps.py, written as JSON report next to the bundle,
+# so we can compare the nightly runs
+#
+# Processes spawned by forked workers (e.g. install_name_tool fallback
+# in relink plan) are not counted
+
+import functools
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+# counted separately, everything else is "other"
+TOOLS = ["otool", "install_name_tool", "chmod", "file", "diff"]
+
+_lock = threading.Lock()
+_counters = {"bytes_copied": 0, "files_touched": 0}
+_processes = dict((tool, 0) for tool in TOOLS + ["other"])
+# name -> record
+_steps = {}
+_step_order = []
+_functions = {}
+# function name -> depth of the recursion, only outermost call is measured
+_depth = {}
+_started = None
+_original_popen = None
+
+
+class _CountingPopen(subprocess.Popen):
+    def __init__(self, args, *posargs, **kwargs):
+        process_started(args)
+        super().__init__(args, *posargs, **kwargs)
+
+
+def install():
+    # count all processes started by subprocess module
+    global _original_popen, _started
+    if _original_popen is None:
+        _original_popen = subprocess.Popen
+        subprocess.Popen = _CountingPopen
+    _started = time.time()
+
+
+def process_started(args):
+    if isinstance(args, (str, bytes)):
+        exe = args.split()[0] if args else ""
+    else:
+        exe = args[0] if args else ""
+    tool = os.path.basename(str(exe))
+    if tool not in TOOLS:
+        tool = "other"
+    with _lock:
+        _processes[tool] += 1
+
+
+def add_bytes(size):
+    with _lock:
+        _counters["bytes_copied"] += size
+
+
+def add_files(count=1):
+    with _lock:
+        _counters["files_touched"] += count
+
+
+def _peak_rss():
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return max(own, children)
+
+
+def _cpu_time():
+    # including finished child processes
+    t = 0.0
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        t += usage.ru_utime + usage.ru_stime
+    return t
+
+
+def _snapshot():
+    with _lock:
+        return {"wall": time.perf_counter(),
+                "cpu": _cpu_time(),
+                "bytes_copied": _counters["bytes_copied"],
+                "files_touched": _counters["files_touched"],
+                "processes": dict(_processes)}
+
+
+def _delta(start, end):
+    return {"wall_time": round(end["wall"] - start["wall"], 3),
+            "cpu_time": round(end["cpu"] - start["cpu"], 3),
+            "bytes_copied": end["bytes_copied"] - start["bytes_copied"],
+            "files_touched": end["files_touched"] - start["files_touched"],
+            "processes": dict((tool, end["processes"][tool] - start["processes"][tool]) for tool in end["processes"])}
+
+
+def step_started(name):
+    _steps[name] = {"start": _snapshot(), "start_peak_rss": _peak_rss()}
+    if name not in _step_order:
+        _step_order.append(name)
+
+
+def step_finished(name):
+    record = _steps[name]
+    record.update(_delta(record.pop("start"), _snapshot()))
+    # ru_maxrss is the high-water mark of the whole run, not of the step,
+    # so we store it as it is and how much the step raised it
+    peak = _peak_rss()
+    record["cumulative_peak_rss"] = peak
+    record["peak_rss_growth"] = peak - record.pop("start_peak_rss")
+
+
+def timed(func):
+    # decorator for the functions in steps.py
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _lock:
+            _depth[name] = _depth.get(name, 0) + 1
+            outermost = _depth[name] == 1
+        start = _snapshot() if outermost else None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with _lock:
+                _depth[name] -= 1
+            if outermost:
+                d = _delta(start, _snapshot())
+                with _lock:
+                    record = _functions.setdefault(name, {"calls": 0, "wall_time": 0.0, "cpu_time": 0.0,
+                                                          "bytes_copied": 0, "files_touched": 0,
+                                                          "processes": dict((tool, 0) for tool in _processes)})
+                    record["calls"] += 1
+                    for key in ["wall_time", "cpu_time", "bytes_copied", "files_touched"]:
+                        record[key] += d[key]
+                    for tool, count in d["processes"].items():
+                        record["processes"][tool] += count
+
+    return wrapper
+
+
+def report():
+    steps = []
+    for name in _step_order:
+        record = dict(_steps[name])
+        if "start" in record:
+            # failed or still running
+            record = _delta(record.pop("start"), _snapshot())
+            record["finished"] = False
+        record["name"] = name
+        steps.append(record)
+
+    functions = {}
+    for name, record in _functions.items():
+        functions[name] = dict(record, wall_time=round(record["wall_time"], 3), cpu_time=round(record["cpu_time"], 3))
+
+    return {"started": _started,
+            "wall_time": round(time.time() - _started, 3) if _started else None,
+            "cpu_time": round(_cpu_time(), 3),
+            "peak_rss": _peak_rss(),
+            "bytes_copied": _counters["bytes_copied"],
+            "files_touched": _counters["files_touched"],
+            "processes": dict(_processes),
+            "steps": steps,
+            "functions": functions}
+
+
+def save(filename):
+    with open(filename, "w") as f:
+        json.dump(report(), f, indent=1, sort_keys=True)
+
+
+def print_summary():
+    for record in report()["steps"]:
+        print("  {:<20} {:8.1f} s wall {:8.1f} s cpu {:8.1f} MB copied {:7d} files {:6d} processes".format(
+            record["name"], record["wall_time"], record["cpu_time"], record["bytes_copied"] / 1024.0 / 1024.0,
+            record["files_touched"], sum(record["processes"].values())))
@@ -0,0 +1,329 @@
+# 2018 Peter Petrik (zilolv at gmail dot com)
+# GNU General Public License 2 any later version
+
+# Minimal Mach-O reader, so we do not need to spawn otool
+# for every file in the bundle. Reads only the header and the
+# load commands we are interested in (dylibs and rpaths).
+#
+# https://opensource.apple.com/source/xnu/xnu-4903.221.2/EXTERNAL_HEADERS/mach-o/loader.h
+# https://opensource.apple.com/source/xnu/xnu-4903.221.2/EXTERNAL_HEADERS/mach-o/fat.h
+
+import hashlib
+import struct
+
+MH_MAGIC = 0xfeedface
+MH_CIGAM = 0xcefaedfe
+MH_MAGIC_64 = 0xfeedfacf
+MH_CIGAM_64 = 0xcffaedfe
+FAT_MAGIC = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+
+LC_REQ_DYLD = 0x80000000
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_LOAD_WEAK_DYLIB = 0x18 | LC_REQ_DYLD
+LC_RPATH = 0x1c | LC_REQ_DYLD
+LC_REEXPORT_DYLIB = 0x1f | LC_REQ_DYLD
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_LOAD_UPWARD_DYLIB = 0x23 | LC_REQ_DYLD
+LC_SEGMENT = 0x1
+LC_SEGMENT_64 = 0x19
+
+S_ZEROFILL = 0x1
+S_GB_ZEROFILL = 0xc
+S_THREAD_LOCAL_ZEROFILL = 0x12
+
+DYLIB_COMMANDS = [LC_LOAD_DYLIB,
+                  LC_LOAD_WEAK_DYLIB,
+                  LC_REEXPORT_DYLIB,
+                  LC_LAZY_LOAD_DYLIB,
+                  LC_LOAD_UPWARD_DYLIB]
+
+CPU_TYPE_X86_64 = 0x01000007
+
+# fat header and java class files share the magic,
+# java class files have the version (>= 45) there
+MAX_FAT_ARCHS = 30
+
+
+class MachOError(Exception):
+    pass
+
+
+class LoadCommand:
+    def __init__(self, cmd, offset, size, name=None):
+        self.cmd = cmd
+        # offset of the load command in the file
+        self.offset = offset
+        self.size = size
+        # lc_str for dylib and rpath commands
+        self.name = name
+
+
+class MachOSlice:
+    def __init__(self, offset, is64, endian, cputype, filetype, sizeofcmds, commands, data_start):
+        # offset of the slice in the (fat) file
+        self.offset = offset
+        self.is64 = is64
+        self.endian = endian
+        self.cputype = cputype
+        self.filetype = filetype
+        self.sizeofcmds = sizeofcmds
+        self.commands = commands
+        # first byte of section data relative to the slice,
+        # load commands must fit before it
+        self.data_start = data_start
+
+    def header_size(self):
+        return 32 if self.is64 else 28
+
+    def id_dylib(self):
+        for c in self.commands:
+            if c.cmd == LC_ID_DYLIB:
+                return c.name
+        return None
+
+    def dylibs(self):
+        return [c.name for c in self.commands if c.cmd in DYLIB_COMMANDS]
+
+    def rpaths(self):
+        return [c.name for c in self.commands if c.cmd == LC_RPATH]
+
+
+def is_macho_header(data):
+    if len(data) < 8:
+        return False
+
+    magic = struct.unpack(">I", data[:4])[0]
+    if magic in [MH_MAGIC, MH_CIGAM, MH_MAGIC_64, MH_CIGAM_64]:
+        return True
+
+    if magic in [FAT_MAGIC, FAT_MAGIC_64]:
+        nfat_arch = struct.unpack(">I", data[4:8])[0]
+        return 0 < nfat_arch < MAX_FAT_ARCHS
+
+    return False
+
+
+def _read_lc_str(data, cmd_offset, str_offset, cmdsize):
+    start = cmd_offset + str_offset
+    end = cmd_offset + cmdsize
+    if str_offset >= cmdsize or end > len(data):
+        raise MachOError("Invalid lc_str in load command")
+    name = data[start:end]
+    return name.split(b"\0", 1)[0].decode("utf-8", errors="surrogateescape")
+
+
+def _sections_start(segment, endian, is64):
+    # smallest file offset of the non-zerofill sections in the segment
+    if is64:
+        nsects = struct.unpack(endian + "I", segment[64:68])[0]
+        pos, section_size, offset_pos = 72, 80, 48
+    else:
+        nsects = struct.unpack(endian + "I", segment[48:52])[0]
+        pos, section_size, offset_pos = 56, 68, 40
+
+    start = None
+    for i in range(nsects):
+        section = segment[pos:pos + section_size]
+        if len(section) < section_size:
+            raise MachOError("Truncated segment load command")
+        offset = struct.unpack(endian + "I", section[offset_pos:offset_pos + 4])[0]
+        flags = struct.unpack(endian + "I", section[offset_pos + 16:offset_pos + 20])[0]
+        if offset > 0 and (flags & 0xff) not in [S_ZEROFILL, S_GB_ZEROFILL, S_THREAD_LOCAL_ZEROFILL]:
+            if start is None or offset < start:
+                start = offset
+        pos += section_size
+    return start
+
+
+def _parse_slice(f, offset):
+    f.seek(offset)
+    header = f.read(32)
+    if len(header) < 28:
+        raise MachOError("Truncated Mach-O header")
+
+    magic = struct.unpack("<I", header[:4])[0]
+    if magic == MH_MAGIC:
+        endian, is64 = "<", False
+    elif magic == MH_MAGIC_64:
+        endian, is64 = "<", True
+    elif magic == MH_CIGAM:
+        endian, is64 = ">", False
+    elif magic == MH_CIGAM_64:
+        endian, is64 = ">", True
+    else:
+        raise MachOError("Not a Mach-O slice at offset {}".format(offset))
+
+    _, cputype, _, filetype, ncmds, sizeofcmds, _ = struct.unpack(endian + "7I", header[:28])
+    header_size = 32 if is64 else 28
+
+    f.seek(offset + header_size)
+    data = f.read(sizeofcmds)
+    if len(data) < sizeofcmds:
+        raise MachOError("Truncated Mach-O load commands")
+
+    commands = []
+    data_start = None
+    pos = 0
+    for i in range(ncmds):
+        if pos + 8 > sizeofcmds:
+            raise MachOError("Load command {} out of bounds".format(i))
+        cmd, cmdsize = struct.unpack(endian + "2I", data[pos:pos + 8])
+        if cmdsize < 8 or pos + cmdsize > sizeofcmds:
+            raise MachOError("Invalid size of load command {}".format(i))
+
+        name = None
+        if cmd in DYLIB_COMMANDS or cmd in [LC_ID_DYLIB, LC_RPATH]:
+            str_offset = struct.unpack(endian + "I", data[pos + 8:pos + 12])[0]
+            name = _read_lc_str(data, pos, str_offset, cmdsize)
+        elif cmd in [LC_SEGMENT, LC_SEGMENT_64]:
+            start = _sections_start(data[pos:pos + cmdsize], endian, cmd == LC_SEGMENT_64)
+            if start is not None and (data_start is None or start < data_start):
+                data_start = start
+
+        commands.append(LoadCommand(cmd, offset + header_size + pos, cmdsize, name))
+        pos += cmdsize
+
+    return MachOSlice(offset, is64, endian, cputype, filetype, sizeofcmds, commands, data_start)
+
+
+def _slice_offsets(f, path):
+    # offsets of the Mach-O slices, empty list for non Mach-O files
+    f.seek(0)
+    head = f.read(8)
+    if not is_macho_header(head):
+        return []
+
+    magic, nfat_arch = struct.unpack(">2I", head)
+    if magic == FAT_MAGIC or magic == FAT_MAGIC_64:
+        # fat_arch is 20 bytes, fat_arch_64 is 32 bytes, always big endian
+        arch_size = 32 if magic == FAT_MAGIC_64 else 20
+        archs = f.read(nfat_arch * arch_size)
+        if len(archs) < nfat_arch * arch_size:
+            raise MachOError("Truncated fat header " + path)
+        offsets = []
+        for i in range(nfat_arch):
+            arch = archs[i * arch_size:(i + 1) * arch_size]
+            if magic == FAT_MAGIC_64:
+                _, _, slice_offset = struct.unpack(">2IQ", arch[:16])
+            else:
+                _, _, slice_offset = struct.unpack(">3I", arch[:12])
+            offsets.append(slice_offset)
+        return offsets
+
+    return [0]
+
+
+def read_slices(path):
+    # returns list of MachOSlice, empty list for non Mach-O files
+    with open(path, "rb") as f:
+        return [_parse_slice(f, o) for o in _slice_offsets(f, path)]
+
+
+def load_commands_digest(path):
+    # hash of the headers and load commands of all slices, i.e. of everything
+    # the dependency analysis reads. None for non Mach-O files
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        offsets = _slice_offsets(f, path)
+        if not offsets:
+            return None
+        for offset in offsets:
+            f.seek(offset)
+            header = f.read(32)
+            if len(header) < 28:
+                raise MachOError("Truncated Mach-O header")
+            magic = struct.unpack("<I", header[:4])[0]
+            endian = "<" if magic in [MH_MAGIC, MH_MAGIC_64] else ">"
+            header_size = 32 if magic in [MH_MAGIC_64, MH_CIGAM_64] else 28
+            sizeofcmds = struct.unpack(endian + "I", header[20:24])[0]
+            f.seek(offset)
+            h.update(f.read(header_size + sizeofcmds))
+    return h.hexdigest()
+
+
+def main_slice(slices):
+    # slice to report for the fat binaries, same as otool on the build machine
+    if not slices:
+        return None
+    for s in slices:
+        if s.cputype == CPU_TYPE_X86_64:
+            return s
+    return slices[0]
+
+
+def _new_lc_str_command(data, endian, is64, name):
+    # same command with the lc_str replaced, keeps the fixed part (e.g. versions)
+    cmd, _, str_offset = struct.unpack(endian + "3I", data[:12])
+    encoded = name.encode("utf-8", errors="surrogateescape") + b"\0"
+    align = 8 if is64 else 4
+    cmdsize = (str_offset + len(encoded) + align - 1) // align * align
+    command = struct.pack(endian + "2I", cmd, cmdsize) + data[8:str_offset] + encoded
+    return command + b"\0" * (cmdsize - len(command))
+
+
+def _rewrite_slice(f, s, id_name, changes, delete_rpaths):
+    # returns (new load commands, ncmds) or None when no change is needed
+    f.seek(s.offset + s.header_size())
+    data = f.read(s.sizeofcmds)
+
+    modified = False
+    new_commands = []
+    for c in s.commands:
+        start = c.offset - s.offset - s.header_size()
+        command = data[start:start + c.size]
+        if c.cmd == LC_ID_DYLIB and id_name is not None and c.name != id_name:
+            command = _new_lc_str_command(command, s.endian, s.is64, id_name)
+            modified = True
+        elif c.cmd in DYLIB_COMMANDS and c.name in changes and c.name != changes[c.name]:
+            command = _new_lc_str_command(command, s.endian, s.is64, changes[c.name])
+            modified = True
+        elif c.cmd == LC_RPATH and c.name in delete_rpaths:
+            command = None
+            modified = True
+
+        if command is not None:
+            new_commands.append(command)
+
+    if not modified:
+        return None
+
+    new_data = b"".join(new_commands)
+    if s.data_start is None:
+        raise MachOError("Unable to find start of section data")
+    if s.header_size() + len(new_data) > s.data_start:
+        raise MachOError("Not enough header padding for new load commands, {} bytes required, {} available".format(
+            len(new_data), s.data_start - s.header_size()))
+    return new_data, len(new_commands)
+
+
+def rewrite_load_commands(path, id_name=None, changes=None, delete_rpaths=None):
+    # in place equivalent of install_name_tool -id -change -delete_rpath
+    # returns True if the file was modified
+    # raises MachOError when the file cannot be patched (e.g. small header padding)
+    changes = changes or {}
+    delete_rpaths = delete_rpaths or []
+
+    slices = read_slices(path)
+    if not slices:
+        raise MachOError("Not a Mach-O file " + path)
+
+    with open(path, "rb+") as f:
+        # first check all slices, so we do not end up with half-patched file
+        patches = []
+        for s in slices:
+            patch = _rewrite_slice(f, s, id_name, changes, delete_rpaths)
+            if patch:
+                patches.append((s, patch[0], patch[1]))
+
+        for s, new_data, ncmds in patches:
+            # zero the rest of the old commands
+            padding = max(0, s.sizeofcmds - len(new_data))
+            f.seek(s.offset + s.header_size())
+            f.write(new_data + b"\0" * padding)
+            # ncmds and sizeofcmds in mach_header
+            f.seek(s.offset + 16)
+            f.write(struct.pack(s.endian + "2I", ncmds, len(new_data)))
+
+    return len(patches) > 0
@@ -1,17 +1,30 @@
 # 2018 Peter Petrik (zilolv at gmail dot com)
 # GNU General Public License 2 any later version
 
-import subprocess
 import os
+from . import macho
+from . import utils
+
+# optional persistent cache of the analysis, see depcache.py
+_cache = None
+
+
+def set_cache(cache):
+    global _cache
+    _cache = cache
 
 
 class BinaryDependencies:
-    def __init__(self, libname, path, frameworks, sys_libs, libs):
+    def __init__(self, libname, path, frameworks, sys_libs, libs, rpaths=None, install_name=None):
         self.libname = libname
         self.path = path
         self.frameworks = frameworks
         self.sys_libs = sys_libs
         self.libs = libs
+        # LC_RPATH entries of the binary
+        self.rpaths = rpaths or []
+        # LC_ID_DYLIB of the library
+        self.install_name = install_name
 
     def __str__(self):
         msg = "BinaryDependency " + self.libname + " (" + self.path + ")"
@@ -21,17 +34,15 @@ class BinaryDependencies:
         msg += "\n\t".join(self.frameworks)
         msg += "\nSysLibs:\n\t"
         msg += "\n\t".join(self.sys_libs)
+        msg += "\nRPaths:\n\t"
+        msg += "\n\t".join(self.rpaths)
         return msg
 
 
 def is_omach_file(binary):
-    args = ["otool", "-L", binary]
-    try:
-        ret = subprocess.check_output(args, encoding='UTF-8')
-    except:
-        return False
-
-    return "is not an object file" not in ret
+    # just sniff the magic number, no need to run otool
+    # the classification is cached in utils for the whole run
+    return utils.classify_file(os.path.realpath(binary)) == utils.FILE_MACHO
 
 
 SYS_LIB = 1
@@ -69,27 +80,28 @@ def binary_type(lib_path):
     return lib_path, type
 
 
-def get_binary_dependencies(pa, binary):
-    args = ["otool", "-L", binary]
-    ret = subprocess.check_output(args, encoding='UTF-8')
-    otool_libs = ret.split("\n")
-    path = otool_libs.pop(0)[:-1] # first one is the library path
-    libname = os.path.basename(path)
+def load_command_names(binary):
+    # same list as otool -L prints: id of the library
+    # and all loaded/reexported libraries
+    s = macho.main_slice(macho.read_slices(binary))
+    if s is None:
+        return [], [], None
 
+    names = []
+    for c in s.commands:
+        if c.cmd == macho.LC_ID_DYLIB or c.cmd in macho.DYLIB_COMMANDS:
+            names.append(c.name)
+    return names, s.rpaths(), s.id_dylib()
+
+
+def _classify(lib_paths):
     frameworks = []
     sys_libs = []
     libs = []
     binaries = []
 
-    # also add library itself
-    for lib in otool_libs + [binary]:
-        # e.g.
-        # \t@executable_path/lib/libqgis_app.3.3.0.dylib (compatibility version 3.3.0, current version 3.3.0)
-        lib = lib.strip()
-        lib_parts = lib.split(" (")
-        lib_path = lib_parts[0]
-
-        lib_path, type = binary_type(lib_path)
+    for lib in lib_paths:
+        lib_path, type = binary_type(lib)
 
         if type is SYS_LIB:
             sys_libs.append(lib_path)
@@ -103,6 +115,67 @@ def get_binary_dependencies(pa, binary):
             raise Exception("Internal error: missing enum type " + type)
 
     # binaries must be copied manually to the destination
-    return BinaryDependencies(libname, path, frameworks, sys_libs, libs)
+    return frameworks, sys_libs, libs
+
+
+def _dependencies(binary):
+    # parsed load commands, the record stored in the cache
+    otool_libs, rpaths, install_name = load_command_names(binary)
+    frameworks, sys_libs, libs = _classify(otool_libs)
+    return {"frameworks": frameworks,
+            "sys_libs": sys_libs,
+            "libs": libs,
+            "rpaths": rpaths,
+            "install_name": install_name}
+
+
+def _binary_dependencies(binary, deps):
+    # also add library itself
+    frameworks, sys_libs, libs = _classify([binary])
+    return BinaryDependencies(os.path.basename(binary),
+                              binary,
+                              deps["frameworks"] + frameworks,
+                              deps["sys_libs"] + sys_libs,
+                              deps["libs"] + libs,
+                              deps["rpaths"],
+                              deps.get("install_name"))
+
+
+def parse_binary_dependencies(binary):
+    # same as get_binary_dependencies without the cache,
+    # safe to call in forked worker processes
+    return _binary_dependencies(binary, _dependencies(binary))
+
+
+def get_binary_dependencies(pa, binary):
+    # hash of the load commands only, much cheaper than the whole file
+    digest = macho.load_commands_digest(binary) if _cache else None
+    deps = _cache.get(digest) if digest else None
+    if deps is None:
+        deps = _dependencies(binary)
+        if digest:
+            _cache.put(digest, deps)
+    return _binary_dependencies(binary, deps)
+
+
+def get_binaries_dependencies(pa, binaries, executor):
+    # get_binary_dependencies for all binaries, the cache is used only
+    # in this process and the misses are parsed by the (forked) executor
+    records = {}
+    digests = {}
+    missing = []
+    for binary in binaries:
+        digest = macho.load_commands_digest(binary) if _cache else None
+        deps = _cache.get(digest) if digest else None
+        if deps is None:
+            digests[binary] = digest
+            missing.append(binary)
+        else:
+            records[binary] = deps
 
+    for binary, deps in zip(missing, executor.map(_dependencies, missing, chunksize=16)):
+        records[binary] = deps
+        if digests[binary]:
+            _cache.put(digests[binary], deps)
 
+    return [_binary_dependencies(binary, records[binary]) for binary in binaries]
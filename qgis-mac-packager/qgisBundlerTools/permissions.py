@@ -0,0 +1,106 @@
+# 2018 Peter Petrik (zilolv at gmail dot com)
+# GNU General Public License 2 any later version
+
+# Permissions of all files in the bundle, set in one pass over
+# the BundleIndex instead of many chmod -R processes:
+#  - everything is writable (chmod +w)
+#  - libraries, Mach-O binaries and files in executable
+#    directories are executable (chmod +x)
+# Only files with different mode are touched.
+
+import os
+import stat
+
+from . import utils
+from . import instrument
+
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def _is_script(entry):
+    if entry.classify() == utils.FILE_MACHO:
+        return True
+    try:
+        with open(entry.path, "rb") as f:
+            return f.read(2) == b"#!"
+    except (IOError, OSError):
+        return False
+
+
+class PermissionModel:
+    def __init__(self):
+        # same as chmod +w and chmod +x without who, umask is respected
+        mask = _umask()
+        self.write_bits = (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH) & ~mask
+        self.exec_bits = (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH) & ~mask
+        # realpath of directory -> (depth, scripts_only), depth None for the whole subtree
+        self.executable_dirs = {}
+        # same for the paths of the index being applied
+        self._dirs = {}
+
+    def add_executable_dir(self, path, depth=1, scripts_only=False):
+        # all files in path (and in its subdirectories up to depth) are executable,
+        # with scripts_only only Mach-O binaries and scripts with #!
+        self.executable_dirs[os.path.realpath(path)] = (depth, scripts_only)
+
+    def _index_dirs(self, index):
+        # index paths are not resolved below its root, so the
+        # directories are expressed relative to the same root
+        root = os.path.realpath(index.root)
+        dirs = {}
+        for d, rule in self.executable_dirs.items():
+            if d == root or d.startswith(root + "/"):
+                d = index.root + d[len(root):]
+            dirs[d] = rule
+        return dirs
+
+    def _in_executable_dir(self, entry):
+        d = os.path.dirname(entry.path)
+        level = 1
+        while len(d) > 1:
+            if d in self._dirs:
+                depth, scripts_only = self._dirs[d]
+                if depth is None or level <= depth:
+                    return not scripts_only or _is_script(entry)
+            d = os.path.dirname(d)
+            level += 1
+        return False
+
+    def is_executable(self, entry):
+        name = os.path.basename(entry.path)
+        if name.endswith((".dylib", ".so")):
+            return True
+        if self._in_executable_dir(entry):
+            return True
+        # e.g. framework binaries and app helpers, files with extension are not read
+        if "." not in name:
+            return entry.classify() == utils.FILE_MACHO
+        return False
+
+    def mode(self, entry, current):
+        # current is the mode of the file, without the file type bits
+        mode = current | self.write_bits
+        if not entry.is_dir and self.is_executable(entry):
+            mode |= self.exec_bits
+        return mode
+
+    def apply(self, index):
+        self._dirs = self._index_dirs(index)
+        checked = 0
+        changed = 0
+        for path, entry in sorted(index.entries.items()):
+            # links are not followed, their targets are in the index too
+            if entry.is_link:
+                continue
+            checked += 1
+            current = stat.S_IMODE(entry.mode)
+            mode = self.mode(entry, current)
+            if mode != current:
+                os.chmod(path, mode)
+                changed += 1
+        instrument.add_files(changed)
+        print("Permissions: checked {} files, changed {}".format(checked, changed))
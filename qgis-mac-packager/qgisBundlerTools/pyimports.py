@@ -0,0 +1,190 @@
+# 2018 Peter Petrik (zilolv at gmail dot com)
+# GNU General Public License 2 any later version
+
+# Static analysis of python imports, used to copy only the
+# site-packages which are reachable from QGIS python plugins
+# and processing providers
+
+import ast
+import os
+import re
+
+# packages loaded by QGIS from C++ or by string, not visible as imports
+DEFAULT_ALLOWLIST = ["PyQt5", "sip", "pkg_resources", "setuptools"]
+
+_IMPORT_RE = re.compile(r"^\s*(?:from\s+([\w.]+)\s+import|import\s+([\w., ]+))", re.MULTILINE)
+_DYNAMIC_IMPORT_RE = re.compile(r"(?:import_module|__import__)\(\s*['\"]([\w.]+)['\"]")
+
+
+def imported_modules(filename):
+    # top level names of all modules imported by the file
+    try:
+        with open(filename, "rb") as f:
+            source = f.read()
+    except (IOError, OSError):
+        return set()
+
+    names = set()
+    try:
+        tree = ast.parse(source, filename)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                for alias in node.names:
+                    names.add(alias.name.split(".")[0])
+            elif isinstance(node, ast.ImportFrom):
+                # relative imports are always inside the same package
+                if node.level == 0 and node.module:
+                    names.add(node.module.split(".")[0])
+    except (SyntaxError, ValueError):
+        # e.g. python2 scripts in GRASS
+        text = source.decode("utf-8", "replace")
+        for m in _IMPORT_RE.finditer(text):
+            if m.group(1):
+                names.add(m.group(1).split(".")[0])
+            else:
+                for name in m.group(2).split(","):
+                    name = name.strip().split(" ")[0]
+                    if name:
+                        names.add(name.split(".")[0])
+
+    text = source.decode("utf-8", "replace")
+    for m in _DYNAMIC_IMPORT_RE.finditer(text):
+        names.add(m.group(1).split(".")[0])
+    return names
+
+
+def python_files(path):
+    if os.path.isfile(path):
+        if path.endswith(".py"):
+            yield path
+        return
+    for root, dirs, files in os.walk(path, followlinks=True):
+        for name in files:
+            if name.endswith(".py"):
+                yield os.path.join(root, name)
+
+
+def _module_name(item):
+    # top level module name provided by the site-packages item, None for metadata
+    if item.endswith((".dist-info", ".egg-info", ".pth")) or item == "__pycache__":
+        return None
+    if item.endswith(".py"):
+        return item[:-3]
+    if item.endswith(".so"):
+        # e.g. _cffi_backend.cpython-37m-darwin.so
+        return item.split(".")[0]
+    return item
+
+
+def _metadata_modules(path):
+    # top level modules of the distribution
+    top_level = os.path.join(path, "top_level.txt")
+    if os.path.isfile(top_level):
+        with open(top_level, "r") as f:
+            return [l.strip() for l in f.read().splitlines() if l.strip()]
+    # e.g. GitPython-2.1.11.dist-info
+    name = os.path.basename(path).split("-")[0]
+    return [name, name.lower()]
+
+
+def _tree_size(path):
+    files = 0
+    size = 0
+    if os.path.isdir(path):
+        for root, dirs, filenames in os.walk(path, followlinks=True):
+            for name in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                    files += 1
+                except OSError:
+                    pass
+    elif os.path.exists(path):
+        files = 1
+        size = os.path.getsize(path)
+    return files, size
+
+
+class SitePackages:
+    def __init__(self, sourceDir):
+        # item name -> source path, in the same order and with the same
+        # precedence as append_recursively_site_packages would copy them
+        self.items = {}
+        # top level module -> item names
+        self.modules = {}
+        # item name -> top level modules of metadata (dist-info, egg-info)
+        self.metadata = {}
+        # item name -> why it is selected
+        self.reasons = {}
+        self._scan(sourceDir, set())
+
+        for item in self.items:
+            name = _module_name(item)
+            if name:
+                self.modules.setdefault(name, []).append(item)
+            elif item.endswith((".dist-info", ".egg-info")):
+                self.metadata[item] = _metadata_modules(self.items[item])
+
+    def _scan(self, sourceDir, visited):
+        sourceDir = os.path.realpath(sourceDir)
+        if sourceDir in visited:
+            return
+        visited.add(sourceDir)
+
+        for item in os.listdir(sourceDir):
+            if item in self.items:
+                continue
+            s = os.path.join(sourceDir, item)
+            if not os.path.isdir(s):
+                # pth files and links can get other site-packages
+                if os.path.islink(s):
+                    self._scan(os.path.dirname(os.path.realpath(s)), visited)
+                if s.endswith(".pth"):
+                    with open(s, 'r') as myfile:
+                        dirname = myfile.read().strip()
+                    if os.path.isdir(dirname):
+                        self._scan(dirname, visited)
+            if item not in self.items:
+                self.items[item] = s
+
+    def closure(self, roots, allowlist):
+        # item names reachable from python files in roots
+        queue = []
+        for name in allowlist:
+            queue.append((name, "allowlist"))
+        for root in roots:
+            for filename in python_files(root):
+                for name in imported_modules(filename):
+                    queue.append((name, filename))
+
+        selected = set()
+        while queue:
+            name, reason = queue.pop()
+            for item in self.modules.get(name, []):
+                if item in selected:
+                    continue
+                selected.add(item)
+                self.reasons[item] = reason
+                for filename in python_files(self.items[item]):
+                    for dep in imported_modules(filename):
+                        queue.append((dep, item))
+
+        # metadata of selected packages, pth files are small and always copied
+        names = set(_module_name(item) for item in selected)
+        for item in self.items:
+            if item.endswith(".pth"):
+                selected.add(item)
+                self.reasons[item] = "pth file"
+            elif item in self.metadata and names.intersection(self.metadata[item]):
+                selected.add(item)
+                self.reasons[item] = "metadata"
+        return selected
+
+    def size(self, items):
+        # (files, bytes) of the items
+        files = 0
+        size = 0
+        for item in items:
+            f, s = _tree_size(self.items[item])
+            files += f
+            size += s
+        return files, size
@@ -0,0 +1,140 @@
+# 2018 Peter Petrik (zilolv at gmail dot com)
+# GNU General Public License 2 any later version
+
+# Plan of all install name changes in the bundle.
+# The plan is computed first for all frameworks, libraries
+# and executables, so it can be reviewed (--plan_only) and
+# then applied in parallel.
+
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from . import instrument
+from . import macho
+from . import install_name_tool
+from . import otool
+
+
+class RelinkPlan:
+    def __init__(self, contentsPath, relLibPathToExe, relLibPathToFramework):
+        self.contentsPath = contentsPath
+        self.relLibPathToExe = relLibPathToExe
+        self.relLibPathToFramework = relLibPathToFramework
+        # realpath of binary -> edits
+        self.entries = {}
+        # realpath of binary -> seconds to apply
+        self.timings = {}
+
+    def add(self, binary, depLibs):
+        binary = os.path.realpath(binary)
+        if binary in self.entries:
+            return
+
+        entry = _plan_entry(binary, depLibs, self.contentsPath, self.relLibPathToExe, self.relLibPathToFramework)
+        if entry:
+            self.entries[binary] = entry
+
+    def add_all(self, binaries, jobs):
+        # same as add for all binaries, the load commands are parsed in forked
+        # worker processes and the entries are added here in order of binaries
+        items = []
+        for binary in binaries:
+            binary = os.path.realpath(binary)
+            if binary not in self.entries:
+                items.append((binary, self.contentsPath, self.relLibPathToExe, self.relLibPathToFramework))
+
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+            for binary, entry in executor.map(_plan_binary, items, chunksize=16):
+                if entry and binary not in self.entries:
+                    self.entries[binary] = entry
+
+    def to_dict(self):
+        return {"contentsPath": self.contentsPath,
+                "relLibPathToExe": self.relLibPathToExe,
+                "relLibPathToFramework": self.relLibPathToFramework,
+                "entries": self.entries,
+                "timings": self.timings}
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=1, sort_keys=True)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "r") as f:
+            data = json.load(f)
+        plan = cls(data["contentsPath"], data["relLibPathToExe"], data["relLibPathToFramework"])
+        plan.entries = data["entries"]
+        plan.timings = data.get("timings", {})
+        return plan
+
+    def summary(self):
+        changes = sum(len(e.get("changes", {})) for e in self.entries.values())
+        ids = sum(1 for e in self.entries.values() if "id" in e)
+        rpaths = sum(len(e.get("delete_rpaths", [])) for e in self.entries.values())
+        return "Relink plan: {} binaries, {} ids, {} changes, {} deleted rpaths".format(
+            len(self.entries), ids, changes, rpaths)
+
+    def apply(self, jobs):
+        # fork, the bundler script is not importable by spawned workers
+        context = multiprocessing.get_context("fork")
+        start = time.time()
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+            for binary, seconds in executor.map(_apply_entry, sorted(self.entries.items())):
+                self.timings[binary] = seconds
+        instrument.add_files(len(self.entries))
+        print("Applied relink plan to {} binaries in {:.1f} s".format(len(self.entries), time.time() - start))
+
+        slowest = sorted(self.timings.items(), key=lambda t: t[1], reverse=True)[:10]
+        for binary, seconds in slowest:
+            print("  {:.3f} s {}".format(seconds, binary))
+
+
+def _plan_entry(binary, depLibs, contentsPath, relLibPathToExe, relLibPathToFramework):
+    slices = macho.read_slices(binary)
+    if not slices:
+        # e.g. Python.framework/Versions/Current/bin/idle3 is a script
+        return None
+
+    id_name, changes, delete_rpaths = install_name_tool.lib_edits(binary,
+                                                                  depLibs,
+                                                                  contentsPath,
+                                                                  relLibPathToExe,
+                                                                  relLibPathToFramework)
+
+    # keep only the edits which really change the binary,
+    # so the plan is readable
+    entry = {}
+    for s in slices:
+        if s.id_dylib() is not None and s.id_dylib() != id_name:
+            entry["id"] = id_name
+        for lib in s.dylibs():
+            if lib in changes and changes[lib] != lib:
+                entry.setdefault("changes", {})[lib] = changes[lib]
+        for rpath in s.rpaths():
+            if rpath in delete_rpaths:
+                entry.setdefault("delete_rpaths", [])
+                if rpath not in entry["delete_rpaths"]:
+                    entry["delete_rpaths"].append(rpath)
+    return entry
+
+
+def _plan_binary(item):
+    # runs in worker process, the dependency cache is not used there
+    binary, contentsPath, relLibPathToExe, relLibPathToFramework = item
+    depLibs = otool.parse_binary_dependencies(binary)
+    return binary, _plan_entry(binary, depLibs, contentsPath, relLibPathToExe, relLibPathToFramework)
+
+
+def _apply_entry(item):
+    binary, entry = item
+    start = time.time()
+    install_name_tool.apply_edits(binary,
+                                  entry.get("id"),
+                                  entry.get("changes", {}),
+                                  entry.get("delete_rpaths", []))
+    return binary, time.time() - start
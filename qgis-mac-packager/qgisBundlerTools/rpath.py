@@ -0,0 +1,60 @@
+# 2018 Peter Petrik (zilolv at gmail dot com)
+# GNU General Public License 2 any later version
+
+# Resolve @rpath the way dyld does: search LC_RPATH entries of the loading
+# binary, then of the binaries that loaded it, up to the main executable.
+# The main executable (and the python interpreter) are always searched,
+# e.g. plugins and python modules rely on their rpaths.
+# https://developer.apple.com/library/archive/documentation/DeveloperTools/Conceptual/DynamicLibraries/100-Articles/RunpathDependentLibraries.html
+
+import itertools
+import os
+
+
+class RPathResolver:
+    def __init__(self, executable_path, executables=None):
+        self.executable_path = executable_path
+        # binaries whose LC_RPATH apply to all libraries, in order of search
+        self.executables = executables or []
+        # binary -> list of LC_RPATH entries
+        self.rpaths = {}
+        # (loader, rpath) -> expanded directory
+        self._dirs = {}
+        # (directory, name) -> library exists, directories are shared by many loaders
+        self._exists = {}
+
+    def add_binary(self, binary, rpaths):
+        self.rpaths[binary] = rpaths
+
+    def expand(self, loader, rpath):
+        key = (loader, rpath)
+        if key not in self._dirs:
+            d = rpath
+            if d.startswith("@loader_path"):
+                d = d.replace("@loader_path", os.path.realpath(os.path.dirname(loader)), 1)
+            elif d.startswith("@executable_path"):
+                d = d.replace("@executable_path", self.executable_path, 1)
+            self._dirs[key] = os.path.normpath(d)
+        return self._dirs[key]
+
+    def resolve(self, loaders, lib):
+        # loaders is iterable of the binaries to search, the loader of the lib first,
+        # the executables are searched after them. Returns resolved path or None
+        # if lib cannot be found in their rpaths
+        if not lib.startswith("@rpath/"):
+            return None
+
+        name = lib[len("@rpath/"):]
+        searched = set()
+        for current in itertools.chain(loaders, self.executables):
+            if current in searched:
+                continue
+            searched.add(current)
+            for rpath in self.rpaths.get(current, []):
+                directory = self.expand(current, rpath)
+                key = (directory, name)
+                if key not in self._exists:
+                    self._exists[key] = os.path.exists(os.path.join(directory, name))
+                if self._exists[key]:
+                    return os.path.join(directory, name)
+        return None
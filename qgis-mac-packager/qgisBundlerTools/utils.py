@@ -1,16 +1,54 @@
 # 2018 Peter Petrik (zilolv at gmail dot com)
 # GNU General Public License 2 any later version
 
+import glob
+import hashlib
 import os
 import shutil
-import subprocess
+import stat
+
+from . import instrument
+from . import macho
+
+
+class QGISBundlerError(Exception):
+    pass
+
+
+def file_digest(path):
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# (path, inode, size, mtime) -> digest, valid for the whole run
+_digests = {}
+
+
+def cached_file_digest(path):
+    st = os.stat(path)
+    key = (path, st.st_ino, st.st_size, st.st_mtime_ns)
+    if key not in _digests:
+        _digests[key] = file_digest(path)
+    return _digests[key]
+
 
 def files_differ(file1, file2):
     try:
-        subprocess.check_output(["diff", file1, file2], stderr=subprocess.STDOUT, encoding='UTF-8')
-    except subprocess.CalledProcessError as err:
+        st1 = os.stat(file1)
+        st2 = os.stat(file2)
+    except OSError:
+        return True
+
+    if os.path.samestat(st1, st2):
+        return False
+
+    if st1.st_size != st2.st_size:
         return True
-    return False
+
+    return cached_file_digest(file1) != cached_file_digest(file2)
 
 
 def framework_name(framework):
@@ -30,64 +68,184 @@ def framework_name(framework):
     return frameworkName, path
 
 
+FILE_OTHER = 0
+FILE_SYMLINK = 1
+FILE_MACHO = 2
+FILE_TEXT = 3
+FILE_BINARY = 4
+
+# how many bytes we read to classify the file
+SNIFF_SIZE = 8192
+
+# control characters allowed in text files
+_TEXT_CONTROL_CHARS = set(b"\t\n\r\f\b\x1b")
+
+# (path, inode, size, mtime) -> FILE_* type, shared by all steps for the whole run
+_file_classes = {}
+
+
+def _classify_bytes(data):
+    if not data:
+        # same as file --mime, empty files are inode/x-empty; charset=binary
+        return FILE_BINARY
+
+    if macho.is_macho_header(data[:8]):
+        return FILE_MACHO
+
+    # UTF-16/32 with BOM
+    if data.startswith(b"\xff\xfe") or data.startswith(b"\xfe\xff"):
+        return FILE_TEXT
+
+    if b"\0" in data:
+        return FILE_BINARY
+
+    try:
+        data.decode("utf-8")
+        return FILE_TEXT
+    except UnicodeDecodeError as err:
+        # multibyte character cut at the end of the prefix
+        if err.start >= len(data) - 3 and len(data) == SNIFF_SIZE:
+            return FILE_TEXT
+
+    # ISO-8859 and other 8-bit text
+    for c in data:
+        if c < 0x20 and c not in _TEXT_CONTROL_CHARS:
+            return FILE_BINARY
+    return FILE_TEXT
+
+
+def classify_file(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return FILE_OTHER
+
+    key = (path, st.st_ino, st.st_size, st.st_mtime_ns)
+    if key not in _file_classes:
+        if stat.S_ISLNK(st.st_mode):
+            _file_classes[key] = FILE_SYMLINK
+        elif not stat.S_ISREG(st.st_mode):
+            _file_classes[key] = FILE_OTHER
+        else:
+            try:
+                with open(path, "rb") as f:
+                    _file_classes[key] = _classify_bytes(f.read(SNIFF_SIZE))
+            except (IOError, OSError):
+                _file_classes[key] = FILE_OTHER
+    return _file_classes[key]
+
+
 def is_text(fn):
-    msg = subprocess.Popen(["file", "--mime", fn],
-                           stdout=subprocess.PIPE,
-                           encoding='UTF-8',
-                           errors='replace').communicate()[0]
-    # returns something like
-    # <path>/libdelimitedtextprovider.so: application/x-mach-binary; charset=binary
-    msg = msg.replace(fn, "")
-    return "text" in msg
+    # symlinks are not followed, same as file --mime
+    return classify_file(fn) == FILE_TEXT
+
+
+def library_search_roots(pa):
+    # in order of priority
+    roots = [pa.frameworksDir,
+             pa.contentsDir,
+             "/usr/local/lib",
+             # e.g. opencv@2 and icu4c are not in /usr/local/lib
+             "/usr/local/opt/opencv@2/lib",
+             "/usr/local/opt/icu4c/lib"]
+    # workarounds. Some python packages have bundled their libraries
+    # but the libraries are in different version than the libraries
+    # from brew packages
+    roots += [pa.pysitepackages]
+    # keg-only brew packages last, e.g. zlib must not win over .dylibs of a wheel
+    roots += sorted(glob.glob("/usr/local/opt/*/lib"))
+    return roots
 
 
-def resolve_libpath(pa, lib_path):
+def _is_library_name(dirpath, name):
+    if ".dylib" in name or name.endswith(".so"):
+        return True
+    # only the framework binary, e.g. QtCore.framework/Versions/5/QtCore,
+    # not the headers and resources
+    pos = dirpath.rfind(".framework")
+    if pos == -1:
+        return False
+    return os.path.basename(dirpath[:pos]) == name
+
+
+class LibraryIndex:
+    # basename -> paths of all libraries in search roots,
+    # built on first lookup and then kept for the whole run
+    def __init__(self, roots):
+        self.roots = []
+        for root in roots:
+            if root not in self.roots:
+                self.roots.append(root)
+        self.ambiguous = {}
+        self._index = None
+
+    def _build(self):
+        self._index = {}
+        for priority, root in enumerate(self.roots):
+            if not os.path.isdir(root):
+                continue
+            for dirpath, dirnames, filenames in os.walk(root):
+                for name in filenames:
+                    if _is_library_name(dirpath, name):
+                        self._index.setdefault(name, []).append((priority, os.path.join(dirpath, name)))
+        print("Indexed {} library names in {} search roots".format(len(self._index), len(self.roots)))
+
+    def lookup(self, relpath):
+        # relpath is e.g. ../../Frameworks/QtCore.framework/QtCore or .dylibs/libz.1.dylib
+        if self._index is None:
+            self._build()
+
+        # only the part after the last .. is relevant for the search
+        parts = relpath.split("/")
+        last = max([i for i, part in enumerate(parts) if part in ["..", "."]] or [-1])
+        parts = [p for p in parts[last + 1:] if p and p != ".dylibs"]
+        if not parts:
+            return None
+        suffix = "/" + "/".join(parts)
+
+        candidates = [c for c in self._index.get(parts[-1], []) if c[1].endswith(suffix)]
+        if not candidates:
+            return None
+
+        # first in the order of search roots, other candidates of the same library
+        # (e.g. /usr/local/lib link to the keg) are not ambiguous
+        matches = []
+        realpaths = set()
+        for priority, path in sorted(candidates):
+            realpath = os.path.realpath(path)
+            if realpath not in realpaths:
+                realpaths.add(realpath)
+                matches.append(path)
+        if len(matches) > 1:
+            self.ambiguous[relpath] = matches
+        return matches[0]
+
+    def report(self):
+        for relpath, matches in sorted(self.ambiguous.items()):
+            print("WARNING: ambiguous library " + relpath + ", used first of\n\t" + "\n\t".join(matches))
+
+
+def resolve_libpath(pa, lib_path, loader=None, index=None):
     # loader path should be really resolved here, because
     # it is relative to this binary
-    if "@loader_path" in lib_path:
-        if os.path.exists(lib_path.replace("@loader_path/../../../MacOS/../Frameworks", pa.frameworksDir)):
-            lib_path = lib_path.replace("@loader_path/../../../MacOS/../Frameworks", pa.frameworksDir)
-        elif os.path.exists(lib_path.replace("@loader_path/../../MacOS/../Frameworks", pa.frameworksDir)):
-            lib_path = lib_path.replace("@loader_path/../../MacOS/../Frameworks", pa.frameworksDir)
-        elif os.path.exists(lib_path.replace("@loader_path/../../../MacOS/..", pa.contentsDir)):
-            lib_path = lib_path.replace("@loader_path/../../../MacOS/..", pa.contentsDir)
-        elif os.path.exists(lib_path.replace("@loader_path/../../..", pa.frameworksDir)):
-            lib_path = lib_path.replace("@loader_path/../../..", pa.frameworksDir)
-        elif os.path.exists(lib_path.replace("@loader_path/../..", pa.contentsDir)):
-            lib_path = lib_path.replace("@loader_path/../..", pa.contentsDir)
-        elif os.path.exists("/usr/local/lib" + lib_path.replace("@loader_path/.dylibs", "")):
-            lib_path = "/usr/local/lib" + lib_path.replace("@loader_path/.dylibs", "")
-        elif os.path.exists("/usr/local/lib" + lib_path.replace("@loader_path/../.dylibs", "")):
-            lib_path = "/usr/local/lib" + lib_path.replace("@loader_path/../.dylibs", "")
-        elif os.path.exists("/usr/local" + lib_path.replace("@loader_path", "")):
-            lib_path = "/usr/local" + lib_path.replace("@loader_path", "")
-        elif os.path.exists("/usr/local/lib" + lib_path.replace("@loader_path", "")):
-            lib_path = "/usr/local/lib" + lib_path.replace("@loader_path", "")
-        elif os.path.exists("/usr/local/opt/opencv@2/lib" + lib_path.replace("@loader_path", "")):
-            # opencv@2 is not in /usr/local/lib
-            lib_path = "/usr/local/opt/opencv@2/lib" + lib_path.replace("@loader_path", "")
-        elif os.path.exists("/usr/local/opt/icu4c/lib/" + lib_path.replace("@loader_path", "")):
-            # icu4c is not in /usr/local/lib
-            lib_path = "/usr/local/opt/icu4c/lib/" + lib_path.replace("@loader_path", "")
-        else:
-            # workarounds. Some python packages have bundled their libraries
-            # but the libraries are in different version than the libraries
-            # from brew packages
-            for item in os.listdir(pa.pysitepackages):
-                s = os.path.join(pa.pysitepackages, item)
-                if os.path.isdir(s):
-                    if os.path.exists(s + "/" + lib_path.replace("@loader_path", "")):
-                        lib_path = s + "/" + lib_path.replace("@loader_path", "")
-                        break
-                    if os.path.exists(s + "/.dylibs/" + lib_path.replace("@loader_path", "")):
-                        lib_path = s + "/.dylibs/" + lib_path.replace("@loader_path", "")
-                        break
-                    if os.path.exists(s + "/" + lib_path.replace("@loader_path/..", "")):
-                        lib_path = s + "/" + lib_path.replace("@loader_path/..", "")
-                        break
-                    if os.path.exists(s + "/.dylibs/" + lib_path.replace("@loader_path/..", "")):
-                        lib_path = s + "/.dylibs/" + lib_path.replace("@loader_path/..", "")
-                        break
+    if "@loader_path" not in lib_path:
+        return lib_path
+
+    relpath = lib_path.split("@loader_path", 1)[1].lstrip("/")
+    if loader:
+        candidate = os.path.join(os.path.realpath(os.path.dirname(loader)), relpath)
+        if os.path.exists(candidate):
+            normalized = os.path.normpath(candidate)
+            if os.path.exists(normalized) and os.path.samefile(normalized, candidate):
+                return normalized
+            return candidate
+
+    # the index is shared for the whole analysis, building it walks all search roots
+    if index is None:
+        raise Exception("Missing library index to resolve " + lib_path)
+    found = index.lookup(relpath)
+    if found:
+        return found
     return lib_path
 
 
@@ -99,6 +257,10 @@ class CopyUtils:
     def __init__(self, outdir, verbose=True):
         self.outdir = outdir
         self.verbose = verbose
+        # optional BundleIndex kept up to date with all operations
+        self.index = None
+        # optional IncrementalSync, records all copied files
+        self.sync = None
 
     def _is_in_out_dir(self, name):
         if self.outdir not in name:
@@ -106,6 +268,14 @@ class CopyUtils:
             if self.outdir not in realpath:
                 raise Exception("Trying to do file operation outside bundle directory! " + name)
 
+    def _indexed(self, name):
+        if self.index:
+            self.index.add(name)
+
+    def _unindexed(self, name):
+        if self.index:
+            self.index.remove(name)
+
     def recreate_dir(self, name):
         if os.path.exists(name):
             self.rmtree(name)
@@ -113,19 +283,33 @@ class CopyUtils:
                 self.remove(name + "/.DS_Store")
         else:
             os.makedirs(name)
+            self._indexed(name)
+
+    def makedirs(self, name):
+        self._is_in_out_dir(name)
+        os.makedirs(name)
+        self._indexed(name)
+        instrument.add_files()
 
     def rename(self, src, dest):
         self._is_in_out_dir(src)
         self._is_in_out_dir(dest)
         os.rename(src, dest)
+        self._unindexed(src)
+        self._indexed(dest)
+        instrument.add_files()
 
     def remove(self, name):
         self._is_in_out_dir(name)
         os.remove(name)
+        self._unindexed(name)
+        instrument.add_files()
 
     def rmtree(self, name):
         self._is_in_out_dir(name)
         shutil.rmtree(name)
+        self._unindexed(name)
+        instrument.add_files()
 
     def symlink(self, src, dest):
         self._is_in_out_dir(dest)
@@ -133,26 +317,146 @@ class CopyUtils:
             self._is_in_out_dir(src)
         else:
             self._is_in_out_dir(os.path.dirname(dest) + "/" + src)
+        if self.sync and self.sync.incremental and os.path.lexists(dest):
+            # link from the previous run
+            if os.path.islink(dest) and os.readlink(dest) == src:
+                return
+            self.rm(dest)
         try:
             os.symlink(src, dest)
         except:
             print( dest + " -> " + src)
             raise
+        self._indexed(dest)
+        instrument.add_files()
 
     def unlink(self, name):
         self._is_in_out_dir(name)
         os.unlink(name)
+        self._unindexed(name)
+        instrument.add_files()
+
+    def _remove_existing(self, dest):
+        if os.path.islink(dest) or not os.path.isdir(dest):
+            self.unlink(dest)
+        else:
+            self.rmtree(dest)
+
+    def _sync_file(self, src, dest, follow_symlinks=True):
+        link_target = None
+        if not follow_symlinks and os.path.islink(src):
+            link_target = os.readlink(src)
+        signature = self.sync.source_signature(src, link_target)
+
+        copied = self.sync.needs_copy(dest, signature)
+        if copied:
+            if self.sync.incremental and os.path.lexists(dest):
+                self._remove_existing(dest)
+            if link_target is not None:
+                os.symlink(link_target, dest)
+            else:
+                shutil.copy2(src, dest)
+                instrument.add_bytes(signature["size"])
+            self._indexed(dest)
+            instrument.add_files()
+        self.sync.produced(dest, signature, copied)
+
+    def _sync_tree(self, src, dest, symlinks):
+        if os.path.lexists(dest) and (os.path.islink(dest) or not os.path.isdir(dest)):
+            self._remove_existing(dest)
+        created = not os.path.exists(dest)
+        if created:
+            os.makedirs(dest)
+            self._indexed(dest)
+
+        items = sorted(os.listdir(src))
+        for item in items:
+            s = os.path.join(src, item)
+            d = os.path.join(dest, item)
+            if os.path.islink(s) and symlinks:
+                self._sync_file(s, d, follow_symlinks=False)
+            elif os.path.isdir(s):
+                self._sync_tree(s, d, symlinks)
+            else:
+                self._sync_file(s, d)
+
+        if created and items and not os.listdir(dest):
+            # all files were removed by some step last time (e.g. zipped python packages)
+            os.rmdir(dest)
+            self._unindexed(dest)
+            return
+        shutil.copystat(src, dest)
+        self.sync.produced_tree(dest)
 
     def copy(self, src, dest):
         self._is_in_out_dir(dest)
-        shutil.copy2(src, dest)
+        if self.sync:
+            if os.path.isdir(dest):
+                dest = os.path.join(dest, os.path.basename(src))
+            self._sync_file(src, dest)
+            return
+        new_file = shutil.copy2(src, dest)
+        self._indexed(new_file)
+        instrument.add_bytes(os.path.getsize(new_file))
+        instrument.add_files()
 
     def copytree(self, src, dest, symlinks):
         self._is_in_out_dir(dest)
+        if self.sync:
+            if not self.sync.incremental and os.path.exists(dest):
+                # same as shutil.copytree
+                raise FileExistsError(dest)
+            self._sync_tree(src, dest, symlinks)
+            return
         shutil.copytree(src, dest, symlinks=symlinks)
+        self._indexed(dest)
+
+    def copy_library(self, src, target_dir):
+        # copy library with its chain of symlinks, e.g.
+        # libfoo.dylib -> libfoo.1.dylib -> libfoo.1.0.0.dylib
+        # the real file is copied once and the links are recreated in target_dir
+        chain = [src]
+        while os.path.islink(chain[-1]):
+            target = os.path.normpath(os.path.join(os.path.dirname(chain[-1]), os.readlink(chain[-1])))
+            if target in chain:
+                raise QGISBundlerError("Symlink loop " + src)
+            chain.append(target)
+
+        real = chain[-1]
+        dest = os.path.join(target_dir, os.path.basename(real))
+        # in incremental mode files left from the previous run are just replaced
+        if self.exists(dest):
+            if files_differ(real, dest):
+                raise QGISBundlerError("Library " + dest + " already exists and differs from " + real)
+        else:
+            self.copy(real, dest)
+
+        for link, target in zip(chain[:-1], chain[1:]):
+            name = os.path.basename(link)
+            to = os.path.basename(target)
+            if name == to:
+                # e.g. /usr/local/lib/libfoo.1.dylib -> ../Cellar/foo/1.0/lib/libfoo.1.dylib
+                continue
+            linkDest = os.path.join(target_dir, name)
+            if os.path.islink(linkDest) and os.readlink(linkDest) == to:
+                continue
+            if os.path.lexists(linkDest):
+                if self.exists(linkDest) and files_differ(linkDest, dest):
+                    raise QGISBundlerError("Library " + linkDest + " already exists and differs from " + real)
+                # same library copied before as a file or left from the previous run
+                self.rm(linkDest)
+            self.symlink(to, linkDest)
+        return dest
+
+    def exists(self, name):
+        # in incremental mode files left from the previous run do not count
+        if self.sync and self.sync.incremental:
+            return self.sync.is_produced(name)
+        return os.path.exists(name)
 
     def rm(self, src):
-        if os.path.exists(src):
+        # dangling links are removed too
+        if os.path.lexists(src):
             self._is_in_out_dir(src)
             if os.path.islink(src):
                 self.unlink(src)
@@ -160,4 +464,3 @@ class CopyUtils:
                 self.remove(src)
             else:
                 self.rmtree(src)
-
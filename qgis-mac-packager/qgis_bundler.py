@@ -5,9 +5,18 @@ import argparse
 import glob
 import os
 
+import qgisBundlerTools.binpatch as binpatch
+import qgisBundlerTools.instrument as instrument
 import qgisBundlerTools.otool as otool
-import qgisBundlerTools.install_name_tool as install_name_tool
+import qgisBundlerTools.pyimports as pyimports
 import qgisBundlerTools.utils as utils
+from qgisBundlerTools.depcache import DependencyCache
+from qgisBundlerTools.relink import RelinkPlan
+from qgisBundlerTools.bundleindex import BundleIndex
+from qgisBundlerTools.incremental import IncrementalSync
+from qgisBundlerTools.checkpoint import BundlerState
+from qgisBundlerTools.graph import DependencyGraph
+from qgisBundlerTools.permissions import PermissionModel
 from steps import *
 from get_computer_info import *
 
@@ -36,10 +45,17 @@ parser.add_argument('--grass7',
                     help='grass7 installation directory')
 parser.add_argument('--rpath_hint',
                     required=False,
-                    default="")
-parser.add_argument('--start_step',
+                    default="",
+                    help='fallback directory for @rpath libraries not found in LC_RPATH of the loaders')
+parser.add_argument('--resume_from', '--resume-from', '--start_step',
+                    dest='resume_from',
                     required=False,
-                    default=0)
+                    default="copy",
+                    help='name of the step to resume from in existing output directory, e.g. patch_files, or its number 0-11 before the steps got names')
+parser.add_argument('--only',
+                    required=False,
+                    default=None,
+                    help='run only this step (name or number 0-11 as for --resume_from) in existing output directory')
 parser.add_argument('--min_os',
                     required=False,
                     default=None,
@@ -50,10 +66,74 @@ parser.add_argument('--qgisapp_name',
 parser.add_argument('--proj_datumgrids',
                     required=True,
                     help='proj-datumgrids shared data directory')
+parser.add_argument('--cache_file',
+                    required=False,
+                    default=None,
+                    help='sqlite file with cached dependency analysis, default is bundler_cache.sqlite next to output directory')
+parser.add_argument('--cache_max_entries',
+                    required=False,
+                    type=int,
+                    default=100000,
+                    help='maximum number of binaries kept in dependency cache')
+parser.add_argument('--jobs',
+                    required=False,
+                    type=int,
+                    default=os.cpu_count(),
+                    help='number of parallel workers')
+parser.add_argument('--debug_lib',
+                    required=False,
+                    default=None,
+                    help='print why libraries with this name are bundled, e.g. libopencv_calib3d')
+parser.add_argument('--plan_only',
+                    action='store_true',
+                    help='only write relink_plan.json with install name changes, do not apply them')
+parser.add_argument('--incremental',
+                    action='store_true',
+                    help='do not remove output directory, copy only files changed since last run')
+parser.add_argument('--selective_site_packages',
+                    action='store_true',
+                    help='copy only python site-packages imported by QGIS python plugins, GRASS and GDAL scripts')
+parser.add_argument('--site_packages_allowlist',
+                    required=False,
+                    default="",
+                    help='comma separated python packages always copied with --selective_site_packages, e.g. numpy,requests')
+parser.add_argument('--prune',
+                    required=False,
+                    choices=["report", "remove"],
+                    default="report",
+                    help='report or remove libraries not loaded by executables, plugins or python modules')
+parser.add_argument('--prune_allowlist',
+                    required=False,
+                    default="",
+                    help='comma separated names of libraries loaded by dlopen (e.g. libproj), never pruned')
+parser.add_argument('--precompile',
+                    action='store_true',
+                    help='compile all bundled python files to .pyc (checked-hash), so the first start is faster')
+parser.add_argument('--pyc_optimize',
+                    required=False,
+                    type=int,
+                    choices=[0, 1, 2],
+                    default=0,
+                    help='optimization level of precompiled .pyc files')
+parser.add_argument('--zip_stdlib',
+                    action='store_true',
+                    help='pack pure python standard library to python37.zip, extension modules stay on disk')
+parser.add_argument('--zip_site_packages',
+                    required=False,
+                    default="",
+                    help='comma separated pure python packages (no extension modules or data files) from Resources/python to add to python37.zip with --zip_stdlib')
+parser.add_argument('--report_file',
+                    required=False,
+                    default=None,
+                    help='JSON report with timings, copied bytes and spawned processes of steps, default is bundler_report.json in output directory')
+parser.add_argument('--no_cache',
+                    action='store_true',
+                    help='do not use persistent dependency cache')
 
 verbose = False
 
 args = parser.parse_args()
+instrument.install()
 
 print("QGIS INSTALL TREE: " + args.qgis_install_tree)
 print("OUTPUT DIRECTORY: " + args.output_directory)
@@ -163,701 +243,885 @@ class Paths:
 cp = utils.CopyUtils(os.path.realpath(args.output_directory))
 pa = Paths(args)
 
-print(100*"*")
-print("STEP 0: Copy QGIS and independent folders to build folder")
-print(100*"*")
-
-print ("Cleaning: " + args.output_directory)
-if os.path.exists(args.output_directory):
-    cp.rmtree(args.output_directory)
-    if os.path.exists(args.output_directory + "/.DS_Store"):
-        cp.remove(args.output_directory + "/.DS_Store")
-
-print("Copying " + args.qgis_install_tree)
-cp.copytree(args.qgis_install_tree, args.output_directory, symlinks=True)
-if args.qgisapp_name != "QGIS.app":
-    cp.rename(os.path.join(args.output_directory, "QGIS.app"), pa.qgisApp)
-
-if not os.path.exists(pa.qgisApp):
-    raise QGISBundlerError(pa.qgisExe + " does not exists")
-
-if not os.path.exists(pa.binDir):
-    os.makedirs(pa.binDir)
-
-print("Remove crssync")
-if os.path.exists(pa.libDir + "/qgis/crssync"):
-    cp.rmtree(pa.libDir + "/qgis")
-
-# https://doc.qt.io/qt-5/sql-driver.html#supported-databases
-print("Copying QT SQL Drivers")
-if not os.path.exists(pa.sqlDriversDir):
-    os.makedirs(pa.sqlDriversDir)
-for item in [pa.mysqlDriverHost, pa.psqlDriverHost, pa.odbcDriverHost]:
-    if not os.path.exists(item):
-        raise QGISBundlerError("Unable to find QT driver " + item)
-    cp.copy(item, pa.sqlDriversDir)
-
-print("Copying GDAL" + pa.gdalHost)
-for item in os.listdir(pa.gdalHost + "/bin"):
-    cp.copy(pa.gdalHost + "/bin/" + item, pa.binDir)
-cp.copytree(pa.gdalHost + "/share/gdal", pa.gdalDataDir, symlinks=False)
-cp.copytree(pa.gdalPluginsHost, pa.gdalPluginsDir, symlinks=False)
-subprocess.call(['chmod', '-R', '+w', pa.gdalDataDir])
-
-# normally this should be on MacOS/bin/ so logic in GdalUtils.py works,
-# but .py file in MacOS/bin halts the signing of the bundle
-print("Copying GDAL-PYTHON" + pa.gdalPythonHost)
-if not os.path.exists(pa.gdalDataDir + "/bin"):
-    os.makedirs(pa.gdalDataDir + "/bin")
-if not os.path.exists(pa.binDir):
-    cp.makedirs(pa.binDir)
-for item in os.listdir(pa.gdalPythonHost + "/bin"):
-  if not os.path.isdir(pa.gdalPythonHost + "/bin/" + item):
-    cp.copy(pa.gdalPythonHost + "/bin/" + item, pa.gdalDataDir + "/bin/" + item)
-    cp.symlink(os.path.relpath(pa.gdalDataDir + "/bin/" + item, pa.binDir), pa.binDir + "/" + item)
-
-print("Copying SAGA " + pa.sagaHost)
-cp.copy(pa.sagaHost + "/bin/saga_cmd", pa.binDir)
-# https://github.com/lutraconsulting/qgis-mac-packager/issues/52
-# we need to have it in subfolder because there is where
-# qgis saga batch bash script expects the SAGA tools to be located
-cp.copytree(pa.sagaHost + "/share/saga", pa.sagaDataDir, symlinks=False)
-os.makedirs(pa.sagaDataDir + "/tools")
-for item in os.listdir(pa.sagaHost + "/lib/saga"):
-    cp.copy(pa.sagaHost + "/lib/saga/" + item, pa.sagaDataDir + "/tools/" + item)
-
-subprocess.call(['chmod', '-R', '+w', pa.binDir])
-
-print("Copying GRASS7 " + pa.grass7Host)
-cp.copytree(pa.grass7Host, pa.grass7Dir, symlinks=True)
-for item in os.listdir(pa.grass7Host + "/lib"):
-    if os.path.islink(pa.grass7Host + "/lib/" + item):
-        linkto = os.readlink(pa.grass7Host + "/lib/" + item)
-        os.symlink(linkto, pa.libDir + "/" + item)
+# the cache must live outside of output directory, it is removed in STEP 0
+depCache = None
+if not args.no_cache:
+    if args.cache_file is None:
+        args.cache_file = os.path.join(os.path.dirname(os.path.realpath(args.output_directory)), "bundler_cache.sqlite")
+    print("DEPENDENCY CACHE: " + args.cache_file)
+    depCache = DependencyCache(args.cache_file, args.cache_max_entries)
+    otool.set_cache(depCache)
+
+libPatchedPath = "@executable_path/lib"
+relLibPathToFramework = "@executable_path/../Frameworks"
+
+manifestFile = os.path.join(cp.outdir, "bundle_manifest.json")
+graphFile = os.path.join(cp.outdir, "dependency_graph.json")
+relinkPlanFile = os.path.join(cp.outdir, "relink_plan.json")
+reportFile = args.report_file or os.path.join(cp.outdir, "bundler_report.json")
+
+# data passed between steps, saved after each step
+state = BundlerState(os.path.join(cp.outdir, "bundler_state.json"))
+# built after STEP 0, then kept up to date by cp
+bundleIndex = None
+# set by a step to stop the bundling after it, e.g. --plan_only
+stopRequested = False
+# names of the steps run in this run
+stepsRun = set()
+# install names are changed in one go at the end of fix_executables step
+relinkPlan = None
+
+
+def load_relink_plan():
+    # plan of previous steps when resuming
+    global relinkPlan
+    if relinkPlan is None:
+        if os.path.exists(relinkPlanFile):
+            print("Loading relink plan " + relinkPlanFile)
+            relinkPlan = RelinkPlan.load(relinkPlanFile)
+        else:
+            relinkPlan = RelinkPlan(pa.contentsDir, libPatchedPath, relLibPathToFramework)
+    return relinkPlan
+
+
+def step_copy():
+    if args.incremental:
+        # manifest of all copied files, so next run can be incremental
+        if not os.path.exists(manifestFile) and os.path.exists(args.output_directory):
+            print("No manifest from previous run, cleaning: " + args.output_directory)
+            cp.rmtree(args.output_directory)
+        cp.sync = IncrementalSync(manifestFile, True)
+
+        print("Incremental bundling to: " + args.output_directory)
+        if not os.path.exists(cp.outdir):
+            os.makedirs(cp.outdir)
+        for item in os.listdir(args.qgis_install_tree):
+            src = os.path.join(args.qgis_install_tree, item)
+            dest = pa.qgisApp if item == "QGIS.app" else os.path.join(cp.outdir, item)
+            if os.path.isdir(src) and not os.path.islink(src):
+                cp.copytree(src, dest, symlinks=True)
+            else:
+                cp.copy(src, dest)
     else:
-        cp.copy(pa.grass7Host + "/lib/" + item, pa.libDir + "/" + item)
-cp.rmtree(pa.grass7Dir + "/lib")
-cp.copy(pa.grass7Host + "/../bin/grass76", pa.grass7Dir + "/bin")
-cp.copy(pa.grass7Host + "/../libexec/bin/grass76", pa.grass7Dir + "/bin/_grass76")
-subprocess.call(['chmod', '-R', '+w', pa.grass7Dir])
-subprocess.call(['chmod', '-R', '+x', pa.grass7Dir + "/bin"])
-
-print("Remove unneeded qgis_bench.app")
-if os.path.exists(pa.binDir + "/qgis_bench.app"):
-    cp.rmtree(pa.binDir + "/qgis_bench.app")
-
-print("Append Python site-packages")
-append_recursively_site_packages(cp, pa.pysitepackages, pa.pythonDir)
-
-# TODO copy of python site-packages should be rather
-# selective an not copy-all and then remove
-print("remove not needed python site-packages")
-redundantPyPackages = [
-    "dropbox*",
-    "GitPython*",
-    "homebrew-*",
-]
-for pp in redundantPyPackages:
-    for path in glob.glob(pa.pythonDir + "/" + pp):
-        print("Removing " + path)
-        if os.path.isdir(path):
-            cp.rmtree(path)
+        print ("Cleaning: " + args.output_directory)
+        if os.path.exists(args.output_directory):
+            cp.rmtree(args.output_directory)
+            if os.path.exists(args.output_directory + "/.DS_Store"):
+                cp.remove(args.output_directory + "/.DS_Store")
+
+        print("Copying " + args.qgis_install_tree)
+        cp.copytree(args.qgis_install_tree, cp.outdir, symlinks=True)
+        if args.qgisapp_name != "QGIS.app":
+            cp.rename(os.path.join(cp.outdir, "QGIS.app"), pa.qgisApp)
+
+    if not os.path.exists(pa.qgisApp):
+        raise QGISBundlerError(pa.qgisExe + " does not exists")
+
+    if not os.path.exists(pa.binDir):
+        os.makedirs(pa.binDir)
+
+    print("Remove crssync")
+    if os.path.exists(pa.libDir + "/qgis/crssync"):
+        cp.rmtree(pa.libDir + "/qgis")
+
+    # https://doc.qt.io/qt-5/sql-driver.html#supported-databases
+    print("Copying QT SQL Drivers")
+    if not os.path.exists(pa.sqlDriversDir):
+        os.makedirs(pa.sqlDriversDir)
+    for item in [pa.mysqlDriverHost, pa.psqlDriverHost, pa.odbcDriverHost]:
+        if not os.path.exists(item):
+            raise QGISBundlerError("Unable to find QT driver " + item)
+        cp.copy(item, pa.sqlDriversDir)
+
+    print("Copying GDAL" + pa.gdalHost)
+    for item in os.listdir(pa.gdalHost + "/bin"):
+        cp.copy(pa.gdalHost + "/bin/" + item, pa.binDir)
+    cp.copytree(pa.gdalHost + "/share/gdal", pa.gdalDataDir, symlinks=False)
+    cp.copytree(pa.gdalPluginsHost, pa.gdalPluginsDir, symlinks=False)
+
+    # normally this should be on MacOS/bin/ so logic in GdalUtils.py works,
+    # but .py file in MacOS/bin halts the signing of the bundle
+    print("Copying GDAL-PYTHON" + pa.gdalPythonHost)
+    if not os.path.exists(pa.gdalDataDir + "/bin"):
+        os.makedirs(pa.gdalDataDir + "/bin")
+    if not os.path.exists(pa.binDir):
+        cp.makedirs(pa.binDir)
+    for item in os.listdir(pa.gdalPythonHost + "/bin"):
+      if not os.path.isdir(pa.gdalPythonHost + "/bin/" + item):
+        cp.copy(pa.gdalPythonHost + "/bin/" + item, pa.gdalDataDir + "/bin/" + item)
+        cp.symlink(os.path.relpath(pa.gdalDataDir + "/bin/" + item, pa.binDir), pa.binDir + "/" + item)
+
+    print("Copying SAGA " + pa.sagaHost)
+    cp.copy(pa.sagaHost + "/bin/saga_cmd", pa.binDir)
+    # https://github.com/lutraconsulting/qgis-mac-packager/issues/52
+    # we need to have it in subfolder because there is where
+    # qgis saga batch bash script expects the SAGA tools to be located
+    cp.copytree(pa.sagaHost + "/share/saga", pa.sagaDataDir, symlinks=False)
+    if not os.path.exists(pa.sagaDataDir + "/tools"):
+        os.makedirs(pa.sagaDataDir + "/tools")
+    for item in os.listdir(pa.sagaHost + "/lib/saga"):
+        cp.copy(pa.sagaHost + "/lib/saga/" + item, pa.sagaDataDir + "/tools/" + item)
+
+
+    print("Copying GRASS7 " + pa.grass7Host)
+    cp.copytree(pa.grass7Host, pa.grass7Dir, symlinks=True)
+    for item in os.listdir(pa.grass7Host + "/lib"):
+        if os.path.islink(pa.grass7Host + "/lib/" + item):
+            linkto = os.readlink(pa.grass7Host + "/lib/" + item)
+            cp.symlink(linkto, pa.libDir + "/" + item)
         else:
-            cp.remove(path)
-
-
-subprocess.call(['chmod', '-R', '+w', pa.pluginsDir])
-
-print("add pyqgis_startup.py to remove MacOS default paths")
-startup_script = os.path.join(pa.bundlerResourcesDir, "pyqgis-startup.py")
-if not os.path.exists(startup_script):
-    raise QGISBundlerError("Missing resource " + startup_script)
-cp.copy(startup_script, os.path.join(pa.pythonDir, "pyqgis-startup.py"))
-
-print("Copying PyQt " + pyqtHostDir)
-if not os.path.exists(pa.pythonDir + "/PyQt5/Qt.so"):
-    raise QGISBundlerError("Inconsistent python with pyqt5, should be copied in previous step")
-pyqtpluginfile = os.path.join(pyqtHostDir, os.pardir, os.pardir, os.pardir, os.pardir, "share", "pyqt", "plugins")
-cp.copytree(pyqtpluginfile, pa.pluginsDir + "/PyQt5", True)
-subprocess.call(['chmod', '-R', '+w', pa.pluginsDir + "/PyQt5"])
-
-# https://github.com/lutraconsulting/qgis-mac-packager/issues/44
-# when number 7 changes, change also in steps.py
-print("Copying mod_spatiallite")
-cp.copy("/usr/local/opt/libspatialite/lib/mod_spatialite.7.dylib", os.path.join(pa.libDir, "mod_spatialite.7.dylib"))
-
-print("Copy PROJ shared folder")
-cp.copytree(pa.projHost, pa.projDir, True)
-for item in os.listdir(pa.projDatumGridsHost):
-    src = pa.projDatumGridsHost + "/" + item
-    dest = pa.projDir + "/proj/" + item
-    if os.path.exists(dest):
-      cp.remove(dest)
-    cp.copy(src, dest)
-
-print("Copy GEOTIFF shared folder")
-cp.copytree(pa.geotiffHost, pa.geotiffDir, True)
-
-# at the end make it all writable
-subprocess.call(['chmod', '-R', '+w', pa.contentsDir])
-
-print(100*"*")
-print("STEP 1: Analyze the libraries we need to bundle")
-print(100*"*")
-
-# Find QT
-qtDir = None
-for framework in otool.get_binary_dependencies(pa, pa.qgisExe).frameworks:
-    if "lib/QtCore.framework" in framework:
-        path = os.path.realpath(framework)
-        qtDir = path.split("/lib/")[0]
-        break
-if not qtDir:
-    raise QGISBundlerError("Unable to find QT install directory")
-print("Found QT: " + qtDir)
-
-# Find QCA dir
-qcaDir = None
-for framework in otool.get_binary_dependencies(pa, pa.qgisExe).frameworks:
-    if "lib/qca" in framework:
-        path = os.path.realpath(framework)
-        qcaDir = path.split("/lib/")[0]
-        break
-if not qcaDir:
-    raise QGISBundlerError("Unable to find QCA install directory")
-print("Found QCA: " + qcaDir)
-
-# Analyze all
-sys_libs = set()
-libs = set()
-frameworks = set()
-
-deps_queue = set()
-done_queue = set()
-
-# initial items:
-# 1. qgis executable
-deps_queue.add(pa.qgisExe)
-# 2. all so and dylibs in bundle folder
-for root, dirs, files in os.walk(pa.qgisApp):
-    for file in files:
-        filepath = os.path.join(root, file)
+            cp.copy(pa.grass7Host + "/lib/" + item, pa.libDir + "/" + item)
+    cp.rmtree(pa.grass7Dir + "/lib")
+    cp.copy(pa.grass7Host + "/../bin/grass76", pa.grass7Dir + "/bin")
+    cp.copy(pa.grass7Host + "/../libexec/bin/grass76", pa.grass7Dir + "/bin/_grass76")
+
+    print("Remove unneeded qgis_bench.app")
+    if os.path.exists(pa.binDir + "/qgis_bench.app"):
+        cp.rmtree(pa.binDir + "/qgis_bench.app")
+
+    if args.selective_site_packages:
+        print("Append imported Python site-packages")
+        allowlist = pyimports.DEFAULT_ALLOWLIST + [p for p in args.site_packages_allowlist.split(",") if p]
+        copy_selected_site_packages(pa, cp, pa.pysitepackages, pa.pythonDir, allowlist)
+    else:
+        print("Append Python site-packages")
+        append_recursively_site_packages(cp, pa.pysitepackages, pa.pythonDir)
+
+    print("remove not needed python site-packages")
+    redundantPyPackages = [
+        "dropbox*",
+        "GitPython*",
+        "homebrew-*",
+    ]
+    for pp in redundantPyPackages:
+        for path in glob.glob(pa.pythonDir + "/" + pp):
+            print("Removing " + path)
+            if os.path.isdir(path):
+                cp.rmtree(path)
+            else:
+                cp.remove(path)
+
+
+    print("add pyqgis_startup.py to remove MacOS default paths")
+    startup_script = os.path.join(pa.bundlerResourcesDir, "pyqgis-startup.py")
+    if not os.path.exists(startup_script):
+        raise QGISBundlerError("Missing resource " + startup_script)
+    cp.copy(startup_script, os.path.join(pa.pythonDir, "pyqgis-startup.py"))
+
+    print("Copying PyQt " + pyqtHostDir)
+    if not os.path.exists(pa.pythonDir + "/PyQt5/Qt.so"):
+        raise QGISBundlerError("Inconsistent python with pyqt5, should be copied in previous step")
+    pyqtpluginfile = os.path.join(pyqtHostDir, os.pardir, os.pardir, os.pardir, os.pardir, "share", "pyqt", "plugins")
+    cp.copytree(pyqtpluginfile, pa.pluginsDir + "/PyQt5", True)
+
+    # https://github.com/lutraconsulting/qgis-mac-packager/issues/44
+    # when number 7 changes, change also in steps.py
+    print("Copying mod_spatiallite")
+    cp.copy("/usr/local/opt/libspatialite/lib/mod_spatialite.7.dylib", os.path.join(pa.libDir, "mod_spatialite.7.dylib"))
+
+    print("Copy PROJ shared folder")
+    cp.copytree(pa.projHost, pa.projDir, True)
+    for item in os.listdir(pa.projDatumGridsHost):
+        src = pa.projDatumGridsHost + "/" + item
+        dest = pa.projDir + "/proj/" + item
+        if os.path.exists(dest):
+          cp.remove(dest)
+        cp.copy(src, dest)
+
+    print("Copy GEOTIFF shared folder")
+    cp.copytree(pa.geotiffHost, pa.geotiffDir, True)
+
+
+def step_analyze():
+    # Find QT
+    qtDir = None
+    for framework in otool.get_binary_dependencies(pa, pa.qgisExe).frameworks:
+        if "lib/QtCore.framework" in framework:
+            path = os.path.realpath(framework)
+            qtDir = path.split("/lib/")[0]
+            break
+    if not qtDir:
+        raise QGISBundlerError("Unable to find QT install directory")
+    print("Found QT: " + qtDir)
+
+    # Find QCA dir
+    qcaDir = None
+    for framework in otool.get_binary_dependencies(pa, pa.qgisExe).frameworks:
+        if "lib/qca" in framework:
+            path = os.path.realpath(framework)
+            qcaDir = path.split("/lib/")[0]
+            break
+    if not qcaDir:
+        raise QGISBundlerError("Unable to find QCA install directory")
+    print("Found QCA: " + qcaDir)
+    state["qtDir"] = qtDir
+    state["qcaDir"] = qcaDir
+
+    # Analyze all
+    deps_queue = set()
+
+    # initial items:
+    # 1. qgis executable
+    deps_queue.add(pa.qgisExe)
+    # 2. all so and dylibs in bundle folder, in incremental mode only the
+    # files copied from the install tree, not the relinked ones from the previous run
+    for filepath in bundleIndex.files():
+        if cp.sync and not cp.sync.is_produced(filepath):
+            continue
         filename, file_extension = os.path.splitext(filepath)
         if file_extension in [".dylib", ".so"]:
             deps_queue.add(filepath)
-# 3. python libraries
-deps_queue |= set(glob.glob(os.path.dirname(args.python) + "/lib/python3.7/lib-dynload/*.so"))
-# 4. dynamic qt providers
-deps_queue |= set(glob.glob(qtDir + "/plugins/*/*.dylib"))
-deps_queue |= set(glob.glob(qcaDir + "/lib/qt5/plugins/*/*.dylib"))
-# 5. python interpreter
-deps_queue.add(pythonHost)
-# 6. saga for processing toolbox and other bins
-deps_queue |= set(glob.glob(pa.binDir + "/*"))
-# 7. grass7
-deps_queue |= set(glob.glob(pa.grass7Dir + "/bin/*"))
-deps_queue |= set(glob.glob(pa.grass7Dir + "/lib/*.dylib"))
-deps_queue |= set(glob.glob(pa.grass7Dir + "/driver/db/*"))
-deps_queue |= set(glob.glob(pa.grass7Dir + "/etc/*"))
-deps_queue |= set(glob.glob(pa.grass7Dir + "/etc/*/*"))
-
-# DEBUGGING
-debug_lib = None
-# debug_lib = "libopencv_calib3d"
-
-while deps_queue:
-    lib = deps_queue.pop()
-
-    if lib.endswith(".py"):
-        continue
-
-    lib_fixed = lib
-    # patch @rpath, @loader_path and @executable_path
-    if "@rpath" in lib_fixed:
-        # replace rpath we know from homebrew
-        patched_path = lib_fixed.replace("@rpath", "/usr/local/opt/lapack/lib/")
-        if os.path.exists(patched_path):
-            lib_fixed = patched_path
-        # now try the hint?
-        lib_fixed = lib_fixed.replace("@rpath", args.rpath_hint)
-
-    lib_fixed = lib_fixed.replace("@executable_path", pa.macosDir)
-    lib_fixed = utils.resolve_libpath(pa, lib_fixed)
-
-    if "@loader_path" in lib_fixed:
-        raise QGISBundlerError("Ups, unable to get library path, maybe fix resolve_libpath? " + lib_fixed)
-
-    if lib_fixed in done_queue:
-        continue
-
-    if not lib_fixed:
-        continue
-
-    if os.path.isdir(lib_fixed):
-        continue
-
-    extraInfo = "" if lib == lib_fixed else "(" + lib_fixed + ")"
-    print("Analyzing " + lib + extraInfo)
-
-    if not os.path.exists(lib_fixed):
-        raise QGISBundlerError("Library missing! " + lib_fixed)
-
-    done_queue.add(lib_fixed)
-
-    binaryDependencies = otool.get_binary_dependencies(pa, lib_fixed)
-
-    if debug_lib:
-        for l in binaryDependencies.libs:
-            if debug_lib in l:
-               print(100*"*")
-               print("DEBUG: {} -- {}".format(debug_lib, lib))
-
-
-    lib_fixed, type = otool.binary_type(lib_fixed)
-    if type is otool.SYS_LIB:
-        sys_libs |= set(binaryDependencies.sys_libs)
-    elif type is otool.FRAMEWORK:
-        frameworks |= set([lib_fixed])
-    elif type is otool.LIB:
-        libs |= set([lib_fixed])
-
-    deps_queue |= set(binaryDependencies.libs)
-    deps_queue |= set(binaryDependencies.frameworks)
-
-
-msg = "\nLibs:\n\t"
-msg += "\n\t".join(sorted(libs))
-msg += "\nFrameworks:\n\t"
-msg += "\n\t".join(sorted(frameworks))
-msg += "\nSysLibs:\n\t"
-msg += "\n\t".join(sorted(sys_libs))
-print(msg)
-
-print(100*"*")
-print("STEP 2: Copy libraries/plugins to bundle")
-print(100*"*")
-
-unlinked_libs = set()
-unlink_links = set()
-
-for lib in libs:
-    if not lib:
-        continue
-
-    if ("@rpath" in lib) or ("@loader_path" in lib) or ("@executable_path" in lib):
-        raise QGISBundlerError("Ups, analysis of the library " + lib + " is wrong!")
-
-    # libraries to lib dir
-    # plugins to plugin dir/plugin name/, e.g. PlugIns/qgis, PlugIns/platform, ...
-    if "/plugins/" in lib:
-        pluginFolder = lib.split("/plugins/")[1]
-        pluginFolder = pluginFolder.split("/")[0]
-        # Skip this is already copied
-        if "libpyqt5qmlplugin.dylib" in lib:
-            if os.path.exists(pa.pluginsDir + "/PyQt5/libpyqt5qmlplugin.dylib"):
-                target_dir = pa.pluginsDir + "/PyQt5"
-            else:
-                raise QGISBundlerError("Ups, missing libpyqt5qmlplugin.dylib")
-        else:
-            target_dir = pa.pluginsDir + "/" + pluginFolder
-    else:
-        target_dir = pa.libDir
-
-    # only copy if not already in the bundle
-    # frameworks are copied elsewhere
-    if (pa.qgisApp not in lib) and (".framework" not in lib):
-        print("Bundling " + lib + " to " + target_dir)
-        if not os.path.exists(target_dir):
-            os.makedirs(target_dir)
-
-        cp.copy(lib, target_dir)
-
-        new_file = os.path.join(target_dir, os.path.basename(lib))
-        subprocess.call(['chmod', '+w', new_file])
-
-    # link to libs folder if the library is somewhere around the bundle dir
-    if (pa.qgisApp in lib) and (pa.libDir not in lib):
-        link = pa.libDir + "/" + os.path.basename(lib)
-        if not os.path.exists(link):
-            cp.symlink(os.path.relpath(lib, pa.libDir),
-                       link)
-            link = os.path.realpath(link)
-            if not os.path.exists(link):
-                raise QGISBundlerError("Ups, wrongly linked! " + lib)
-        else:
-            # we already have this lib in the bundle (because there is a link! in lib/), so make sure we do not have it twice!
-            existing_link_realpath = os.path.realpath(link)
-            if existing_link_realpath != os.path.realpath(lib):
-                if utils.files_differ(existing_link_realpath, lib):
-                    # libraries with the same name BUT with different contents
-                    # so do not have it in libs folder because we do not know which
-                    # we HOPE that this happens only for cpython extensions for python modules
-                    if not "cpython-37m-darwin" in link:
-                        raise QGISBundlerError("multiple libraries with same name but different content " + link + "; " + lib)
-                    unlink_links.add(link)
-                    unlinked_libs.add(existing_link_realpath)
-                    unlinked_libs.add(os.path.realpath(lib))
-
+    # 3. python libraries
+    deps_queue |= set(glob.glob(os.path.dirname(args.python) + "/lib/python3.7/lib-dynload/*.so"))
+    # 4. dynamic qt providers
+    deps_queue |= set(glob.glob(qtDir + "/plugins/*/*.dylib"))
+    deps_queue |= set(glob.glob(qcaDir + "/lib/qt5/plugins/*/*.dylib"))
+    # 5. python interpreter
+    deps_queue.add(pythonHost)
+    # 6. saga for processing toolbox and other bins
+    deps_queue |= set(glob.glob(pa.binDir + "/*"))
+    # 7. grass7
+    deps_queue |= set(glob.glob(pa.grass7Dir + "/bin/*"))
+    deps_queue |= set(glob.glob(pa.grass7Dir + "/lib/*.dylib"))
+    deps_queue |= set(glob.glob(pa.grass7Dir + "/driver/db/*"))
+    deps_queue |= set(glob.glob(pa.grass7Dir + "/etc/*"))
+    deps_queue |= set(glob.glob(pa.grass7Dir + "/etc/*/*"))
+
+    # LC_RPATH of the executables apply to all libraries they load
+    executables = [pa.qgisExe, pythonHost]
+    libs, frameworks, sys_libs, depGraph = analyze_dependencies(pa, deps_queue, executables, args.rpath_hint, args.jobs)
+
+    print("Saving dependency graph to " + graphFile)
+    depGraph.save(graphFile)
+
+    # DEBUGGING, e.g. --debug_lib libopencv_calib3d
+    if args.debug_lib:
+        for lib in depGraph.find(args.debug_lib):
+            print(100*"*")
+            print("DEBUG: {} is loaded by\n\t{}".format(lib, "\n\t".join(sorted(depGraph.dependents(lib)))))
+            print("DEBUG: {} is bundled because of\n\t{}".format(lib, "\n\t-> ".join(depGraph.why(lib))))
+
+    msg = "\nLibs:\n\t"
+    msg += "\n\t".join(sorted(libs))
+    msg += "\nFrameworks:\n\t"
+    msg += "\n\t".join(sorted(frameworks))
+    msg += "\nSysLibs:\n\t"
+    msg += "\n\t".join(sorted(sys_libs))
+    print(msg)
+
+    state["libs"] = libs
+    state["frameworks"] = frameworks
+    state["sys_libs"] = sys_libs
+
+
+def step_prune():
+    # libraries seeded from the bundle or loaded only by them may be never used
+    depGraph = DependencyGraph.load(graphFile)
+    pluginDirs = [pa.pluginsDir,
+                  pa.gdalPluginsDir,
+                  pa.sagaDataDir,
+                  state["qtDir"] + "/plugins",
+                  state["qcaDir"] + "/lib/qt5/plugins"]
+    allowlist = DLOPEN_ALLOWLIST + [l for l in args.prune_allowlist.split(",") if l]
+    unreachable = find_unreachable_libraries(depGraph, pluginDirs, allowlist)
+
+    libs = set(state["libs"])
+    for lib in unreachable:
+        print("Unreachable " + lib + "\n\tloaded by " + ", ".join(sorted(depGraph.dependents(lib))))
+        if args.prune == "remove":
+            libs.discard(lib)
+            libs.discard(otool.binary_type(lib)[0])
+            if pa.qgisApp in lib and os.path.lexists(lib):
+                print("Removing " + lib)
+                if os.path.islink(lib):
+                    cp.unlink(lib)
                 else:
-                    # same library (binary) --> we need just one
-                    # ok, in this case remove the new library and just symlink to the lib
-                    cp.remove(lib)
-                    relpath = os.path.relpath(existing_link_realpath, os.path.dirname(lib))
-                    cp.symlink(relpath,
-                               lib)
-
-                    link = os.path.realpath(lib)
-                    if not os.path.exists(link):
-                        raise QGISBundlerError("Ups, wrongly relinked! " + link)
-
-
-    # find out if there are no python3.7 plugins in the dir
-    plugLibDir = os.path.join(os.path.dirname(lib), "python3.7", "site-packages", "PyQt5")
-    if os.path.exists(plugLibDir):
-        for file in glob.glob(plugLibDir + "/*.so"):
-            basename =  os.path.basename(file)
-            destFile = pa.pluginsDir + "/PyQt5/" + basename
-            link = pa.pythonDir + "/PyQt5/" + basename
-            if not os.path.exists(destFile):
-                if os.path.exists(link):
-                    print("Linking extra python plugin " + file)
-                    relpath = os.path.relpath(link, os.path.dirname(destFile))
-                    cp.symlink(relpath,
-                               destFile)
-                else:
-                    raise QGISBundlerError("All PyQt5 modules should be already bundled!" + file)
-
-
-# these are cpython libs, unlink them it is enough to have them in python site-packages
-for lib in unlink_links:
-    cp.unlink(lib)
-
-# fix duplicit libraries
-# this is really just a workaround,
-# because when libraries are copied, we should copy all the link tree
-# xy.dylib -> dx.1.0.dylib -> dx.1.0.0.dylib ..but now we copy it 3 times
-# and not as links
-workarounds = {}
-
-for l in ["libwx_osx_cocoau_core",
-          "libwx_osx_cocoau_html",
-          "libwx_baseu_xml",
-          "libwx_osx_cocoau_adv",
-          "libwx_baseu"
-          ]:
-    lib = pa.libDir + "/{}-3.0.dylib".format(l)
-    existing_link_realpath = pa.libDir + "/{}-3.0.0.4.0.dylib".format(l)
-    workarounds[lib] = existing_link_realpath
-
-lib = pa.libDir + "/libpq.5.dylib"
-existing_link_realpath = pa.libDir + "/libpq.5.10.dylib"
-workarounds[lib] = existing_link_realpath
-
-for lib, existing_link_realpath in workarounds.items():
-    if not (os.path.exists(lib) and os.path.exists(existing_link_realpath)):
-        print("WARNING: Workaround " + lib + "->" + existing_link_realpath + " is no longer valid, maybe you upaded packages?")
-        continue
-
-    cp.remove(lib)
-    relpath = os.path.relpath(existing_link_realpath, os.path.dirname(lib))
-    cp.symlink(relpath, lib)
-
-
-print(100*"*")
-print("STEP 3: Copy frameworks to bundle")
-print(100*"*")
-for framework in frameworks:
-    if not framework:
-        continue
-
-    frameworkName, baseFrameworkDir = utils.framework_name(framework)
-    new_framework = os.path.join(pa.frameworksDir, frameworkName + ".framework")
-
-    # only copy if not already in the bundle
-    if os.path.exists(new_framework):
-        print("Skipping " + new_framework + " already exists")
-        continue
-
-    # do not copy system libs
-    if pa.qgisApp not in baseFrameworkDir:
-        print("Bundling " + frameworkName + ": " + framework + "  to " + pa.frameworksDir)
-        cp.copytree(baseFrameworkDir, new_framework, symlinks=True)
-        subprocess.call(['chmod', '-R', '+w', new_framework])
+                    cp.rm(lib)
+    print("Found {} unreachable libraries{}".format(len(unreachable), ", removed" if args.prune == "remove" else ""))
 
+    state["libs"] = libs
+    state["unreachable_libs"] = unreachable
 
-libPatchedPath = "@executable_path/lib"
-relLibPathToFramework = "@executable_path/../Frameworks"
 
-# Now everything should be here
-subprocess.call(['chmod', '-R', '+w', pa.qgisApp])
-
-print(100*"*")
-print("STEP 4: Fix frameworks linker paths")
-print(100*"*")
-frameworks = glob.glob(pa.frameworksDir + "/*.framework")
-for framework in frameworks:
-    print("Patching " + framework)
-    frameworkName = os.path.basename(framework)
-    frameworkName = frameworkName.replace(".framework", "")
-
-    # patch versions framework
-    last_version = None
-    versions = sorted(glob.glob(os.path.join(framework, "Versions") + "/*"))
-    for version in versions:
-        verFramework = os.path.join(version, frameworkName)
-        if os.path.exists(verFramework):
-            if not os.path.islink(verFramework):
-                binaryDependencies = otool.get_binary_dependencies(pa, verFramework)
-                subprocess.call(['chmod', '+x', verFramework])
-                install_name_tool.fix_lib(verFramework, binaryDependencies, pa.contentsDir, libPatchedPath, relLibPathToFramework)
+def step_copy_libs():
+    unlinked_libs = set()
+    unlink_links = set()
 
-            if version is not "Current":
-                last_version = os.path.basename(version)
-        else:
-            print("Warning: Missing " + verFramework)
-
-    # patch current version
-    currentFramework = os.path.join(framework, frameworkName)
-    if os.path.exists(currentFramework):
-        if not os.path.islink(verFramework):
-            binaryDependencies = otool.get_binary_dependencies(pa, currentFramework)
-            install_name_tool.fix_lib(currentFramework, binaryDependencies, pa.contentsDir, libPatchedPath, relLibPathToFramework)
-            subprocess.call(['chmod', '+x', currentFramework])
-    else:
-        if last_version is None:
-            print("Warning: Missing " + currentFramework)
+    for lib in state["libs"]:
+        if not lib:
+            continue
+
+        if ("@rpath" in lib) or ("@loader_path" in lib) or ("@executable_path" in lib):
+            raise QGISBundlerError("Ups, analysis of the library " + lib + " is wrong!")
+
+        # libraries to lib dir
+        # plugins to plugin dir/plugin name/, e.g. PlugIns/qgis, PlugIns/platform, ...
+        if "/plugins/" in lib:
+            pluginFolder = lib.split("/plugins/")[1]
+            pluginFolder = pluginFolder.split("/")[0]
+            # Skip this is already copied
+            if "libpyqt5qmlplugin.dylib" in lib:
+                if os.path.exists(pa.pluginsDir + "/PyQt5/libpyqt5qmlplugin.dylib"):
+                    target_dir = pa.pluginsDir + "/PyQt5"
+                else:
+                    raise QGISBundlerError("Ups, missing libpyqt5qmlplugin.dylib")
+            else:
+                target_dir = pa.pluginsDir + "/" + pluginFolder
         else:
-            print("Creating version link for " + currentFramework)
-            subprocess.call(["ln", "-s", last_version, framework + "/Versions/Current"])
-            subprocess.call(["ln", "-s", "Versions/Current/" + frameworkName, currentFramework])
-
-    # TODO generic?
-    # patch helpers (?)
-    helper = os.path.join(framework, "Helpers", "QtWebEngineProcess.app" , "Contents", "MacOS", "QtWebEngineProcess")
-    if os.path.exists(helper):
-        binaryDependencies = otool.get_binary_dependencies(pa, helper)
-        install_name_tool.fix_lib(helper, binaryDependencies, pa.contentsDir, libPatchedPath, relLibPathToFramework)
-        subprocess.call(['chmod', '+x', helper])
-
-    # TODO generic?
-    helper = os.path.join(framework, "Versions/Current/Resources/Python.app/Contents/MacOS/Python")
-    if os.path.exists(helper):
-        binaryDependencies = otool.get_binary_dependencies(pa, helper)
-        install_name_tool.fix_lib(helper, binaryDependencies, pa.contentsDir, libPatchedPath, relLibPathToFramework)
-        subprocess.call(['chmod', '+x', helper])
-        # add link to MacOS/bin too
-        cp.symlink(os.path.relpath(helper, pa.binDir), pa.binDir + "/python")
-        cp.symlink(os.path.relpath(helper, pa.binDir), pa.binDir + "/python3")
-
-    helper = os.path.join(framework, "Versions/Current/lib/python3.7/lib-dynload")
-    if os.path.exists(helper):
-        for bin in glob.glob(helper + "/*.so"):
-            binaryDependencies = otool.get_binary_dependencies(pa, bin)
-            install_name_tool.fix_lib(bin, binaryDependencies, pa.contentsDir, libPatchedPath, relLibPathToFramework)
-            subprocess.call(['chmod', '+x', bin])
-
-            link = pa.libDir + "/" + os.path.basename(bin)
-            cp.symlink(os.path.relpath(bin, pa.libDir),
-                       link)
-            link = os.path.realpath(link)
+            target_dir = pa.libDir
+
+        # only copy if not already in the bundle
+        # frameworks are copied elsewhere
+        if (pa.qgisApp not in lib) and (".framework" not in lib):
+            print("Bundling " + lib + " to " + target_dir)
+            if not os.path.exists(target_dir):
+                cp.makedirs(target_dir)
+
+            # links are copied as links, so different names of the same library
+            # are not bundled more times
+            cp.copy_library(lib, target_dir)
+
+        # link to libs folder if the library is somewhere around the bundle dir
+        if (pa.qgisApp in lib) and (pa.libDir not in lib):
+            link = pa.libDir + "/" + os.path.basename(lib)
             if not os.path.exists(link):
-                raise QGISBundlerError("Ups, wrongly relinked! " + bin)
-
-    if "Python" in framework:
-        filepath = os.path.join(framework, "Versions/Current/lib/python3.7/site-packages" )
-        cp.unlink(filepath)
-        cp.symlink("../../../../../../Resources/python", filepath)
-        filepath = os.path.realpath(filepath)
-        if  not os.path.exists(filepath):
-            raise QGISBundlerError("Ups, wrongly relinked! " + "site-packages")
-
-
-print(100*"*")
-print("STEP 5: Fix libraries/plugins linker paths")
-print(100*"*")
-libs = []
-for root, dirs, files in os.walk(pa.qgisApp):
-    for file in files:
-        filepath = os.path.join(root, file)
+                cp.symlink(os.path.relpath(lib, pa.libDir),
+                           link)
+                link = os.path.realpath(link)
+                if not os.path.exists(link):
+                    raise QGISBundlerError("Ups, wrongly linked! " + lib)
+            else:
+                # we already have this lib in the bundle (because there is a link! in lib/), so make sure we do not have it twice!
+                existing_link_realpath = os.path.realpath(link)
+                if existing_link_realpath != os.path.realpath(lib):
+                    if utils.files_differ(existing_link_realpath, lib):
+                        # libraries with the same name BUT with different contents
+                        # so do not have it in libs folder because we do not know which
+                        # we HOPE that this happens only for cpython extensions for python modules
+                        if not "cpython-37m-darwin" in link:
+                            raise QGISBundlerError("multiple libraries with same name but different content " + link + "; " + lib)
+                        unlink_links.add(link)
+                        unlinked_libs.add(existing_link_realpath)
+                        unlinked_libs.add(os.path.realpath(lib))
+
+                    else:
+                        # same library (binary) --> we need just one
+                        # ok, in this case remove the new library and just symlink to the lib
+                        cp.remove(lib)
+                        relpath = os.path.relpath(existing_link_realpath, os.path.dirname(lib))
+                        cp.symlink(relpath,
+                                   lib)
+
+                        link = os.path.realpath(lib)
+                        if not os.path.exists(link):
+                            raise QGISBundlerError("Ups, wrongly relinked! " + link)
+
+
+        # find out if there are no python3.7 plugins in the dir
+        plugLibDir = os.path.join(os.path.dirname(lib), "python3.7", "site-packages", "PyQt5")
+        if os.path.exists(plugLibDir):
+            for file in glob.glob(plugLibDir + "/*.so"):
+                basename =  os.path.basename(file)
+                destFile = pa.pluginsDir + "/PyQt5/" + basename
+                link = pa.pythonDir + "/PyQt5/" + basename
+                if not os.path.exists(destFile):
+                    if os.path.exists(link):
+                        print("Linking extra python plugin " + file)
+                        relpath = os.path.relpath(link, os.path.dirname(destFile))
+                        cp.symlink(relpath,
+                                   destFile)
+                    else:
+                        raise QGISBundlerError("All PyQt5 modules should be already bundled!" + file)
+
+
+    # these are cpython libs, unlink them it is enough to have them in python site-packages
+    for lib in unlink_links:
+        cp.unlink(lib)
+    state["unlink_links"] = unlink_links
+    state["unlinked_libs"] = unlinked_libs
+
+
+def step_copy_frameworks():
+    for framework in state["frameworks"]:
+        if not framework:
+            continue
+
+        frameworkName, baseFrameworkDir = utils.framework_name(framework)
+        new_framework = os.path.join(pa.frameworksDir, frameworkName + ".framework")
+
+        # only copy if not already in the bundle
+        if cp.exists(new_framework):
+            print("Skipping " + new_framework + " already exists")
+            continue
+
+        # do not copy system libs
+        if pa.qgisApp not in baseFrameworkDir:
+            print("Bundling " + frameworkName + ": " + framework + "  to " + pa.frameworksDir)
+            cp.copytree(baseFrameworkDir, new_framework, symlinks=True)
+
+
+    # products of previous run which are not needed anymore
+    if cp.sync:
+        for item in cp.sync.stale():
+            if os.path.lexists(item):
+                print("Removing stale " + item)
+                if os.path.islink(item):
+                    cp.unlink(item)
+                else:
+                    cp.rm(item)
+        cp.sync.report()
+
+    # Now everything should be here, make it all writable
+    # and binaries executable in one pass
+    permissions = PermissionModel()
+    permissions.add_executable_dir(pa.binDir)
+    permissions.add_executable_dir(pa.frameworksDir + "/Python.framework/Versions/Current/bin")
+    permissions.add_executable_dir(pa.grass7Dir + "/bin", depth=None)
+    permissions.add_executable_dir(pa.grass7Dir + "/driver/db")
+    # GRASS modules and their helpers, not the data files
+    permissions.add_executable_dir(pa.grass7Dir + "/etc", depth=2, scripts_only=True)
+    permissions.apply(bundleIndex)
+
+
+def step_dedup():
+    deduplicate_libraries(pa, cp, bundleIndex)
+
+
+def step_fix_frameworks():
+    global relinkPlan
+    relinkPlan = RelinkPlan(pa.contentsDir, libPatchedPath, relLibPathToFramework)
+
+    frameworks = glob.glob(pa.frameworksDir + "/*.framework")
+    for framework in frameworks:
+        print("Patching " + framework)
+        frameworkName = os.path.basename(framework)
+        frameworkName = frameworkName.replace(".framework", "")
+
+        # patch versions framework
+        last_version = None
+        versions = sorted(glob.glob(os.path.join(framework, "Versions") + "/*"))
+        for version in versions:
+            verFramework = os.path.join(version, frameworkName)
+            if os.path.exists(verFramework):
+                if not os.path.islink(verFramework):
+                    binaryDependencies = otool.get_binary_dependencies(pa, verFramework)
+                    relinkPlan.add(verFramework, binaryDependencies)
+
+                if version is not "Current":
+                    last_version = os.path.basename(version)
+            else:
+                print("Warning: Missing " + verFramework)
+
+        # patch current version
+        currentFramework = os.path.join(framework, frameworkName)
+        if os.path.exists(currentFramework):
+            if not os.path.islink(verFramework):
+                binaryDependencies = otool.get_binary_dependencies(pa, currentFramework)
+                relinkPlan.add(currentFramework, binaryDependencies)
+        else:
+            if last_version is None:
+                print("Warning: Missing " + currentFramework)
+            else:
+                print("Creating version link for " + currentFramework)
+                cp.symlink(last_version, framework + "/Versions/Current")
+                cp.symlink("Versions/Current/" + frameworkName, currentFramework)
+
+        # TODO generic?
+        # patch helpers (?)
+        helper = os.path.join(framework, "Helpers", "QtWebEngineProcess.app" , "Contents", "MacOS", "QtWebEngineProcess")
+        if os.path.exists(helper):
+            binaryDependencies = otool.get_binary_dependencies(pa, helper)
+            relinkPlan.add(helper, binaryDependencies)
+
+        # TODO generic?
+        helper = os.path.join(framework, "Versions/Current/Resources/Python.app/Contents/MacOS/Python")
+        if os.path.exists(helper):
+            binaryDependencies = otool.get_binary_dependencies(pa, helper)
+            relinkPlan.add(helper, binaryDependencies)
+            # add link to MacOS/bin too
+            cp.symlink(os.path.relpath(helper, pa.binDir), pa.binDir + "/python")
+            cp.symlink(os.path.relpath(helper, pa.binDir), pa.binDir + "/python3")
+
+        helper = os.path.join(framework, "Versions/Current/lib/python3.7/lib-dynload")
+        if os.path.exists(helper):
+            for bin in glob.glob(helper + "/*.so"):
+                binaryDependencies = otool.get_binary_dependencies(pa, bin)
+                relinkPlan.add(bin, binaryDependencies)
+
+                link = pa.libDir + "/" + os.path.basename(bin)
+                cp.symlink(os.path.relpath(bin, pa.libDir),
+                           link)
+                link = os.path.realpath(link)
+                if not os.path.exists(link):
+                    raise QGISBundlerError("Ups, wrongly relinked! " + bin)
+
+        if "Python" in framework:
+            filepath = os.path.join(framework, "Versions/Current/lib/python3.7/site-packages" )
+            cp.unlink(filepath)
+            cp.symlink("../../../../../../Resources/python", filepath)
+            filepath = os.path.realpath(filepath)
+            if  not os.path.exists(filepath):
+                raise QGISBundlerError("Ups, wrongly relinked! " + "site-packages")
+
+    relinkPlan.save(relinkPlanFile)
+
+
+def step_fix_libs():
+    relinkPlan = load_relink_plan()
+
+    libs = []
+    for filepath in bundleIndex.files():
         if ".framework" not in filepath:
             filename, file_extension = os.path.splitext(filepath)
             if file_extension in [".dylib", ".so"]:
                 libs += [filepath]
 
-# note there are some libs here: /Python.framework/Versions/Current/lib/*.dylib but
-# those are just links to Current/Python
-for lib in libs:
-    if not os.path.islink(lib):
-        print("Patching " + lib)
-        binaryDependencies = otool.get_binary_dependencies(pa, lib)
-        install_name_tool.fix_lib(lib, binaryDependencies, pa.contentsDir, libPatchedPath, relLibPathToFramework)
-        subprocess.call(['chmod', '+x', lib])
-
-        # TODO what to do with unlinked_libs????
-        # now we hope noone references them
+    # note there are some libs here: /Python.framework/Versions/Current/lib/*.dylib but
+    # those are just links to Current/Python
+    # TODO what to do with unlinked_libs????
+    # now we hope noone references them
+    fix_libraries(pa, relinkPlan, libs, args.jobs)
+
+    relinkPlan.save(relinkPlanFile)
+
+
+def step_fix_executables():
+    relinkPlan = load_relink_plan()
+
+    exes = set()
+    exes.add(pa.qgisExe)
+    exes |= set(glob.glob(pa.frameworksDir + "/Python.framework/Versions/Current/bin/*"))
+    exes |= set(glob.glob(pa.frameworksDir + "/Python.framework/Versions/Current/Resources/Python.app/Contents/MacOS/Python"))
+    exes |= set(glob.glob(pa.binDir + "/*"))
+    exes |= set(glob.glob(pa.grass7Dir + "/bin/*"))
+    exes |= set(glob.glob(pa.grass7Dir + "/driver/db/*"))
+    exes |= set(glob.glob(pa.grass7Dir + "/etc/*"))
+    exes |= set(glob.glob(pa.grass7Dir + "/etc/*/*"))
+
+    for exe in exes:
+        if not os.path.isdir(exe):
+            if not os.path.islink(exe):
+                print("Patching " + exe)
+                binaryDependencies = otool.get_binary_dependencies(pa.qgisApp, exe)
+                # Python.framework/Versions/Current/bin/idle3 is not a Mach-O file,
+                # such files are skipped by the plan
+                relinkPlan.add(exe, binaryDependencies)
+
+                exeDir = os.path.dirname(exe)
+                # as we use @executable_path everywhere,
+                # there is a problem
+                # because QGIS and bin/* is different directory
+                if not os.path.exists(exeDir + "/lib"):
+                    cp.symlink(os.path.relpath(pa.libDir, exeDir), exeDir + "/lib")
+                testLink = os.path.realpath(exeDir + "/lib")
+                if testLink != os.path.realpath(pa.libDir):
+                    raise QGISBundlerError("invalid lib link!")
+
+                # we need to create symlinks to Frameworks, so for example python does not pick system Python 2.7 dylibs
+                # https://github.com/lutraconsulting/qgis-mac-packager/issues/60
+                if not os.path.exists(exeDir + "/../Frameworks"):
+                    cp.symlink(os.path.relpath(pa.frameworksDir, os.path.join(exeDir, os.pardir) ), exeDir + "/../Frameworks")
+                testLink = os.path.realpath(exeDir + "/../Frameworks")
+                if testLink != os.path.realpath(pa.frameworksDir):
+                    raise QGISBundlerError("invalid frameworks link!")
+
+            else:
+                print("Skipping link " + exe)
+
+    print(relinkPlan.summary())
+    print("Saving relink plan to " + relinkPlanFile)
+    relinkPlan.save(relinkPlanFile)
+    if args.plan_only:
+        global stopRequested
+        print("Plan only, stopping before applying the relink plan")
+        stopRequested = True
+        return
+
+    print("Applying relink plan")
+    relinkPlan.apply(args.jobs)
+    relinkPlan.save(relinkPlanFile)
+
+
+def step_fix_hardcoded_paths():
+    qcaDir = state["qcaDir"]
+
+    print("Fix QCA_PLUGIN_PATH Qt Plugin path")
+    # It looks like that QCA compiled with QCA_PLUGIN_PATH CMake define
+    # adds this by default to QT_PLUGIN_PATH. Overwrite this
+    # in resulting binary library
+    qcaLib = os.path.join(pa.frameworksDir, "qca-qt5.framework", "qca-qt5")
+    binpatch.patch_binary(qcaLib, [(qcaDir + "/lib/qt5/plugins", qcaDir + "/xxx/xxx/plugins")])
+    if binpatch.find_strings(qcaLib, qcaDir + "/lib/qt5/plugins"):
+        raise QGISBundlerError("Failed to patch " + qcaLib)
+
+    # saga_cmd has hardcoded path to /usr/local to search for the tools and shared folder
+    saga_ver = "2.3.2_1"
+    sagaLibHost = "/usr/local/Cellar/osgeo-saga-lts/{}/lib/saga".format(saga_ver)
+    sagaShareHost = "/usr/local/Cellar/osgeo-saga-lts/{}/share/saga".format(saga_ver)
+    if not os.path.exists(sagaLibHost):
+        raise QGISBundlerError("Maybe SAGA was updated?")
+
+    basePathForLinks = pa.installQgisApp + "/Contents/Resources"
+    # we need to replace with the string with same length
+    if len(basePathForLinks + "/") < len(sagaLibHost):
+        link_length = len(sagaLibHost) - len(basePathForLinks +  "/")
+        sagaLibDir = ""
+        sagaLibDir += link_length * "a"
+        sagaLibInstall = basePathForLinks + "/" + sagaLibDir
+        print("patching SAGA shared data with " + sagaLibInstall)
+        cp.symlink(os.path.relpath(pa.sagaDataDir + "/tools", pa.resourcesDir), pa.resourcesDir + "/" + sagaLibDir)
+    else:
+        raise QGISBundlerError("Unable to modify install path for SAGA lib folder")
+
+    # we need to replace with the string with same length
+    if len(basePathForLinks + "/") < len(sagaShareHost):
+        link_length = len(sagaShareHost) - len(basePathForLinks + "/" )
+        sagaShareDir = ""
+        sagaShareDir += link_length * "b"
+        sagaShareInstall = basePathForLinks + "/" + sagaShareDir
+        print("patching SAGA shared data with " + sagaShareInstall)
+        cp.symlink(os.path.relpath(pa.sagaDataDir, pa.resourcesDir), pa.resourcesDir + "/" + sagaShareDir)
     else:
-        print("Skipping link " + lib)
-
-print(100*"*")
-print("STEP 6: Fix executables linker paths")
-print(100*"*")
-exes = set()
-exes.add(pa.qgisExe)
-exes |= set(glob.glob(pa.frameworksDir + "/Python.framework/Versions/Current/bin/*"))
-exes |= set(glob.glob(pa.frameworksDir + "/Python.framework/Versions/Current/Resources/Python.app/Contents/MacOS/Python"))
-exes |= set(glob.glob(pa.binDir + "/*"))
-exes |= set(glob.glob(pa.grass7Dir + "/bin/*"))
-exes |= set(glob.glob(pa.grass7Dir + "/driver/db/*"))
-exes |= set(glob.glob(pa.grass7Dir + "/etc/*"))
-exes |= set(glob.glob(pa.grass7Dir + "/etc/*/*"))
-
-for exe in exes:
-    if not os.path.isdir(exe):
-        if not os.path.islink(exe):
-            print("Patching " + exe)
-            binaryDependencies = otool.get_binary_dependencies(pa.qgisApp, exe)
-            try:
-                install_name_tool.fix_lib(exe, binaryDependencies, pa.contentsDir, libPatchedPath, relLibPathToFramework)
-            except subprocess.CalledProcessError:
-                # Python.framework/Versions/Current/bin/idle3 is not a Mach-O file ??
-                pass
-            subprocess.call(['chmod', '+x', exe])
-
-            exeDir = os.path.dirname(exe)
-            # as we use @executable_path everywhere,
-            # there is a problem
-            # because QGIS and bin/* is different directory
-            if not os.path.exists(exeDir + "/lib"):
-                cp.symlink(os.path.relpath(pa.libDir, exeDir), exeDir + "/lib")
-            testLink = os.path.realpath(exeDir + "/lib")
-            if testLink != os.path.realpath(pa.libDir):
-                raise QGISBundlerError("invalid lib link!")
-
-            # we need to create symlinks to Frameworks, so for example python does not pick system Python 2.7 dylibs
-            # https://github.com/lutraconsulting/qgis-mac-packager/issues/60
-            if not os.path.exists(exeDir + "/../Frameworks"):
-                cp.symlink(os.path.relpath(pa.frameworksDir, os.path.join(exeDir, os.pardir) ), exeDir + "/../Frameworks")
-            testLink = os.path.realpath(exeDir + "/../Frameworks")
-            if testLink != os.path.realpath(pa.frameworksDir):
-                raise QGISBundlerError("invalid frameworks link!")
+        raise QGISBundlerError("Unable to modify install path for SAGA shared folder")
+
+    # we need to replace same number of bytes to not breakup the binary
+    sagaBin = os.path.join(pa.binDir, "saga_cmd")
+    binpatch.patch_binary(sagaBin, [(sagaLibHost, sagaLibInstall),
+                                    (sagaShareHost, sagaShareInstall)])
+    if binpatch.find_strings(sagaBin, "osgeo-saga-lts"):
+        raise QGISBundlerError("Failed to patch " + sagaBin)
+
+    # report all remaining hardcoded paths to brew packages
+    binaries = [path for path, entry in bundleIndex.entries.items()
+                if not entry.is_dir and not entry.is_link and entry.classify() == utils.FILE_MACHO]
+    leftovers = binpatch.scan_binaries(binaries, "/usr/local/Cellar", args.jobs)
+    for path, found in sorted(leftovers.items()):
+        for offset, string in found:
+            print("WARNING: hardcoded path in {} at {}: {}".format(path, offset, string))
+    print("Found {} hardcoded /usr/local/Cellar strings in {} of {} binaries".format(
+        sum(len(found) for found in leftovers.values()), len(leftovers), len(binaries)))
+
+    # unlink in lib/saga because here SAGA_MLB variable points in QGIS SAGA processing script
+    if os.path.exists(pa.libDir + "/saga"):
+        raise QGISBundlerError("Extra dir in lib/saga")
+
+
+def step_extra_links():
+    # PROJ
+    projLib = "libproj.13.dylib"
+    if not os.path.exists(pa.libDir + "/" + projLib):
+        raise QGISBundlerError("Proj lib not present " + projLib + ". Maybe it has new version?")
+    cp.symlink(projLib, pa.libDir + "/libproj.dylib")
+
+    # GRASS7
+    link = pa.grass7Dir + "/lib"
+    if os.path.exists(link) and not os.path.islink(link):
+        raise QGISBundlerError(link + " should have been deleted during grass7 copy.")
+    cp.symlink(os.path.relpath(pa.libDir, pa.grass7Dir), link)
+    cp.remove(pa.grass7Dir + "/grass.sh")
+    cp.symlink("bin/grass76", pa.grass7Dir + "/grass.sh")
+    cp.remove(pa.grass7Dir + "/grass76.sh")
+    cp.symlink("bin/grass76", pa.grass7Dir + "/grass76.sh")
+
+
+def step_clean():
+    clean_redundant_files(pa, cp)
+
+
+def step_patch_files():
+    if cp.sync:
+        patch_files(pa, args.min_os, bundleIndex, cp.sync.is_changed, cp.sync.is_copied)
+    elif "copy" in stepsRun:
+        patch_files(pa, args.min_os, bundleIndex)
+    else:
+        # resumed without manifest, all files are from the previous run
+        patch_files(pa, args.min_os, bundleIndex, is_copied=lambda path: False)
+
+
+def step_zip_stdlib():
+    if not args.zip_stdlib:
+        print("Skipped, use --zip_stdlib")
+        return
+
+    bundledPython = os.path.join(pa.binDir, "python3")
+    pythonLibDir = os.path.realpath(pa.frameworksDir + "/Python.framework/Versions/Current/lib")
+    stdlibDir = os.path.join(pythonLibDir, "python3.7")
+    # same name as in default sys.path, e.g. lib/python37.zip
+    zipPath = os.path.join(pythonLibDir, "python37.zip")
+    sitePackages = [p for p in args.zip_site_packages.split(",") if p]
+
+    items = python_zip_items(pa, stdlibDir, sitePackages, zipped_python_items(zipPath))
+    if not items:
+        # e.g. incremental or resumed run, the sources are already zipped
+        print("Python modules already zipped in " + zipPath)
+        return
+    # compare with the loose modules with .pyc, the zip contains .pyc too.
+    # The loose sources (and their .pyc) are removed after zipping
+    precompile_python(pa, bundledPython, items, args.pyc_optimize, args.jobs)
+    before = measure_python_startup(pa, bundledPython, args.pyc_optimize)
+    zip_python_modules(pa, cp, bundledPython, items, zipPath, args.pyc_optimize, args.jobs)
+    bundleIndex.add(zipPath)
+    after = measure_python_startup(pa, bundledPython, args.pyc_optimize)
+
+    if before is not None and after is not None:
+        print("Python imports: {:.3f} s with loose stdlib and .pyc, {:.3f} s with zipped stdlib".format(before, after))
+        state["python_zip_imports"] = {"loose": before, "zipped": after}
+
+
+def step_precompile():
+    if not args.precompile:
+        print("Skipped, use --precompile")
+        return
+
+    # bytecode must match the bundled python version, so use the bundled interpreter
+    bundledPython = os.path.join(pa.binDir, "python3")
+    stdlibDir = os.path.realpath(pa.frameworksDir + "/Python.framework/Versions/Current/lib/python3.7")
+
+    before = measure_python_startup(pa, bundledPython, args.pyc_optimize)
+    precompile_python(pa, bundledPython, [stdlibDir, pa.pythonDir], args.pyc_optimize, args.jobs)
+    after = measure_python_startup(pa, bundledPython, args.pyc_optimize)
+
+    for d in [stdlibDir, pa.pythonDir]:
+        bundleIndex.add(d)
+
+    if before is not None and after is not None:
+        print("Python startup: {:.3f} s without .pyc, {:.3f} s with .pyc, saved {:.3f} s".format(before, after, before - after))
+        state["python_startup"] = {"without_pyc": before, "with_pyc": after}
+
+
+def step_startup_path():
+    # after zip_stdlib, the zip is in sys.path only when it exists
+    bundledPython = os.path.join(pa.binDir, "python3")
+    startupScript = os.path.join(pa.pythonDir, "pyqgis-startup.py")
+    prefix, sysPath = bundle_sys_path(pa, bundledPython)
+    if sysPath is None:
+        print("WARNING: sys.path is filtered at runtime by " + startupScript)
+        return
+    for pth in sysPath:
+        print("  " + pth)
+    write_startup_sys_path(startupScript, prefix, sysPath)
+    bundleIndex.add(startupScript)
+
+
+def step_test():
+    test_full_tree_consistency(pa, bundleIndex)
+
+
+STEPS = [
+    ("copy", "Copy QGIS and independent folders to build folder", step_copy),
+    ("analyze", "Analyze the libraries we need to bundle", step_analyze),
+    ("prune", "Find libraries not loaded by any entry point", step_prune),
+    ("copy_libs", "Copy libraries/plugins to bundle", step_copy_libs),
+    ("copy_frameworks", "Copy frameworks to bundle", step_copy_frameworks),
+    ("dedup", "Replace identical libraries by links", step_dedup),
+    ("fix_frameworks", "Fix frameworks linker paths", step_fix_frameworks),
+    ("fix_libs", "Fix libraries/plugins linker paths", step_fix_libs),
+    ("fix_executables", "Fix executables linker paths", step_fix_executables),
+    ("fix_hardcoded_paths", "Fix hardcoded paths in binaries", step_fix_hardcoded_paths),
+    ("extra_links", "Create some extra links", step_extra_links),
+    ("clean", "Clean redundant files", step_clean),
+    ("patch_files", "Patch files", step_patch_files),
+    ("zip_stdlib", "Zip python standard library", step_zip_stdlib),
+    ("precompile", "Precompile python bytecode", step_precompile),
+    ("startup_path", "Precompute python sys.path", step_startup_path),
+    ("test", "Test full tree QGIS.app", step_test),
+]
 
-        else:
-            print("Skipping link " + exe)
-            subprocess.call(['chmod', '+x', exe])
-
-print(100*"*")
-print("STEP 7: Fix hardcoded paths in binaries")
-print(100*"*")
-
-print("Fix QCA_PLUGIN_PATH Qt Plugin path")
-# It looks like that QCA compiled with QCA_PLUGIN_PATH CMake define
-# adds this by default to QT_PLUGIN_PATH. Overwrite this
-# in resulting binary library
-qcaLib = os.path.join(pa.frameworksDir, "qca-qt5.framework", "qca-qt5")
-f = open(qcaLib, 'rb+')
-data = f.read()
-data=data.replace(bytes(qcaDir + "/lib/qt5/plugins", "utf-8"), bytes(qcaDir + "/xxx/xxx/plugins", "utf-8"))
-f.seek(0)
-f.write(data)
-f.close()
-output = subprocess.check_output(["strings", qcaLib], encoding='UTF-8')
-if qcaLib in output:
-    raise QGISBundlerError("Failed to patch " + qcaLib)
-
-# saga_cmd has hardcoded path to /usr/local to search for the tools and shared folder
-saga_ver = "2.3.2_1"
-if not os.path.exists("/usr/local/Cellar/osgeo-saga-lts/{}/lib/saga".format(saga_ver)):
-    raise QGISBundlerError("Maybe SAGA was updated?")
-
-basePathForLinks = pa.installQgisApp + "/Contents/Resources"
-# we need to replace with the string with same length
-if len(basePathForLinks + "/") < len("/usr/local/Cellar/osgeo-saga-lts/{}/lib/saga".format(saga_ver)):
-    link_length = len("/usr/local/Cellar/osgeo-saga-lts/{}/lib/saga".format(saga_ver)) - len(basePathForLinks +  "/")
-    sagaLibDir = ""
-    sagaLibDir += link_length * "a"
-    sagaLibInstall = basePathForLinks + "/" + sagaLibDir
-    print("patching SAGA shared data with " + sagaLibInstall)
-    cp.symlink(os.path.relpath(pa.sagaDataDir + "/tools", pa.resourcesDir), pa.resourcesDir + "/" + sagaLibDir)
+
+# numbers of the steps before they got names, so --start_step N
+# still starts at the same step. New steps have no number
+LEGACY_STEP_NUMBERS = {
+    "0": "copy",
+    "1": "analyze",
+    "2": "copy_libs",
+    "3": "copy_frameworks",
+    "4": "fix_frameworks",
+    "5": "fix_libs",
+    "6": "fix_executables",
+    "7": "fix_hardcoded_paths",
+    "8": "extra_links",
+    "9": "clean",
+    "10": "patch_files",
+    "11": "test",
+}
+
+
+def step_number(name):
+    # step name or legacy number, e.g. patch_files or 10
+    name = LEGACY_STEP_NUMBERS.get(str(name), name)
+    for i, step in enumerate(STEPS):
+        if name == step[0]:
+            return i
+    raise QGISBundlerError("Unknown step " + name + ", use one of " + ", ".join(s[0] for s in STEPS))
+
+
+if args.only:
+    first = step_number(args.only)
+    last = first
 else:
-    raise QGISBundlerError("Unable to modify install path for SAGA lib folder")
-
-sagaBin = os.path.join(pa.binDir, "saga_cmd")
-f = open(sagaBin, 'rb+')
-data = f.read()
-# we need to replace same number of bytes to not breakup the lib
-if len("/usr/local/Cellar/osgeo-saga-lts/{}/lib/saga".format(saga_ver)) != len(sagaLibInstall):
-    raise QGISBundlerError("bad length  " + sagaLibInstall)
-data=data.replace(bytes("/usr/local/Cellar/osgeo-saga-lts/{}/lib/saga".format(saga_ver), "utf-8"),
-                  bytes(sagaLibInstall, "utf-8"))
-f.seek(0)
-f.write(data)
-f.close()
-
-# we need to replace with the string with same length
-if len(basePathForLinks + "/") < len("/usr/local/Cellar/osgeo-saga-lts/{}/share/saga".format(saga_ver)):
-    link_length = len("/usr/local/Cellar/osgeo-saga-lts/{}/share/saga".format(saga_ver)) - len(basePathForLinks + "/" )
-    sagaShareDir = ""
-    sagaShareDir += link_length * "b"
-    sagaShareInstall = basePathForLinks + "/" + sagaShareDir
-    print("patching SAGA shared data with " + sagaShareInstall)
-    cp.symlink(os.path.relpath(pa.sagaDataDir, pa.resourcesDir), pa.resourcesDir + "/" + sagaShareDir)
+    first = step_number(args.resume_from)
+    last = len(STEPS) - 1
+
+if first > 0:
+    # resume against existing bundle directory
+    state.load()
+    for step in STEPS[:first]:
+        if not state.is_done(step[0]):
+            raise QGISBundlerError("Unable to resume from " + STEPS[first][0] + ", step " + step[0] + " is not finished")
+    if STEPS[first][0] == "analyze" and any(state.is_done(s[0]) for s in STEPS[first + 1:]):
+        # the analysis must see the libraries as copied from the install tree
+        raise QGISBundlerError("Unable to resume from analyze, the bundle contains products of later steps, resume from copy")
+    state.invalidate([s[0] for s in STEPS[first:last + 1]])
+    # files in the bundle are from the previous run, so handle them
+    # same way as in incremental bundling
+    if os.path.exists(manifestFile):
+        cp.sync = IncrementalSync(manifestFile, True)
+        cp.sync.resume()
+    else:
+        print("No manifest from previous run (use --incremental to write it), all files are copied again")
+
+for i in range(first, last + 1):
+    name, title, step = STEPS[i]
+    print(100*"*")
+    print("STEP {}: {}".format(name, title))
+    print(100*"*")
+
+    if i > 0 and bundleIndex is None:
+        # from now on all steps use the index instead of walking the bundle
+        bundleIndex = BundleIndex(pa.qgisApp)
+        bundleIndex.build()
+        cp.index = bundleIndex
+
+    instrument.step_started(name)
+    stepsRun.add(name)
+    step()
+    instrument.step_finished(name)
+
+    # checkpoint, a stopped step is not finished, so it runs again on resume
+    if cp.sync:
+        cp.sync.save()
+    if stopRequested:
+        state.save()
+    else:
+        state.done(name)
+    instrument.save(reportFile)
+
+    if stopRequested:
+        last = i
+        break
+
+if depCache:
+    depCache.close()
+
+print("Steps:")
+instrument.print_summary()
+print("Saved report to " + reportFile)
+
+if stopRequested:
+    print("Stopped in step " + STEPS[last][0] + ", resume with --resume_from " + STEPS[last][0])
+elif last < len(STEPS) - 1:
+    print("Done with step " + STEPS[last][0])
 else:
-    raise QGISBundlerError("Unable to modify install path for SAGA shared folder")
-
-f = open(sagaBin, 'rb+')
-data = f.read()
-if len("/usr/local/Cellar/osgeo-saga-lts/{}/share/saga".format(saga_ver)) != len(sagaShareInstall):
-    raise QGISBundlerError("bad length  " + sagaShareInstall)
-data=data.replace(bytes("/usr/local/Cellar/osgeo-saga-lts/{}/share/saga".format(saga_ver), "utf-8"),
-                  bytes(sagaShareInstall, "utf-8"))
-f.seek(0)
-f.write(data)
-f.close()
-
-output = subprocess.check_output(["strings", sagaBin], encoding='UTF-8')
-if "osgeo-saga-lts" in output:
-    raise QGISBundlerError("Failed to patch " + sagaBin)
-
-# unlink in lib/saga because here SAGA_MLB variable points in QGIS SAGA processing script
-if os.path.exists(pa.libDir + "/saga"):
-    raise QGISBundlerError("Extra dir in lib/saga")
-
-
-print(100*"*")
-print("STEP 8: Create some extra links")
-print(100*"*")
-# PROJ
-projLib = "libproj.13.dylib"
-if not os.path.exists(pa.libDir + "/" + projLib):
-    raise QGISBundlerError("Proj lib not present " + projLib + ". Maybe it has new version?")
-cp.symlink(projLib, pa.libDir + "/libproj.dylib")
-
-# GRASS7
-link = pa.grass7Dir + "/lib"
-if os.path.exists(link):
-    raise QGISBundlerError(link + " should have been deleted during grass7 copy.")
-cp.symlink(os.path.relpath(pa.libDir, pa.grass7Dir), link)
-cp.remove(pa.grass7Dir + "/grass.sh")
-cp.symlink("bin/grass76", pa.grass7Dir + "/grass.sh")
-cp.remove(pa.grass7Dir + "/grass76.sh")
-cp.symlink("bin/grass76", pa.grass7Dir + "/grass76.sh")
-
-print(100*"*")
-print("STEP 9: Clean redundant files")
-print(100*"*")
-clean_redundant_files(pa, cp)
-
-print(100 * "*")
-print("STEP 10: Patch files")
-print(100 * "*")
-patch_files(pa, args.min_os)
-
-
-print(100 * "*")
-print("STEP 11: Test full tree QGIS.app")
-print(100 * "*")
-test_full_tree_consistency(pa)
-
-# Wow we are done!
-cpt = sum([len(files) for r, d, files in os.walk(pa.qgisApp)])
-print ("Done with files bundled " + str(cpt))
+    # Wow we are done!
+    cpt = len(bundleIndex.files())
+    print ("Done with files bundled " + str(cpt))
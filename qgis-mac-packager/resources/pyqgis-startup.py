@@ -20,12 +20,97 @@
 import sys
 import os
 
-sys.path[:] = (pth for pth in sys.path if not (pth.startswith('/Library/Python') or \
-pth.startswith('/Library/Frameworks') or \
-pth.startswith('/System/Library/Frameworks/Python.framework')))
+# sys.prefix and ordered sys.path of the bundled python, written by qgis_bundler.py.
+# None when the script is used outside of the bundle
+BUNDLE_PREFIX = None
+BUNDLE_SYS_PATH = None
 
-# make abs paths
-sys.path[:] = (os.path.abspath(pth) for pth in sys.path)
+SYSTEM_PYTHON_PATHS = ('/Library/Python',
+                       '/Library/Frameworks',
+                       '/System/Library/Frameworks/Python.framework')
 
-# remove duplicit entries
-sys.path = list(set(sys.path))
+
+def _filter_sys_path():
+    if BUNDLE_SYS_PATH is not None and sys.prefix == BUNDLE_PREFIX:
+        # entries not known at bundle time (e.g. added by user) go after the bundled ones
+        known = set(BUNDLE_SYS_PATH)
+        sys.path[:] = BUNDLE_SYS_PATH + [pth for pth in sys.path if pth not in known and not pth.startswith(SYSTEM_PYTHON_PATHS)]
+    else:
+        sys.path[:] = (pth for pth in sys.path if not pth.startswith(SYSTEM_PYTHON_PATHS))
+
+        # make abs paths
+        sys.path[:] = (os.path.abspath(pth) for pth in sys.path)
+
+        # zipped standard library (qgis_bundler.py --zip_stdlib) must be on the path
+        stdlib_zip = os.path.join(sys.prefix, "lib", "python{}{}.zip".format(*sys.version_info[:2]))
+        if os.path.exists(stdlib_zip) and stdlib_zip not in sys.path:
+            sys.path.insert(1, stdlib_zip)
+
+    # remove duplicit entries, keep the order so the zip is searched before stdlib directory
+    seen = set()
+    sys.path[:] = [pth for pth in sys.path if not (pth in seen or seen.add(pth))]
+
+
+# PYQGIS_IMPORTTIME=stderr or =<file> logs the imports done after this script,
+# like python -X importtime (PYTHONPROFILEIMPORTTIME) does for the interpreter startup.
+# Only import statements are covered (they call builtins.__import__), not
+# importlib.import_module or direct __import__ calls of other modules, nor submodules
+# loaded by "from package import submodule" when the package is already imported
+def _install_import_timer():
+    import atexit
+    import builtins
+    import importlib.util
+    import time
+
+    _import = builtins.__import__
+    if os.environ["PYQGIS_IMPORTTIME"] == "stderr":
+        _import_log = sys.stderr
+    else:
+        _import_log = open(os.environ["PYQGIS_IMPORTTIME"], "a", buffering=1)
+        atexit.register(_import_log.close)
+    # time spent in nested imports, for each import in progress
+    _import_stack = []
+
+    def _absolute_name(name, globals, level):
+        # name of the module of relative import, e.g. "from . import x" has empty name
+        if level == 0:
+            return name
+        globals = globals or {}
+        package = globals.get("__package__")
+        if package is None:
+            package = globals.get("__name__", "")
+            if "__path__" not in globals:
+                package = package.rpartition(".")[0]
+        try:
+            return importlib.util.resolve_name("." * level + name, package)
+        except (ImportError, ValueError):
+            # e.g. relative import beyond top level package, let the import fail
+            return None
+
+    def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        module = _absolute_name(name, globals, level)
+        if module is None or module in sys.modules:
+            return _import(name, globals, locals, fromlist, level)
+        _import_stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return _import(name, globals, locals, fromlist, level)
+        finally:
+            total = time.perf_counter() - start
+            nested = _import_stack.pop()
+            if _import_stack:
+                _import_stack[-1] += total
+            _import_log.write("import time: {:>10} | {:>10} | {}{}\n".format(int((total - nested) * 1e6),
+                                                                            int(total * 1e6),
+                                                                            "  " * len(_import_stack),
+                                                                            module))
+            _import_log.flush()
+
+    builtins.__import__ = _timed_import
+
+
+# the script is executed in __main__ of the QGIS python console, do not leave anything there
+_filter_sys_path()
+if os.environ.get("PYQGIS_IMPORTTIME"):
+    _install_import_timer()
+del _filter_sys_path, _install_import_timer, BUNDLE_PREFIX, BUNDLE_SYS_PATH, SYSTEM_PYTHON_PATHS
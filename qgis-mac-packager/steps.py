@@ -4,14 +4,24 @@ import os
 import qgisBundlerTools.otool as otool
 import qgisBundlerTools.utils as utils
 import qgisBundlerTools.install_name_tool as install_name_tool
+import qgisBundlerTools.instrument as instrument
+import qgisBundlerTools.pyimports as pyimports
+import glob
+import json
 import re
-
-
-class QGISBundlerError(Exception):
-    pass
-
-
-def _patch_file(pa, filepath, keyword, replace_from, replace_to):
+import shutil
+import tempfile
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from qgisBundlerTools.graph import DependencyGraph
+from qgisBundlerTools.rpath import RPathResolver
+from qgisBundlerTools.utils import QGISBundlerError
+
+
+def _patch_file(pa, filepath, keyword, replace_from, replace_to, is_copied=None):
+    # is_copied tells whether the file was copied from the install tree in this run,
+    # None for a new bundle, where all files are copied
     realpath = os.path.realpath(filepath)
     if not os.path.exists(realpath) or pa.qgisApp not in realpath:
         raise QGISBundlerError("Invalid file to patch " + filepath)
@@ -23,6 +33,10 @@ def _patch_file(pa, filepath, keyword, replace_from, replace_to):
         c = f.read()
 
         if keyword in c:
+            if is_copied is not None and not is_copied(filepath):
+                # kept from the previous run, so already patched
+                print("Skipping {}, {} already present".format(filepath, keyword))
+                return
             raise QGISBundlerError("Ups {} already present in info {}".format(keyword, filepath))
 
         c = c.replace(replace_from,
@@ -30,6 +44,7 @@ def _patch_file(pa, filepath, keyword, replace_from, replace_to):
 
     with open(filepath, "w") as f:
         f.write(c)
+    instrument.add_files()
 
     # check
     with open(filepath, "r") as f:
@@ -37,12 +52,14 @@ def _patch_file(pa, filepath, keyword, replace_from, replace_to):
         if keyword not in c:
             raise QGISBundlerError("Ups failed to add {} in info {}".format(keyword, filepath))
 
-def patch_files(pa, min_os):
-    patch_info_plist(pa, min_os)
-    patch_sqlite(pa)
-    patch_text_files(pa)
+@instrument.timed
+def patch_files(pa, min_os, index, is_changed=None, is_copied=None):
+    patch_info_plist(pa, min_os, is_copied)
+    patch_sqlite(pa, is_copied)
+    patch_text_files(pa, index, is_changed, is_copied)
 
-def patch_info_plist(pa, min_os):
+@instrument.timed
+def patch_info_plist(pa, min_os, is_copied=None):
     add_python_home = True
     add_python_start = True
     add_python_path = True
@@ -69,7 +86,8 @@ def patch_info_plist(pa, min_os):
         _patch_file(pa, infoplist,
                     identifier,
                     "org.qgis.qgis3",
-                    "org.qgis.{}".format(identifier)
+                    "org.qgis.{}".format(identifier),
+                    is_copied=is_copied
         )
 
     # Bundle name
@@ -77,7 +95,8 @@ def patch_info_plist(pa, min_os):
         _patch_file(pa, infoplist,
                     pa.installQgisAppName.replace(".app", ""),
                     "\t<key>CFBundleName</key>\n\t<string>QGIS</string>",
-                    "\t<key>CFBundleName</key>\n\t<string>{}</string>".format(pa.installQgisAppName.replace(".app", ""))
+                    "\t<key>CFBundleName</key>\n\t<string>{}</string>".format(pa.installQgisAppName.replace(".app", "")),
+                    is_copied=is_copied
         )
 
     # Bundle signature
@@ -85,7 +104,8 @@ def patch_info_plist(pa, min_os):
         _patch_file(pa, infoplist,
                     pa.installQgisAppName.replace(".app", ""),
                     "\t<key>CFBundleSignature</key>\n\t<string>QGIS</string>",
-                    "\t<key>CFBundleSignature</key>\n\t<string>{}</string>".format(pa.installQgisAppName.replace(".app", ""))
+                    "\t<key>CFBundleSignature</key>\n\t<string>{}</string>".format(pa.installQgisAppName.replace(".app", "")),
+                    is_copied=is_copied
         )
 
     # Minimum version
@@ -95,7 +115,8 @@ def patch_info_plist(pa, min_os):
                                "\t<key>CFBundleDevelopmentRegion</key>",
                                "\t<key>LSMinimumSystemVersion</key>\n" +
                                "\t<string>{}</string>\n".format(min_os) +
-                               "\t<key>CFBundleDevelopmentRegion</key>"
+                               "\t<key>CFBundleDevelopmentRegion</key>",
+                               is_copied=is_copied
                                )
 
     # LSFileQuarantineEnabled
@@ -105,7 +126,8 @@ def patch_info_plist(pa, min_os):
                                "\t<key>CFBundleDevelopmentRegion</key>",
                                "\t<key>LSFileQuarantineEnabled</key>\n" +
                                "\t<false/>\n".format(min_os) +
-                               "\t<key>CFBundleDevelopmentRegion</key>"
+                               "\t<key>CFBundleDevelopmentRegion</key>",
+                               is_copied=is_copied
                                )
 
     # Python Start
@@ -115,7 +137,8 @@ def patch_info_plist(pa, min_os):
                                "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
                                "\t\t<key>PYQGIS_STARTUP</key>\n" +
                                "\t\t<string>{}/Resources/python/pyqgis-startup.py</string>\n".format(destContents) +
-                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>"
+                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
+                               is_copied=is_copied
                                )
 
     # Python Home
@@ -125,7 +148,8 @@ def patch_info_plist(pa, min_os):
                                "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
                                "\t\t<key>PYTHONHOME</key>\n" +
                                "\t\t<string>{}/Frameworks/Python.framework/Versions/Current</string>\n".format(destContents) +
-                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>"
+                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
+                               is_copied=is_copied
                                )
 
     # Python path
@@ -135,7 +159,8 @@ def patch_info_plist(pa, min_os):
                                "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
                                "\t\t<key>PYTHONPATH</key>\n" +
                                "\t\t<string>{}/Resources/python</string>\n".format(destContents) +
-                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>"
+                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
+                               is_copied=is_copied
                                )
 
     # qgis prefix
@@ -145,7 +170,8 @@ def patch_info_plist(pa, min_os):
                                "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
                                "\t\t<key>QGIS_PREFIX_PATH</key>\n" +
                                "\t\t<string>{}/MacOS</string>\n".format(destContents) +
-                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>"
+                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
+                               is_copied=is_copied
                                )
 
     # Grass7 folder
@@ -156,7 +182,8 @@ def patch_info_plist(pa, min_os):
                     grass7pyfile,
                     destGrass7Dir,
                     "'/Applications/GRASS-7.{}.app/Contents/MacOS'.format(version)",
-                    "'{}'".format(destGrass7Dir))
+                    "'{}'".format(destGrass7Dir),
+                    is_copied=is_copied)
 
 
     # fix GDAL paths
@@ -166,7 +193,8 @@ def patch_info_plist(pa, min_os):
                                "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
                                "\t\t<key>GDAL_DRIVER_PATH</key>\n" +
                                "\t\t<string>{}</string>\n".format(pa.gdalPluginsInstall) +
-                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>"
+                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
+                               is_copied=is_copied
                                )
 
         _patch_file(pa, infoplist,
@@ -174,7 +202,8 @@ def patch_info_plist(pa, min_os):
                                "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
                                "\t\t<key>GDAL_DATA</key>\n" +
                                "\t\t<string>{}</string>\n".format(pa.gdalShareInstall) +
-                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>"
+                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
+                               is_copied=is_copied
                                )
 
     # fix PROJ paths
@@ -184,7 +213,8 @@ def patch_info_plist(pa, min_os):
                                "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
                                "\t\t<key>PROJ_LIB</key>\n" +
                                "\t\t<string>{}/Resources/proj/proj</string>\n".format(destContents) +
-                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>"
+                               "\t\t<key>QT_AUTO_SCREEN_SCALE_FACTOR</key>",
+                               is_copied=is_copied
                                )
 
     # fix for Retina displays
@@ -195,7 +225,8 @@ def patch_info_plist(pa, min_os):
             raise QGISBundlerError("Missing {} in info {}".format(keyword, infoplist))
 
 
-def patch_sqlite(pa):
+@instrument.timed
+def patch_sqlite(pa, is_copied=None):
     destContents = pa.installQgisApp + "/Contents"
     # Fix sqlite module
     qgis_utils_file = os.path.join(pa.pythonDir, "qgis/utils.py")
@@ -204,11 +235,13 @@ def patch_sqlite(pa):
     _patch_file(pa, qgis_utils_file,
                 spatialite_mod_path,
                 "\"mod_spatialite\"",
-                "\"" + spatialite_mod_path + "\""
+                "\"" + spatialite_mod_path + "\"",
+                is_copied=is_copied
                 )
 
 
-def patch_text_files(pa):
+@instrument.timed
+def patch_text_files(pa, index, is_changed=None, is_copied=None):
     # First patch GRASS7 shell script
     grass_ver = "osgeo-grass/7.6.0_1"
     grass7file = pa.grass7Dir + "/bin/grass76"
@@ -223,7 +256,8 @@ $GRASS_PYTHON XXX/Contents/Resources/grass7/bin/_grass76 $@
                 grass7file,
                 "MANPATH",
                 "GRASS_PYTHON=python2 exec /usr/local/Cellar/" +grass_ver+ "/libexec/bin/grass76",
-                toreplace)
+                toreplace,
+                is_copied=is_copied)
 
     # now crowl and replace in all other files
     replacements = [
@@ -241,9 +275,12 @@ $GRASS_PYTHON XXX/Contents/Resources/grass7/bin/_grass76 $@
         # "/usr/local" + "~~>" + pa.installQgisApp
     ]
 
-    for root, dirs, files in os.walk(pa.qgisApp):
+    for root, dirs, files in index.walk():
         for file in files:
             filepath = os.path.join(root, file)
+            # in incremental mode files kept from previous run are already patched
+            if is_changed and not is_changed(filepath):
+                continue
             if utils.is_text(filepath):
                 try:
                     with open(filepath, "r") as fh:
@@ -258,16 +295,18 @@ $GRASS_PYTHON XXX/Contents/Resources/grass7/bin/_grass76 $@
                         print("Patching text file " + filepath)
                         with open(filepath, "w") as fh:
                             fh.write(text)
+                        instrument.add_files()
                 except Exception as e:
                     # print("Failed to patch " + filepath )
                     pass
 
 
+@instrument.timed
 def append_recursively_site_packages(cp, sourceDir, destDir):
     for item in os.listdir(sourceDir):
         s = os.path.join(sourceDir, item)
         d = os.path.join(destDir, item)
-        if os.path.exists(d):
+        if cp.exists(d):
             print("Skipped " + d)
             continue
         else:
@@ -298,16 +337,424 @@ def append_recursively_site_packages(cp, sourceDir, destDir):
                     print("packaging also site-package " + dirname)
                     append_recursively_site_packages(cp, dirname, destDir)
 
-            if not os.path.exists(d):
+            if not cp.exists(d):
                 cp.copy(s, d)
 
 
+@instrument.timed
+def copy_selected_site_packages(pa, cp, sourceDir, destDir, allowlist):
+    # copy only packages reachable by imports from QGIS python, GRASS and GDAL scripts
+    sitePackages = pyimports.SitePackages(sourceDir)
+
+    # in incremental mode destDir contains site-packages from the previous run
+    roots = [os.path.join(destDir, item) for item in os.listdir(destDir) if item not in sitePackages.items]
+    roots += [pa.grass7Dir + "/etc/python", pa.grass7Dir + "/scripts", pa.gdalDataDir + "/bin"]
+    roots = [r for r in roots if os.path.exists(r)]
+
+    selected = sitePackages.closure(roots, allowlist)
+    for item, s in sitePackages.items.items():
+        d = os.path.join(destDir, item)
+        if item not in selected:
+            print("Not needed " + d)
+            continue
+        if cp.exists(d):
+            print("Skipped " + d)
+            continue
+        print(" Copied " + d + " (" + os.path.basename(sitePackages.reasons[item]) + ")")
+
+        if os.path.isdir(s):
+            # hard copy - no symlinks
+            cp.copytree(s, d, False)
+
+            if os.path.exists(d + "/.dylibs"):
+                print("Removing extra " + d + "/.dylibs")
+                cp.rmtree(d + "/.dylibs")
+        else:
+            cp.copy(s, d)
+
+    copiedFiles, copiedBytes = sitePackages.size(selected)
+    savedFiles, savedBytes = sitePackages.size(set(sitePackages.items) - selected)
+    print("Selective site-packages: copied {} of {} items, {} files ({:.1f} MB), "
+          "saved {} files ({:.1f} MB) compared to copy-all".format(len(selected),
+                                                                   len(sitePackages.items),
+                                                                   copiedFiles,
+                                                                   copiedBytes / 1024.0 / 1024.0,
+                                                                   savedFiles,
+                                                                   savedBytes / 1024.0 / 1024.0))
+
+
+@instrument.timed
+def deduplicate_libraries(pa, cp, index):
+    # identical libraries (e.g. PyQt5 modules in PlugIns and Resources/python,
+    # GRASS libs) are kept once, the other copies are replaced by relative links.
+    # Frameworks are left alone, they must stay self-contained for signing
+    bySize = {}
+    for path, entry in index.entries.items():
+        if entry.is_dir or entry.is_link or ".framework/" in path:
+            continue
+        if path.endswith((".so", ".dylib")):
+            bySize.setdefault(entry.size, []).append(path)
+
+    groups = {}
+    for size, paths in bySize.items():
+        if len(paths) < 2:
+            continue
+        for path in paths:
+            groups.setdefault((size, utils.cached_file_digest(path)), []).append(path)
+
+    saved = 0
+    replaced = 0
+    for (size, digest), paths in sorted(groups.items()):
+        if len(paths) < 2:
+            continue
+        # prefer the copy in MacOS/lib, then the shortest path
+        paths = sorted(paths, key=lambda p: (os.path.dirname(p) != pa.libDir, len(p), p))
+        canonical = paths[0]
+        for path in paths[1:]:
+            print("Deduplicating " + path + " -> " + canonical)
+            cp.remove(path)
+            cp.symlink(os.path.relpath(canonical, os.path.dirname(path)), path)
+            saved += size
+            replaced += 1
+
+    print("Deduplication: replaced {} files by links, saved {:.1f} MB".format(replaced, saved / 1024.0 / 1024.0))
+
+
+# libraries loaded by dlopen (QLibrary in QGIS and Qt, sqlite extensions,
+# ctypes in python packages, ...), they are not in the load commands of any binary
+DLOPEN_ALLOWLIST = ["libqgispython",  # QgsPythonUtils loaded by QGIS app
+                    "libssl", "libcrypto",  # QSslSocket
+                    "mod_spatialite",
+                    "libgeos_c",
+                    "libspatialindex", "libspatialindex_c",
+                    "libproj",
+                    "libgdal"]
+
+
+def _library_stem(name):
+    # libproj.13.dylib -> proj, mod_spatialite.dylib -> mod_spatialite
+    stem = os.path.basename(name).split(".")[0]
+    if stem.startswith("lib"):
+        stem = stem[3:]
+    return stem
+
+
+@instrument.timed
+def find_unreachable_libraries(graph, pluginDirs, allowlist):
+    # libraries in the dependency graph not loaded (transitively) by any entry point.
+    # Entry points are executables, python extension modules, plugins,
+    # frameworks (they are always bundled whole) and allowlisted libraries
+    allowlistStems = set(_library_stem(a) for a in allowlist)
+    roots = set()
+    for path, type in graph.nodes.items():
+        if type in [otool.BINARY, otool.FRAMEWORK] or path.endswith(".so"):
+            roots.add(path)
+        elif any(path.startswith(d + "/") for d in pluginDirs):
+            roots.add(path)
+        elif _library_stem(path) in allowlistStems:
+            roots.add(path)
+
+    reachable = graph.closure(roots)
+    return sorted(p for p, type in graph.nodes.items() if type == otool.LIB and p not in reachable)
+
+
+# modules imported to measure python startup, failing imports are reported
+STARTUP_PROBE_MODULES = ["encodings", "json", "logging.handlers", "email.mime.text", "xml.dom.minidom",
+                         "urllib.request", "http.client", "sqlite3", "unittest", "asyncio",
+                         "PyQt5", "qgis", "processing", "numpy"]
+
+
+def _optimize_flags(optimize):
+    # python3.7 compileall has no optimize argument, -O of the interpreter is used
+    return ["-O"] * optimize
+
+
+@instrument.timed
+def measure_python_startup(pa, interpreter, optimize, runs=3):
+    # best time of importing the probe modules with the bundled interpreter
+    # from the bundled tree, .pyc are not written
+    pythonHome = os.path.realpath(pa.frameworksDir + "/Python.framework/Versions/Current")
+    env = dict(os.environ,
+               PYTHONHOME=pythonHome,
+               PYTHONPATH=pa.pythonDir,
+               PYTHONDONTWRITEBYTECODE="1")
+    # last two lines of the output are the failed imports and the time
+    script = ("import time\n"
+              "failed = []\n"
+              "t = time.perf_counter()\n"
+              "for m in {}:\n"
+              "    try:\n"
+              "        __import__(m)\n"
+              "    except Exception as err:\n"
+              "        failed.append(m + ' (' + type(err).__name__ + ': ' + str(err).replace('\\n', ' ') + ')')\n"
+              "t = time.perf_counter() - t\n"
+              "print(', '.join(failed))\n"
+              "print(t)\n").format(repr(STARTUP_PROBE_MODULES))
+    best = None
+    for i in range(runs):
+        try:
+            output = subprocess.check_output([interpreter, "-B"] + _optimize_flags(optimize) + ["-c", script],
+                                             env=env, stderr=subprocess.DEVNULL, encoding='UTF-8')
+            lines = output.rstrip("\n").split("\n")
+            failed = lines[-2]
+            t = float(lines[-1])
+        except (subprocess.CalledProcessError, OSError, ValueError, IndexError) as err:
+            print("WARNING: unable to measure python startup: " + str(err))
+            return None
+        if i == 0 and failed:
+            print("WARNING: python startup probe failed to import " + failed)
+        if best is None or t < best:
+            best = t
+    return best
+
+
+@instrument.timed
+def precompile_python(pa, interpreter, paths, optimize, jobs):
+    # deterministic .pyc files, validated by hash of the source instead of mtime,
+    # with the install location (/Applications/...) as the source path.
+    # Files in the same directory are compiled together, compileall -d
+    # is the directory of the file arguments and the directory argument itself
+    env = dict(os.environ, PYTHONHASHSEED="0")
+    groups = []
+    files = {}
+    for path in paths:
+        if os.path.isdir(path):
+            groups.append((path, [path]))
+        elif path.endswith(".py"):
+            files.setdefault(os.path.dirname(path), []).append(path)
+    for d in sorted(files.keys()):
+        groups.append((d, files[d]))
+
+    for d, targets in groups:
+        print("Precompiling " + (d if targets == [d] else "{} files in {}".format(len(targets), d)))
+        installDir = d.replace(pa.qgisApp, pa.installQgisApp)
+        args = [interpreter] + _optimize_flags(optimize) + ["-m", "compileall",
+                                                            "-q",
+                                                            "-j", str(jobs),
+                                                            "--invalidation-mode", "checked-hash",
+                                                            # site-packages of Python.framework is link to Resources/python
+                                                            "-x", "/site-packages/",
+                                                            "-d", installDir] + targets
+        if subprocess.call(args, env=env) != 0:
+            # e.g. python2 scripts in GRASS
+            print("WARNING: some files in " + d + " failed to compile")
+
+
+# stdlib items which must stay on disk: extension modules, site-packages,
+# data files read by path and os.py which python uses to find sys.prefix
+STDLIB_KEEP_ON_DISK = ["lib-dynload", "site-packages", "ensurepip", "idlelib", "lib2to3", "test",
+                       "turtledemo", "venv", "__pycache__"]
+STDLIB_LANDMARK = "os.py"
+
+
+def _is_pure_python(path):
+    if os.path.isfile(path):
+        return path.endswith(".py")
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            if name.endswith((".so", ".dylib")):
+                return False
+    return True
+
+
+def _data_files(path):
+    # files of the package which are not python sources, packages often
+    # read them by path relative to __file__ (e.g. cacert.pem of certifi)
+    data = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if d != "__pycache__"]
+        for name in files:
+            if not name.endswith((".py", ".pyc", ".pyi")) and name != "py.typed":
+                data.append(os.path.relpath(os.path.join(root, name), path))
+    return sorted(data)
+
+
+def _write_zip(zipPath, sourceDir):
+    # deterministic stored zip, zipimport then does not need zlib
+    entries = []
+    for root, dirs, files in os.walk(sourceDir):
+        for name in files:
+            entries.append(os.path.join(root, name))
+    with zipfile.ZipFile(zipPath, "w", zipfile.ZIP_STORED) as zf:
+        for path in sorted(entries):
+            info = zipfile.ZipInfo(os.path.relpath(path, sourceDir), date_time=(1980, 1, 1, 0, 0, 0))
+            info.external_attr = 0o644 << 16
+            with open(path, "rb") as f:
+                zf.writestr(info, f.read())
+    return len(entries)
+
+
+def _has_files(path):
+    if os.path.isfile(path):
+        return True
+    for root, dirs, files in os.walk(path):
+        if files:
+            return True
+    return False
+
+
+def zipped_python_items(zipPath):
+    # top level modules and packages in the zip, e.g. os.py and json
+    if not os.path.exists(zipPath):
+        return set()
+    with zipfile.ZipFile(zipPath) as zf:
+        return set(name.split("/")[0] for name in zf.namelist() if not name.endswith(".pyc"))
+
+
+def python_zip_items(pa, stdlibDir, sitePackages, zipped):
+    # pure python stdlib modules and packages and selected site-packages
+    # from Resources/python, which can be imported from the zip.
+    # zipped are the items already in the zip (see zipped_python_items), the zip is
+    # the only copy of them after the sources were removed. Empty list when there is nothing to zip
+    items = []
+    for item in sorted(os.listdir(stdlibDir)):
+        path = os.path.join(stdlibDir, item)
+        if item in STDLIB_KEEP_ON_DISK or item.startswith("config-") or os.path.islink(path):
+            continue
+        if _has_files(path) and _is_pure_python(path):
+            items.append(path)
+    for item in sitePackages:
+        path = os.path.join(pa.pythonDir, item)
+        if not os.path.exists(path) and os.path.exists(path + ".py"):
+            path += ".py"
+        if not os.path.exists(path) or not _has_files(path):
+            if item in zipped or item + ".py" in zipped:
+                # zipped by the previous (e.g. incremental or resumed) run
+                continue
+            raise QGISBundlerError("Missing python package " + path)
+        if not _is_pure_python(path):
+            print("WARNING: " + item + " has extension modules, not zipped")
+            continue
+        data = _data_files(path) if os.path.isdir(path) else []
+        if data:
+            print("WARNING: " + item + " has data files, which may be read from the file system, not zipped: " +
+                  ", ".join(data[:5]) + (", ..." if len(data) > 5 else ""))
+            continue
+        items.append(path)
+
+    if STDLIB_LANDMARK in zipped and all(os.path.basename(p) == STDLIB_LANDMARK for p in items):
+        # the landmark always stays on disk too
+        return []
+    return items
+
+
+def _overlay_tree(src, dest):
+    # copies src over the existing dest, without the bytecode
+    for root, dirs, files in os.walk(src):
+        dirs[:] = [d for d in dirs if d != "__pycache__"]
+        destRoot = os.path.join(dest, os.path.relpath(root, src))
+        if not os.path.exists(destRoot):
+            os.makedirs(destRoot)
+        for name in files:
+            if not name.endswith(".pyc"):
+                shutil.copy2(os.path.join(root, name), os.path.join(destRoot, name))
+
+
+@instrument.timed
+def zip_python_modules(pa, cp, interpreter, items, zipPath, optimize, jobs):
+    # packs the items (see python_zip_items) with .pyc files to zipPath,
+    # which is on default sys.path before stdlib directory.
+    # Sources already in the existing zip are kept, the items are added over them
+    staging = tempfile.mkdtemp(prefix="qgis-bundler-zip")
+    try:
+        if os.path.exists(zipPath):
+            with zipfile.ZipFile(zipPath) as zf:
+                zf.extractall(staging, [name for name in zf.namelist() if not name.endswith(".pyc")])
+
+        for path in items:
+            dest = os.path.join(staging, os.path.basename(path))
+            if os.path.isdir(path):
+                _overlay_tree(path, dest)
+            else:
+                shutil.copy2(path, dest)
+
+        # legacy .pyc next to .py, zipimport does not look to __pycache__.
+        # Unchecked hash, because zipimport does not validate checked hash-based .pyc
+        args = [interpreter] + _optimize_flags(optimize) + ["-m", "compileall",
+                                                            "-b",
+                                                            "-q",
+                                                            "-j", str(jobs),
+                                                            "--invalidation-mode", "unchecked-hash",
+                                                            "-d", zipPath.replace(pa.qgisApp, pa.installQgisApp),
+                                                            staging]
+        if subprocess.call(args, env=dict(os.environ, PYTHONHASHSEED="0")) != 0:
+            print("WARNING: some files in the zip failed to compile")
+
+        if os.path.exists(zipPath):
+            cp.remove(zipPath)
+        count = _write_zip(zipPath, staging)
+        instrument.add_files()
+    finally:
+        shutil.rmtree(staging)
+
+    for path in items:
+        if os.path.basename(path) != STDLIB_LANDMARK:
+            cp.rm(path)
+            if path.endswith(".py"):
+                # .pyc of the module in __pycache__ of its directory
+                stem = os.path.basename(path)[:-len(".py")]
+                for pyc in glob.glob(os.path.join(os.path.dirname(path), "__pycache__", stem + ".*.pyc")):
+                    cp.rm(pyc)
+    print("Zipped {} python modules and packages ({} files) to {} ({:.1f} MB)".format(
+        len(items), count, zipPath, os.path.getsize(zipPath) / 1024.0 / 1024.0))
+
+
+def bundle_sys_path(pa, interpreter):
+    # sys.prefix and sys.path of the bundled python with the Info.plist environment,
+    # only existing entries in the bundle, in install location
+    pythonHome = pa.frameworksDir + "/Python.framework/Versions/Current"
+    env = dict(os.environ,
+               PYTHONHOME=pythonHome,
+               PYTHONPATH=pa.pythonDir)
+    script = "import json, sys; print(json.dumps([sys.prefix] + sys.path))"
+    try:
+        output = subprocess.check_output([interpreter, "-s", "-c", script], env=env, encoding='UTF-8')
+        paths = json.loads(output.strip().split("\n")[-1])
+    except (subprocess.CalledProcessError, OSError, ValueError) as err:
+        print("WARNING: unable to get python sys.path: " + str(err))
+        return None, None
+
+    prefix = paths[0].replace(pa.qgisApp, pa.installQgisApp)
+    sysPath = []
+    for pth in paths[1:]:
+        # e.g. current directory or host python
+        if not pth.startswith(pa.qgisApp) or not os.path.exists(pth):
+            continue
+        pth = pth.replace(pa.qgisApp, pa.installQgisApp)
+        if pth not in sysPath:
+            sysPath.append(pth)
+    return prefix, sysPath
+
+
+def write_startup_sys_path(startupScript, prefix, sysPath):
+    with open(startupScript, "r") as f:
+        content = f.read()
+
+    lines = ["BUNDLE_PREFIX = " + repr(prefix), "BUNDLE_SYS_PATH = ["]
+    for pth in sysPath:
+        lines.append("    " + repr(pth) + ",")
+    lines.append("]")
+
+    content, count = re.subn(r"^BUNDLE_PREFIX = .*?^BUNDLE_SYS_PATH = (?:None|\[.*?^\])$",
+                             "\n".join(lines).replace("\\", "\\\\"),
+                             content,
+                             flags=re.MULTILINE | re.DOTALL)
+    if count != 1:
+        raise QGISBundlerError("Missing BUNDLE_SYS_PATH in " + startupScript)
+
+    with open(startupScript, "w") as f:
+        f.write(content)
+    instrument.add_files()
+    print("Python sys.path ({} entries) written to {}".format(len(sysPath), startupScript))
+
+
+@instrument.timed
 def clean_redundant_files(pa, cp):
     extensionsToCheck = [".a", ".pyc", ".c", ".cpp", ".h", ".hpp", ".cmake", ".prl"]
     dirsToCheck = ["/include", "/Headers", "/__pycache__", "/man/"]
 
     # remove unneeded files/dirs
-    for root, dirnames, filenames in os.walk(pa.qgisApp):
+    for root, dirnames, filenames in cp.index.walk():
         for file in filenames:
             fpath = os.path.join(root, file)
             filename, file_extension = os.path.splitext(fpath)
@@ -323,12 +770,150 @@ def clean_redundant_files(pa, cp):
                 cp.rm(dpath)
 
     # remove broken links and empty dirs
-    for root, dirnames, filenames in os.walk(pa.qgisApp):
+    for root, dirnames, filenames in cp.index.walk():
         for file in filenames:
             fpath = os.path.join(root, file)
             real = os.path.realpath(fpath)
             if not os.path.exists(real):
-                os.unlink(fpath)
+                cp.unlink(fpath)
+
+
+def _load_chain(graph, loader):
+    # loader and the binaries which (transitively) load it, nearest first
+    if loader is None:
+        return
+    seen = set([loader])
+    queue = [loader]
+    while queue:
+        current = queue.pop(0)
+        yield current
+        for d in sorted(graph.dependents(current)):
+            if d not in seen:
+                seen.add(d)
+                queue.append(d)
+
+
+def _resolve_dependency(pa, rpathResolver, libIndex, graph, loader, lib, rpath_hint):
+    lib_fixed = lib
+    # patch @rpath, @loader_path and @executable_path
+    if "@rpath" in lib_fixed:
+        # LC_RPATH of the load chain and of the executables
+        resolved = rpathResolver.resolve(_load_chain(graph, loader), lib_fixed)
+        if resolved:
+            lib_fixed = resolved
+        elif rpath_hint:
+            # not found in the binaries, try the hint
+            print("WARNING: " + lib_fixed + " not found in LC_RPATH of " + str(loader) + ", using --rpath_hint")
+            lib_fixed = lib_fixed.replace("@rpath", rpath_hint)
+        else:
+            raise QGISBundlerError("Unable to resolve " + lib_fixed + " from LC_RPATH of " + str(loader))
+
+    lib_fixed = lib_fixed.replace("@executable_path", pa.macosDir)
+    lib_fixed = utils.resolve_libpath(pa, lib_fixed, loader, libIndex)
+
+    if "@loader_path" in lib_fixed:
+        raise QGISBundlerError("Ups, unable to get library path, maybe fix resolve_libpath? " + lib_fixed)
+
+    return lib_fixed
+
+
+@instrument.timed
+def analyze_dependencies(pa, deps_queue, executables, rpath_hint, jobs):
+    sys_libs = set()
+    libs = set()
+    frameworks = set()
+    done_queue = set()
+    graph = DependencyGraph()
+    # executables must be in deps_queue, so their rpaths are known
+    # before any library they load is resolved
+    rpathResolver = RPathResolver(pa.macosDir, executables)
+    libIndex = utils.LibraryIndex(utils.library_search_roots(pa))
+
+    # items in queue are (loader, library) pairs,
+    # initial items have no loader
+    deps_queue = set((None, lib) for lib in deps_queue)
+
+    # the graph is processed level by level, all libraries of one level
+    # are parsed in parallel in forked worker processes (the parsing
+    # is pure python). Results are merged in sorted order so the output
+    # does not depend on the timing
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+        while deps_queue:
+            frontier = []
+            # edges are added after the level, so the load chains
+            # do not depend on the order of the items
+            edges = []
+            for loader, lib in sorted(deps_queue, key=lambda item: (item[1], item[0] or "")):
+                if lib.endswith(".py"):
+                    continue
+
+                lib_fixed = _resolve_dependency(pa, rpathResolver, libIndex, graph, loader, lib, rpath_hint)
+
+                if not lib_fixed:
+                    continue
+
+                if os.path.isdir(lib_fixed):
+                    continue
+
+                if loader:
+                    edges.append((loader, lib_fixed))
+
+                if lib_fixed in done_queue:
+                    continue
+
+                extraInfo = "" if lib == lib_fixed else "(" + lib_fixed + ")"
+                print("Analyzing " + lib + extraInfo)
+
+                if not os.path.exists(lib_fixed):
+                    raise QGISBundlerError("Library missing! " + lib_fixed)
+
+                done_queue.add(lib_fixed)
+                frontier.append(lib_fixed)
+
+            for loader, lib_fixed in edges:
+                graph.add_edge(loader, lib_fixed)
+
+            results = otool.get_binaries_dependencies(pa, frontier, executor)
+
+            deps_queue = set()
+            for lib_fixed, binaryDependencies in zip(frontier, results):
+                analyzed, type = otool.binary_type(lib_fixed)
+                graph.add_node(lib_fixed, type)
+                rpathResolver.add_binary(lib_fixed, binaryDependencies.rpaths)
+
+                if type is otool.SYS_LIB:
+                    sys_libs |= set(binaryDependencies.sys_libs)
+                elif type is otool.FRAMEWORK:
+                    frameworks |= set([analyzed])
+                elif type is otool.LIB:
+                    libs |= set([analyzed])
+
+                for dep in binaryDependencies.libs + binaryDependencies.frameworks:
+                    # @rpath id of the library is the library itself
+                    if dep == binaryDependencies.install_name and "@rpath" in dep:
+                        continue
+                    deps_queue.add((lib_fixed, dep))
+
+                for dep in binaryDependencies.sys_libs:
+                    graph.add_node(dep, otool.SYS_LIB)
+                    graph.add_edge(lib_fixed, dep)
+
+    libIndex.report()
+    return libs, frameworks, sys_libs, graph
+
+
+@instrument.timed
+def fix_libraries(pa, relinkPlan, libs, jobs):
+    # every library is independent, they are parsed in forked worker processes
+    binaries = []
+    for lib in libs:
+        if os.path.islink(lib):
+            print("Skipping link " + lib)
+        else:
+            print("Patching " + lib)
+            binaries.append(lib)
+    relinkPlan.add_all(binaries, jobs)
 
 
 def check_deps(pa, filepath, executable_path):
@@ -351,7 +936,27 @@ def check_deps(pa, filepath, executable_path):
                 raise QGISBundlerError("Library/Framework " + bin + " is not in bundle dir for " + filepath)
 
 
-def test_full_tree_consistency(pa):
+@instrument.timed
+def check_all_deps(pa, index):
+    # timed as a whole, check_deps is called for every binary
+    for root, dirs, files in index.walk():
+        for file in files:
+            filepath = os.path.join(root, file)
+            filename, file_extension = os.path.splitext(filepath)
+            if file_extension in [".dylib", ".so"] and otool.is_omach_file(filepath):
+                print('Checking compactness of library ' + filepath)
+                check_deps(pa, filepath, os.path.realpath(pa.macosDir))
+            elif not file_extension and otool.is_omach_file(filepath): # no extension == binaries
+                if os.access(filepath, os.X_OK) and ("/Frameworks/" not in filepath):
+                    print('Checking compactness of binaries ' + filepath)
+                    check_deps(pa, filepath, os.path.dirname(filepath))
+                else:
+                    print('Checking compactness of library ' + filepath)
+                    check_deps(pa, filepath, os.path.realpath(pa.macosDir))
+
+
+@instrument.timed
+def test_full_tree_consistency(pa, index):
     print("Test qgis --help works")
     try:
         output = subprocess.check_output([pa.qgisExe, "--help"], stderr=subprocess.STDOUT, encoding='UTF-8')
@@ -395,7 +1000,7 @@ def test_full_tree_consistency(pa):
     ]
 
     unique_libs = {}
-    for root, dirs, files in os.walk(pa.qgisApp):
+    for root, dirs, files in index.walk():
         for file in files:
             filepath = os.path.join(root, file)
             if not os.path.islink(filepath):
@@ -431,23 +1036,10 @@ def test_full_tree_consistency(pa):
         raise QGISBundlerError("Duplicate libraries found!")
 
     print("Test that all libraries have correct link and and bundled")
-    for root, dirs, files in os.walk(pa.qgisApp):
-        for file in files:
-            filepath = os.path.join(root, file)
-            filename, file_extension = os.path.splitext(filepath)
-            if file_extension in [".dylib", ".so"] and otool.is_omach_file(filepath):
-                print('Checking compactness of library ' + filepath)
-                check_deps(pa, filepath, os.path.realpath(pa.macosDir))
-            elif not file_extension and otool.is_omach_file(filepath): # no extension == binaries
-                if os.access(filepath, os.X_OK) and ("/Frameworks/" not in filepath):
-                    print('Checking compactness of binaries ' + filepath)
-                    check_deps(pa, filepath, os.path.dirname(filepath))
-                else:
-                    print('Checking compactness of library ' + filepath)
-                    check_deps(pa, filepath, os.path.realpath(pa.macosDir))
+    check_all_deps(pa, index)
 
     print("Test that all links are pointing to the destination inside the bundle")
-    for root, dirs, files in os.walk(pa.qgisApp):
+    for root, dirs, files in index.walk():
         for file in files:
             filepath = os.path.join(root, file)
             filepath = os.path.realpath(filepath)
@@ -493,7 +1085,7 @@ def test_full_tree_consistency(pa):
         "Setup",
 
     ]
-    for root, dirs, files in os.walk(pa.qgisApp):
+    for root, dirs, files in index.walk():
         for file in files:
             filepath = os.path.join(root, file)
             if any(filepath.endswith(ext) for ext in exceptions):
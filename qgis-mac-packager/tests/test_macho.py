@@ -0,0 +1,228 @@
+# 2018 Peter Petrik (zilolv at gmail dot com)
+# GNU General Public License 2 any later version
+
+# Tests of the Mach-O reader and the in place rewriting of the load commands
+# on synthetic thin and fat binaries, so they can run on any platform
+#
+# python3 -m unittest discover -s tests
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from qgisBundlerTools import macho
+
+CPU_TYPE_ARM64 = 0x0100000c
+MH_DYLIB = 6
+# file offset of the section data in the thin fixtures
+TEXT_OFFSET = 0x400
+
+
+def _lc_str(cmd, name, fixed=b"", align=8):
+    # load command with lc_str after the fixed part, e.g. dylib timestamp and versions
+    str_offset = 12 + len(fixed)
+    encoded = name.encode("utf-8") + b"\0"
+    size = (str_offset + len(encoded) + align - 1) // align * align
+    data = struct.pack("<3I", cmd, size, str_offset) + fixed + encoded
+    return data + b"\0" * (size - len(data))
+
+
+def _dylib(cmd, name):
+    return _lc_str(cmd, name, struct.pack("<3I", 2, 0x10000, 0x10000))
+
+
+def _segment(text_offset):
+    # LC_SEGMENT_64 __TEXT with one __text section at text_offset
+    section = (b"__text".ljust(16, b"\0") + b"__TEXT".ljust(16, b"\0") +
+               struct.pack("<2Q8I", 0, 16, text_offset, 0, 0, 0, 0, 0, 0, 0))
+    return (struct.pack("<2I", macho.LC_SEGMENT_64, 72 + len(section)) + b"__TEXT".ljust(16, b"\0") +
+            struct.pack("<4Q4I", 0, 0x1000, 0, 0x1000, 5, 5, 1, 0) + section)
+
+
+def make_thin(id_name, deps, rpaths, cputype=macho.CPU_TYPE_X86_64, text_offset=TEXT_OFFSET):
+    commands = [_segment(text_offset)]
+    if id_name:
+        commands.append(_dylib(macho.LC_ID_DYLIB, id_name))
+    for dep in deps:
+        commands.append(_dylib(macho.LC_LOAD_DYLIB, dep))
+    for rpath in rpaths:
+        commands.append(_lc_str(macho.LC_RPATH, rpath))
+    data = b"".join(commands)
+    header = struct.pack("<8I", macho.MH_MAGIC_64, cputype, 3, MH_DYLIB, len(commands), len(data), 0, 0)
+    binary = header + data
+    if len(binary) > text_offset:
+        raise ValueError("load commands do not fit before the section data")
+    return binary + b"\0" * (text_offset - len(binary)) + b"CODE" * 4
+
+
+def make_fat(slices):
+    # fat binary with the slices aligned to 0x1000
+    header = struct.pack(">2I", macho.FAT_MAGIC, len(slices))
+    offset = 0x1000
+    body = b""
+    for cputype, data in slices:
+        header += struct.pack(">5I", cputype, 3, offset, len(data), 12)
+        body += data + b"\0" * (-len(data) % 0x1000)
+        offset += len(data) + (-len(data) % 0x1000)
+    return header + b"\0" * (0x1000 - len(header)) + body
+
+
+class MachOTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="qgis-bundler-macho")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+
+class TestReadSlices(MachOTestCase):
+    def test_thin(self):
+        path = self.write("libfoo.dylib", make_thin("@rpath/libfoo.dylib",
+                                                    ["/usr/lib/libSystem.B.dylib", "@rpath/libbar.dylib"],
+                                                    ["@loader_path/../lib"]))
+        slices = macho.read_slices(path)
+        self.assertEqual(len(slices), 1)
+        s = slices[0]
+        self.assertTrue(s.is64)
+        self.assertEqual(s.id_dylib(), "@rpath/libfoo.dylib")
+        self.assertEqual(s.dylibs(), ["/usr/lib/libSystem.B.dylib", "@rpath/libbar.dylib"])
+        self.assertEqual(s.rpaths(), ["@loader_path/../lib"])
+        self.assertEqual(s.data_start, TEXT_OFFSET)
+
+    def test_fat(self):
+        path = self.write("libfoo.dylib", make_fat([
+            (CPU_TYPE_ARM64, make_thin("libfoo.dylib", ["/opt/arm/libbar.dylib"], [], cputype=CPU_TYPE_ARM64)),
+            (macho.CPU_TYPE_X86_64, make_thin("libfoo.dylib", ["/usr/local/lib/libbar.dylib"], []))]))
+        slices = macho.read_slices(path)
+        self.assertEqual([s.offset for s in slices], [0x1000, 0x2000])
+        self.assertEqual(macho.main_slice(slices).dylibs(), ["/usr/local/lib/libbar.dylib"])
+
+    def test_not_macho(self):
+        path = self.write("script.sh", b"#!/bin/sh\necho hello\n")
+        self.assertEqual(macho.read_slices(path), [])
+        self.assertIsNone(macho.load_commands_digest(path))
+
+    def test_truncated_load_commands(self):
+        data = make_thin("libfoo.dylib", ["@rpath/libbar.dylib"], [])
+        path = self.write("libfoo.dylib", data[:60])
+        with self.assertRaises(macho.MachOError):
+            macho.read_slices(path)
+
+    def test_truncated_header(self):
+        path = self.write("libfoo.dylib", make_thin("libfoo.dylib", [], [])[:20])
+        with self.assertRaises(macho.MachOError):
+            macho.read_slices(path)
+
+    def test_truncated_fat_header(self):
+        data = make_fat([(macho.CPU_TYPE_X86_64, make_thin("libfoo.dylib", [], []))])
+        path = self.write("libfoo.dylib", data[:12])
+        with self.assertRaises(macho.MachOError):
+            macho.read_slices(path)
+
+    def test_invalid_command_size(self):
+        data = bytearray(make_thin("libfoo.dylib", [], []))
+        # cmdsize of the first load command beyond sizeofcmds
+        struct.pack_into("<I", data, 32 + 4, 0x10000)
+        path = self.write("libfoo.dylib", bytes(data))
+        with self.assertRaises(macho.MachOError):
+            macho.read_slices(path)
+
+
+class TestLoadCommandsDigest(MachOTestCase):
+    def test_digest_ignores_section_data(self):
+        data = make_thin("libfoo.dylib", ["@rpath/libbar.dylib"], [])
+        first = self.write("a.dylib", data)
+        second = self.write("b.dylib", data[:-4] + b"DATA")
+        self.assertEqual(macho.load_commands_digest(first), macho.load_commands_digest(second))
+
+    def test_digest_of_load_commands(self):
+        first = self.write("a.dylib", make_thin("libfoo.dylib", ["@rpath/libbar.dylib"], []))
+        second = self.write("b.dylib", make_thin("libfoo.dylib", ["@rpath/libbaz.dylib"], []))
+        self.assertNotEqual(macho.load_commands_digest(first), macho.load_commands_digest(second))
+
+
+class TestRewriteLoadCommands(MachOTestCase):
+    def test_thin(self):
+        path = self.write("libfoo.dylib", make_thin("/usr/local/lib/libfoo.dylib",
+                                                    ["/usr/local/lib/libbar.dylib", "/usr/lib/libSystem.B.dylib"],
+                                                    ["/usr/local/lib", "@loader_path/../lib"]))
+        modified = macho.rewrite_load_commands(path,
+                                               id_name="@executable_path/lib/libfoo.dylib",
+                                               changes={"/usr/local/lib/libbar.dylib": "@executable_path/lib/libbar.dylib"},
+                                               delete_rpaths=["/usr/local/lib"])
+        self.assertTrue(modified)
+
+        s = macho.read_slices(path)[0]
+        self.assertEqual(s.id_dylib(), "@executable_path/lib/libfoo.dylib")
+        self.assertEqual(s.dylibs(), ["@executable_path/lib/libbar.dylib", "/usr/lib/libSystem.B.dylib"])
+        self.assertEqual(s.rpaths(), ["@loader_path/../lib"])
+        self.assertEqual(len(s.commands), 5)
+
+        data = self.read(path)
+        # the rest of the old commands is zeroed, section data untouched
+        self.assertEqual(data[32 + s.sizeofcmds:TEXT_OFFSET], b"\0" * (TEXT_OFFSET - 32 - s.sizeofcmds))
+        self.assertEqual(data[TEXT_OFFSET:], b"CODE" * 4)
+
+    def test_fat(self):
+        path = self.write("libfoo.dylib", make_fat([
+            (macho.CPU_TYPE_X86_64, make_thin("libfoo.dylib", ["/usr/local/lib/libbar.dylib"], ["/usr/local/lib"])),
+            (CPU_TYPE_ARM64, make_thin("libfoo.dylib", ["/usr/local/lib/libbar.dylib"], ["/usr/local/lib"],
+                                       cputype=CPU_TYPE_ARM64))]))
+        self.assertTrue(macho.rewrite_load_commands(path,
+                                                    changes={"/usr/local/lib/libbar.dylib": "@rpath/libbar.dylib"},
+                                                    delete_rpaths=["/usr/local/lib"]))
+        for s in macho.read_slices(path):
+            self.assertEqual(s.dylibs(), ["@rpath/libbar.dylib"])
+            self.assertEqual(s.rpaths(), [])
+
+    def test_no_change(self):
+        data = make_thin("libfoo.dylib", ["/usr/lib/libSystem.B.dylib"], [])
+        path = self.write("libfoo.dylib", data)
+        self.assertFalse(macho.rewrite_load_commands(path,
+                                                     id_name="libfoo.dylib",
+                                                     changes={"/usr/local/lib/libbar.dylib": "@rpath/libbar.dylib"},
+                                                     delete_rpaths=["/usr/local/lib"]))
+        self.assertEqual(self.read(path), data)
+
+    def test_header_padding_overflow(self):
+        # load commands end just before the section data
+        data = make_thin("libfoo.dylib", ["/usr/local/lib/libbar.dylib"], [], text_offset=0x118)
+        path = self.write("libfoo.dylib", data)
+        with self.assertRaises(macho.MachOError):
+            macho.rewrite_load_commands(path, changes={"/usr/local/lib/libbar.dylib": "@executable_path/" + "x" * 64})
+        self.assertEqual(self.read(path), data)
+
+    def test_fat_overflow_in_one_slice(self):
+        # the first slice fits, the second does not, nothing is written
+        data = make_fat([
+            (macho.CPU_TYPE_X86_64, make_thin("libfoo.dylib", ["/usr/local/lib/libbar.dylib"], [])),
+            (CPU_TYPE_ARM64, make_thin("libfoo.dylib", ["/usr/local/lib/libbar.dylib"], [],
+                                       cputype=CPU_TYPE_ARM64, text_offset=0x118))])
+        path = self.write("libfoo.dylib", data)
+        with self.assertRaises(macho.MachOError):
+            macho.rewrite_load_commands(path, changes={"/usr/local/lib/libbar.dylib": "@executable_path/" + "x" * 64})
+        self.assertEqual(self.read(path), data)
+
+    def test_not_macho(self):
+        path = self.write("script.sh", b"#!/bin/sh\n")
+        with self.assertRaises(macho.MachOError):
+            macho.rewrite_load_commands(path, id_name="libfoo.dylib")
+
+
+if __name__ == "__main__":
+    unittest.main()